@@ -8,9 +8,22 @@ Runs the complete HCFA preprocessing pipeline:
 4. Extract JSON from OCR text (llm_hcfa)
 5. Validate and clean JSON files (validatejson)
 6. Map JSON to FileMaker records (map_to_fm)
+
+By default the pipeline streams: every stage runs concurrently with its own
+thread or process pool, and each document moves on as soon as the previous
+stage is done with it, through bounded queues between the stages. In batch
+mode (--batch or PIPELINE_MODE=batch) each stage runs over the whole backlog
+before the next starts.
+
+With PIPELINE_RENDER_ONCE set, steps 2 and 3 run as one stage (preview_ocr)
+that downloads and renders each PDF once for both its previews and OCR.
 """
 import os
 import sys
+import queue
+import threading
+import multiprocessing
+from datetime import datetime
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -25,9 +38,49 @@ load_dotenv()
 from preprocess.utils import split_hcfa_batch
 from preprocess.utils import pdf_preview
 from preprocess.utils import ocr_hcfa
+from preprocess.utils import preview_ocr
 from preprocess.utils import llm_hcfa
 from preprocess.utils import validatejson
+from preprocess.utils import map_to_fm
 from preprocess.utils.map_to_fm import process_mapping_s3
+from preprocess.utils.mapping_report import publish_report
+from preprocess.utils.storage import batched_deletes
+
+# batch: one stage after another, streaming: documents flow through all stages
+PIPELINE_MODE = os.getenv('PIPELINE_MODE', 'streaming').lower()
+
+# Previews and OCR from a single download and rendering per PDF (see preview_ocr)
+PIPELINE_RENDER_ONCE = os.getenv('PIPELINE_RENDER_ONCE', 'false').lower() in ('1', 'true', 'yes')
+
+# Documents buffered between two streaming stages; a full queue pauses the stage feeding it
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', '32'))
+
+# Worker pool per streaming stage: (pool type, default workers). Threads for the stages
+# that wait on S3 and remote APIs, processes for CPU-bound PDF parsing and rendering.
+# Override with PIPELINE_<STAGE>_POOL (thread|process) and PIPELINE_<STAGE>_WORKERS.
+STAGE_POOLS = {
+    'split': ('process', 2),
+    'preview': ('process', os.cpu_count() or 1),
+    'ocr': ('thread', 8),
+    # Threads, so Vision calls share one rate limiter
+    'preview_ocr': ('thread', 8),
+    'extract': ('thread', 8),
+    'validate': ('thread', 4),
+    'map': ('thread', 2),
+}
+
+# Moved sources queued before their deletes are sent during a streaming run
+# (also sent every S3_DELETE_FLUSH_SECONDS), so a killed run re-processes few documents
+PIPELINE_DELETE_BATCH_SIZE = int(os.getenv('PIPELINE_DELETE_BATCH_SIZE', '50'))
+
+# Documents being worked on at the same time across all streaming stages
+PIPELINE_MAX_CONCURRENCY = int(os.getenv('PIPELINE_MAX_CONCURRENCY', '32'))
+
+# Marks the end of one producer's documents on a stage queue
+_DONE = object()
+
+# Tells a stage worker to exit
+_STOP = object()
 
 # Configure output encoding for Windows
 if sys.platform == 'win32':
@@ -35,8 +88,285 @@ if sys.platform == 'win32':
     sys.stdout = codecs.getwriter('utf-8')(sys.stdout.buffer, 'replace')
     sys.stderr = codecs.getwriter('utf-8')(sys.stderr.buffer, 'replace')
 
-def run_pipeline():
+def stage_pool(name):
+    """Pool type and worker count for a streaming stage."""
+    pool, workers = STAGE_POOLS[name]
+    pool = os.getenv(f'PIPELINE_{name.upper()}_POOL', pool).lower()
+    workers = int(os.getenv(f'PIPELINE_{name.upper()}_WORKERS', workers))
+    return pool, max(1, workers)
+
+# Stage handlers take one document and return the documents for the next stage.
+# They are module-level functions so process pools can run them.
+
+def _split_batch(item):
+    batch_key, batch_idx, timestamp = item
+    return list(split_hcfa_batch.iter_split_pages(batch_key, batch_idx, timestamp))
+
+def _preview_pdf(pdf_key):
+    # A failed preview does not hold the document back from OCR
+    try:
+        pdf_preview.preview_document(pdf_key)
+    except Exception as e:
+        print(f"[ERROR] Preview failed for {pdf_key}: {str(e)}")
+    return [pdf_key]
+
+def _ocr_pdfs(pdf_keys):
+    # Several PDFs share one engine request (Vision packs up to five pages per request)
+    return [txt_key for txt_key in ocr_hcfa.ocr_documents(pdf_keys) if txt_key]
+
+def _preview_ocr_pdf(pdf_key):
+    txt_key = preview_ocr.preview_ocr_document(pdf_key)
+    return [txt_key] if txt_key else []
+
+_prompt = None
+
+def _extract_json(txt_key):
+    global _prompt
+    if _prompt is None:
+        _prompt = llm_hcfa.load_prompt()
+    json_key = llm_hcfa.extract_document(txt_key, _prompt)
+    return [json_key] if json_key else []
+
+def _validate_json(json_key):
+    valid_key = validatejson.validate_document(json_key)
+    return [valid_key] if valid_key else []
+
+_order_index = None
+_order_index_lock = threading.Lock()
+
+def _map_claim(valid_key):
+    global _order_index
+    # Claims arrive one by one, so the full index is loaded with the first claim
+    with _order_index_lock:
+        if _order_index is None:
+            _order_index = map_to_fm.load_order_index()
+    result = map_to_fm.map_document(valid_key, _order_index)
+    return [result] if result else []
+
+STAGE_HANDLERS = [
+    ('split', _split_batch),
+    ('preview', _preview_pdf),
+    ('ocr', _ocr_pdfs),
+    ('extract', _extract_json),
+    ('validate', _validate_json),
+    ('map', _map_claim),
+]
+
+def stage_batch_size(name):
+    """
+    Documents per handler call for stages whose handler takes a list, None
+    for stages handling one document at a time.
+    """
+    if name == 'ocr':
+        return ocr_hcfa.get_engine().batch_size
+    return None
+
+def stage_handlers(render_once=None):
+    """Streaming stages in pipeline order, with preview and OCR combined when rendering once."""
+    if render_once is None:
+        render_once = PIPELINE_RENDER_ONCE
+    if not render_once:
+        return STAGE_HANDLERS
+    handlers = [stage for stage in STAGE_HANDLERS if stage[0] not in ('preview', 'ocr')]
+    handlers.insert(1, ('preview_ocr', _preview_ocr_pdf))
+    return handlers
+
+class PipelineStage:
+    """
+    One streaming stage: a bounded input queue served by a pool of workers.
+    
+    Thread stages call the handler in their worker threads. Process stages
+    run it in a forked multiprocessing pool with one waiting thread per
+    process. Every call holds a slot of the pipeline-wide budget while it runs.
+    
+    With a batch_size, the handler takes a list: a worker waits for one
+    document, then adds up to batch_size - 1 more that are already queued,
+    so batching never holds a document back.
+    """
+    
+    def __init__(self, name, handle, pool='thread', workers=1, batch_size=None):
+        self.name = name
+        self.handle = handle
+        self.pool = pool
+        self.workers = workers
+        self.batch_size = batch_size
+        self.inbox = queue.Queue(PIPELINE_QUEUE_SIZE)
+        self.outbox = None
+        self.producers = 0
+        self.results = []
+        self.finished = 0
+        self.lock = threading.Lock()
+        self.threads = []
+        self.process_pool = None
+    
+    def open_pool(self):
+        """Fork the worker processes; done for every stage before any thread starts."""
+        if self.pool != 'process':
+            return
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+        self.process_pool = context.Pool(self.workers)
+    
+    def start(self, budget):
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, args=(budget,), name=f"pipeline-{self.name}-{number}")
+            thread.start()
+            self.threads.append(thread)
+    
+    def join(self):
+        """Wait for the workers, then tell the next stage this one is finished."""
+        for thread in self.threads:
+            thread.join()
+        if self.outbox is not None:
+            self.outbox.put(_DONE)
+        if self.process_pool is not None:
+            self.process_pool.close()
+            self.process_pool.join()
+    
+    def _next_items(self):
+        """The next document, plus queued ones up to batch_size; a marker ends the list."""
+        items = [self.inbox.get()]
+        while (len(items) < (self.batch_size or 1)
+               and items[-1] is not _STOP and items[-1] is not _DONE):
+            try:
+                items.append(self.inbox.get_nowait())
+            except queue.Empty:
+                break
+        return items
+    
+    def _work(self, budget):
+        while True:
+            items = self._next_items()
+            marker = items.pop() if items[-1] is _STOP or items[-1] is _DONE else None
+            if items:
+                self._handle(items[0] if self.batch_size is None else items, budget)
+            if marker is _STOP:
+                return
+            if marker is _DONE:
+                with self.lock:
+                    self.finished += 1
+                    if self.finished < self.producers:
+                        continue
+                # Every producer is done and the queue is drained, stop the other workers
+                for _ in range(self.workers - 1):
+                    self.inbox.put(_STOP)
+                return
+    
+    def _handle(self, item, budget):
+        # A batch holds a single budget slot, so partly acquired budgets cannot deadlock
+        try:
+            with budget:
+                if self.process_pool is not None:
+                    outputs = self.process_pool.apply(self.handle, (item,))
+                else:
+                    outputs = self.handle(item)
+        except Exception as e:
+            print(f"[ERROR] {self.name} failed for {item}: {str(e)}")
+            return
+        
+        # The budget slot is released before waiting on a full queue downstream
+        for output in outputs:
+            if self.outbox is not None:
+                self.outbox.put(output)
+            else:
+                self.results.append(output)
+
+def _feed(keys, inbox):
+    """Queue documents that were already waiting for a stage before the run started."""
+    for key in keys:
+        inbox.put(key)
+    inbox.put(_DONE)
+
+def run_streaming_pipeline(render_once=None):
+    """
+    Run all stages concurrently, passing each document to the next stage
+    as soon as it is ready.
+    
+    New batches flow split -> preview -> OCR -> LLM -> validate -> map. Each
+    stage has its own worker pool (see STAGE_POOLS) and at most
+    PIPELINE_MAX_CONCURRENCY documents are processed at once overall.
+    Documents already waiting in a stage's input folder are listed once at
+    the start and queued for that stage, so leftovers of earlier runs are
+    finished as well.
+    
+    Args:
+        render_once: Run preview and OCR as one stage, defaults to PIPELINE_RENDER_ONCE
+    
+    Returns:
+        List of match details for every mapped claim.
+    """
+    print("\n=== Starting HCFA Preprocessing Pipeline (streaming) ===\n")
+    run_started_at = datetime.now()
+    timestamp = run_started_at.strftime("%Y%m%d_%H%M%S")
+    
+    handlers = stage_handlers(render_once)
+    
+    # Inputs already waiting, listed before any stage writes new outputs
+    pdf_keys = list(pdf_preview.iter_pdf_keys())
+    backlog = {
+        'split': [(key, idx, timestamp) for idx, key in enumerate(split_hcfa_batch.list_batch_keys(), start=1)],
+        'preview': pdf_keys,
+        'preview_ocr': pdf_keys,
+        'extract': list(llm_hcfa.iter_txt_keys()),
+        'validate': list(validatejson.iter_json_keys()),
+        'map': list(map_to_fm.iter_claim_keys()),
+    }
+    
+    stages = []
+    for name, handle in handlers:
+        pool, workers = stage_pool(name)
+        batch_size = stage_batch_size(name)
+        stages.append(PipelineStage(name, handle, pool, workers, batch_size))
+        batches = f", up to {batch_size} documents per call" if batch_size else ""
+        waiting = f", {len(backlog[name])} documents waiting" if backlog.get(name) else ""
+        print(f"Stage {name}: {workers} {pool} workers{batches}{waiting}")
+    
+    feeders = []
+    for position, stage in enumerate(stages):
+        if position + 1 < len(stages):
+            stage.outbox = stages[position + 1].inbox
+        # Documents come from the stage before and/or the backlog
+        stage.producers = (position > 0) + (stage.name in backlog)
+        if stage.name in backlog:
+            feeders.append(threading.Thread(target=_feed, name=f"pipeline-{stage.name}-backlog",
+                                            args=(backlog[stage.name], stage.inbox)))
+    
+    for stage in stages:
+        stage.open_pool()
+    budget = threading.BoundedSemaphore(PIPELINE_MAX_CONCURRENCY)
+    
+    # Moved sources are deleted in small batches across all stages
+    with batched_deletes(max_keys=PIPELINE_DELETE_BATCH_SIZE):
+        for stage in stages:
+            stage.start(budget)
+        for feeder in feeders:
+            feeder.start()
+        # In pipeline order, so each stage is told its predecessor finished
+        for stage in stages:
+            stage.join()
+        for feeder in feeders:
+            feeder.join()
+    
+    results = stages[-1].results
+    print(f"\nMapped {len(results)} claims")
+    try:
+        publish_report(results, run_started_at)
+    except Exception as e:
+        print(f"[ERROR] Error publishing mapping report: {str(e)}\n")
+    
+    print("=== Pipeline Complete ===")
+    return results
+
+def run_pipeline(streaming=None, render_once=None):
     """Run the complete preprocessing pipeline"""
+    if streaming is None:
+        streaming = PIPELINE_MODE != 'batch'
+    if render_once is None:
+        render_once = PIPELINE_RENDER_ONCE
+    if streaming:
+        run_streaming_pipeline(render_once)
+        return True
+    
     print("\n=== Starting HCFA Preprocessing Pipeline ===\n")
     
     print("Step 1: Splitting batch PDFs...")
@@ -49,25 +379,33 @@ def run_pipeline():
         else:
             print(f"[ERROR] Error during batch splitting: {str(e)}\n")
         
-    print("Step 2: Generating PDF previews...")
-    try:
-        pdf_preview.process_previews_s3()
-        print("[SUCCESS] Preview generation complete\n")
-    except Exception as e:
-        if "No PDFs found" in str(e):
-            print("[INFO] No PDFs to preview, continuing...\n")
-        else:
-            print(f"[ERROR] Error during preview generation: {str(e)}\n")
+    if render_once:
+        print("Steps 2-3: Generating PDF previews and OCR from one rendering...")
+        try:
+            preview_ocr.process_preview_ocr_s3()
+            print("[SUCCESS] Preview generation and OCR processing complete\n")
+        except Exception as e:
+            print(f"[ERROR] Error during preview generation and OCR: {str(e)}\n")
+    else:
+        print("Step 2: Generating PDF previews...")
+        try:
+            pdf_preview.process_previews_s3()
+            print("[SUCCESS] Preview generation complete\n")
+        except Exception as e:
+            if "No PDFs found" in str(e):
+                print("[INFO] No PDFs to preview, continuing...\n")
+            else:
+                print(f"[ERROR] Error during preview generation: {str(e)}\n")
     
-    print("Step 3: Performing OCR on PDFs...")
-    try:
-        ocr_hcfa.process_ocr_s3()
-        print("[SUCCESS] OCR processing complete\n")
-    except Exception as e:
-        if "No PDFs found" in str(e):
-            print("[INFO] No PDFs for OCR, continuing...\n")
-        else:
-            print(f"[ERROR] Error during OCR processing: {str(e)}\n")
+        print("Step 3: Performing OCR on PDFs...")
+        try:
+            ocr_hcfa.process_ocr_s3()
+            print("[SUCCESS] OCR processing complete\n")
+        except Exception as e:
+            if "No PDFs found" in str(e):
+                print("[INFO] No PDFs for OCR, continuing...\n")
+            else:
+                print(f"[ERROR] Error during OCR processing: {str(e)}\n")
     
     print("Step 4: Extracting JSON from OCR text...")
     try:
@@ -103,5 +441,12 @@ def run_pipeline():
     return True
 
 if __name__ == "__main__":
-    success = run_pipeline()
+    if '--batch' in sys.argv:
+        streaming = False
+    elif '--streaming' in sys.argv:
+        streaming = True
+    else:
+        streaming = None
+    success = run_pipeline(streaming=streaming,
+                           render_once=True if '--render-once' in sys.argv else None)
     sys.exit(0 if success else 1)
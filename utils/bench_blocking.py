@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+bench_blocking.py
+
+Checks that blocked candidate generation (OrderIndex.candidates) finds the
+same best match as the exhaustive scan over every order, on synthetic
+FileMaker orders (10k and 100k by default), and compares their timings.
+Half of the claims are misspelled copies of an order's name with a DOS near
+one of its line items, the other half random names.
+
+Usage:
+    python bench_blocking.py [--sizes 10000 100000] [--claims 500]
+"""
+import sys
+import time
+import random
+import argparse
+from pathlib import Path
+
+# Add the project root to Python path
+project_root = str(Path(__file__).resolve().parents[2])
+sys.path.append(project_root)
+
+try:
+    from preprocess.utils.fm_index import OrderIndex
+    from preprocess.utils.name_scoring import NAME_THRESHOLD
+    from preprocess.utils.map_to_fm import normalize_text, find_candidate_matches, best_candidate
+    from preprocess.utils.bench_data import (CPT_CODES, FIRST_DAY, LAST_DAY, misspell, random_name,
+                                             synthetic_orders, synthetic_line_items)
+except ImportError:
+    from fm_index import OrderIndex
+    from name_scoring import NAME_THRESHOLD
+    from map_to_fm import normalize_text, find_candidate_matches, best_candidate
+    from bench_data import (CPT_CODES, FIRST_DAY, LAST_DAY, misspell, random_name,
+                            synthetic_orders, synthetic_line_items)
+
+
+def synthetic_claims(count, orders, line_items, names, rng):
+    """(json_name, dos_days, json_data) per claim."""
+    days_by_order = line_items.groupby('Order_ID')['DOS'].apply(list)
+    claims = []
+    for number in range(count):
+        if number % 2:
+            name = random_name(rng)
+            days = [rng.randint(FIRST_DAY, LAST_DAY)]
+        else:
+            pos = rng.randrange(len(orders))
+            name = misspell(names[pos], rng) if rng.random() < 0.5 else names[pos]
+            days = [day + rng.randint(-10, 10) for day in days_by_order[orders['Order_ID'][pos]]]
+        json_data = {'service_lines': [{'cpt_code': rng.choice(CPT_CODES)}]}
+        claims.append((normalize_text(name), days, json_data))
+    return claims
+
+
+def best_matches(order_index, claims, exhaustive):
+    """Position of the best match per claim (None if unmapped) and the time it took."""
+    start = time.perf_counter()
+    candidates = None
+    if not exhaustive:
+        candidates = [order_index.candidates(json_name, days) for json_name, days, _ in claims]
+    name_hits = order_index.name_scorer.match([json_name for json_name, _, _ in claims],
+                                              NAME_THRESHOLD, candidates)
+    best = []
+    for (_, days, json_data), hits in zip(claims, name_hits):
+        match = best_candidate(find_candidate_matches(hits, days, order_index), json_data, order_index)
+        best.append(match['pos'] if match else None)
+    return best, time.perf_counter() - start
+
+
+def run_size(size, claim_count, rng):
+    print(f"\n=== {size:,} orders ===")
+    orders, names = synthetic_orders(size, rng)
+    line_items = synthetic_line_items(orders, rng)
+
+    start = time.perf_counter()
+    order_index = OrderIndex.build(orders, line_items)
+    build_time = time.perf_counter() - start
+
+    claims = synthetic_claims(claim_count, orders, line_items, names, rng)
+    blocked, blocked_time = best_matches(order_index, claims, exhaustive=False)
+    exhaustive, exhaustive_time = best_matches(order_index, claims, exhaustive=True)
+
+    mapped = sum(1 for pos in exhaustive if pos is not None)
+    mismatches = sum(1 for a, b in zip(blocked, exhaustive) if a != b)
+    print(f"Index build:           {build_time:8.2f}s")
+    print(f"Blocked:               {blocked_time:8.2f}s for {claim_count} claims")
+    print(f"Exhaustive:            {exhaustive_time:8.2f}s for {claim_count} claims")
+    print(f"Speedup:               {exhaustive_time / blocked_time:8.1f}x")
+    print(f"Mapped claims:         {mapped:8d}")
+    if mismatches:
+        print(f"❌ {mismatches} claims matched differently than the exhaustive scan")
+    else:
+        print("✔ Best matches identical to the exhaustive scan")
+    return mismatches == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare blocked and exhaustive FileMaker matching")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000])
+    parser.add_argument('--claims', type=int, default=500, help="Synthetic claims matched per size")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    ok = all([run_size(size, args.claims, rng) for size in args.sizes])
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
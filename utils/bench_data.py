@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+bench_data.py
+
+Synthetic FileMaker data shared by the bench_* scripts: patient names with
+OCR-style typos, orders and line items shaped like load_orders_to_dataframe
+returns them, and DOS strings in the formats the snapshot uses.
+"""
+import sys
+from datetime import timedelta
+from pathlib import Path
+import pandas as pd
+
+# Add the project root to Python path
+project_root = str(Path(__file__).resolve().parents[2])
+sys.path.append(project_root)
+
+try:
+    from preprocess.utils.map_to_fm import normalize_text
+    from preprocess.utils.date_parsing import EPOCH, MAPPING_FORMATS
+except ImportError:
+    from map_to_fm import normalize_text
+    from date_parsing import EPOCH, MAPPING_FORMATS
+
+FIRST_NAMES = ['JAMES', 'MARY', 'ROBERT', 'PATRICIA', 'JOHN', 'JENNIFER', 'MICHAEL', 'LINDA',
+               'DAVID', 'ELIZABETH', 'JOSE', 'MARIA', 'WEI', 'FATIMA', 'OLUWASEUN', 'NGUYEN']
+LAST_NAMES = ['SMITH', 'JOHNSON', 'WILLIAMS', 'BROWN', 'JONES', 'GARCIA', 'MILLER', 'DAVIS',
+              'RODRIGUEZ', 'MARTINEZ', 'HERNANDEZ', 'LOPEZ', 'GONZALEZ', 'WILSON', 'ANDERSON', 'OKAFOR']
+SYLLABLES = ['AN', 'BER', 'CO', 'DA', 'EL', 'FI', 'GAR', 'HO', 'IN', 'JO', 'KA', 'LI', 'MON',
+             'NA', 'OS', 'PER', 'QUI', 'RO', 'SAN', 'TA', 'UR', 'VI', 'WA', 'XI', 'YO', 'ZE']
+LETTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+CPT_CODES = ['73721', '73221', '72148', '70551', '74177', '71250']
+
+# Epoch days of the synthetic DOS range (2023-2024)
+FIRST_DAY, LAST_DAY = 19358, 20088
+
+
+def misspell(name, rng):
+    """Replace one character, as OCR or data entry might."""
+    chars = list(name)
+    chars[rng.randrange(len(chars))] = rng.choice(LETTERS)
+    return ''.join(chars)
+
+
+def random_name(rng):
+    """FileMaker-style 'First Middle Last' name with the occasional typo."""
+    # Common surnames plus generated ones, for a realistic spread of distinct names
+    if rng.random() < 0.3:
+        last = rng.choice(LAST_NAMES)
+    else:
+        last = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+    name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LETTERS)} {last}"
+    return misspell(name, rng) if rng.random() < 0.2 else name
+
+
+def synthetic_orders(size, rng):
+    """Normalized orders and the raw names they were made from."""
+    names = [random_name(rng) for _ in range(size)]
+    orders = pd.DataFrame({
+        'Order_ID': [f"ORD{pos:07d}" for pos in range(size)],
+        'FileMaker_Record_Number': [str(100000 + pos) for pos in range(size)],
+        'Patient_Last_Name': [normalize_text(name.split()[-1]) for name in names],
+        'Patient_First_Name': [normalize_text(name.split()[0]) for name in names],
+        'PatientName': [normalize_text(name) for name in names],
+    })
+    return orders, names
+
+
+def synthetic_line_items(orders, rng):
+    """One to three line items per order, DOS as epoch days."""
+    line_items = []
+    for order_id in orders['Order_ID']:
+        for _ in range(rng.randrange(1, 4)):
+            line_items.append({'Order_ID': order_id, 'DOS': rng.randint(FIRST_DAY, LAST_DAY),
+                               'CPT': rng.choice(CPT_CODES)})
+    return pd.DataFrame(line_items)
+
+
+def random_dos_string(rng, first_day=FIRST_DAY, last_day=LAST_DAY):
+    """A DOS between two epoch days, written in one of the snapshot's date formats."""
+    day = EPOCH + timedelta(days=rng.randint(first_day, last_day))
+    return day.strftime(rng.choice(MAPPING_FORMATS))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+bench_date_parsing.py
+
+Checks date_parsing.parse_epoch_days against map_to_fm.parse_date on a
+fuzzed corpus of date strings, then measures throughput against the
+row-by-row apply used before.
+
+Usage:
+    python bench_date_parsing.py [--corpus 200000] [--rows 2000000]
+"""
+import sys
+import time
+import random
+import argparse
+from datetime import datetime
+from pathlib import Path
+import pandas as pd
+
+# Add the project root to Python path
+project_root = str(Path(__file__).resolve().parents[2])
+sys.path.append(project_root)
+
+try:
+    from preprocess.utils.date_parsing import parse_epoch_days, EPOCH
+    from preprocess.utils.map_to_fm import parse_date
+    from preprocess.utils.bench_data import random_dos_string
+except ImportError:
+    from date_parsing import parse_epoch_days, EPOCH
+    from map_to_fm import parse_date
+    from bench_data import random_dos_string
+
+YEARS = ['2023', '2024', '1999', '1900', '2000', '0001', '9999', '0000', '23', '68', '69', '99', '00', '1', '123']
+MONTHS = ['1', '01', '2', '02', ' 2', '12', '13', '0', '00']
+DAYS = ['1', '01', '28', '29', '30', '31', '32', '0', ' 5', '9']
+TEMPLATES = ['{y}-{m}-{d}', '{m}/{d}/{y}', '{m}/{d}/{y} - {m}/{d}/{y}', '{m}/{d}/{y}x', ' {m}/{d}/{y}',
+             '{m}/{d}/{y} ', '{y}-{m}-{d} - {y}-{m}-{d}', '{m}-{d}-{y}']
+NOISE = ['0', '1', '2', '3', '9', '12', '31', '2023', '0023', '/', '-', ' - ', ' ', 'x', '٣']
+
+
+def fuzzed_date(rng):
+    """Mostly date-shaped strings around the edges strptime cares about, plus noise."""
+    if rng.random() < 0.7:
+        template = rng.choice(TEMPLATES)
+        return template.format(y=rng.choice(YEARS), m=rng.choice(MONTHS), d=rng.choice(DAYS))
+    return ''.join(rng.choice(NOISE) for _ in range(rng.randrange(0, 7)))
+
+
+def check_equivalence(corpus):
+    series = pd.Series(corpus + [None, float('nan')], dtype=object)
+    days = parse_epoch_days(series)
+    mismatches = 0
+    for value, day in zip(series, days):
+        expected = parse_date(str(value)) if pd.notna(value) else None
+        expected = None if expected is None else (expected - EPOCH).days
+        actual = None if pd.isna(day) else int(day)
+        if expected != actual:
+            mismatches += 1
+            if mismatches <= 10:
+                print(f"  mismatch {value!r}: expected {expected}, got {actual}")
+
+    print(f"Equivalence over {len(corpus):,} fuzzed values ({int(days.notna().sum()):,} parseable): "
+          f"{'✔ identical' if not mismatches else f'❌ {mismatches} mismatches'}")
+    return mismatches == 0
+
+
+def benchmark(rows, unique_dates, rng):
+    first_day = (datetime(2018, 1, 1) - EPOCH).days
+    pool = [random_dos_string(rng, first_day, first_day + 2999) for _ in range(unique_dates)]
+    column = pd.Series([rng.choice(pool) for _ in range(rows)], dtype=object)
+
+    start = time.perf_counter()
+    column.apply(lambda x: parse_date(str(x)) if pd.notna(x) else None)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    parse_epoch_days(column)
+    vector_time = time.perf_counter() - start
+
+    print(f"\n{rows:,} rows, {unique_dates:,} distinct values")
+    print(f"Row-by-row apply:   {legacy_time:8.2f}s ({rows / legacy_time:,.0f} rows/s)")
+    print(f"parse_epoch_days:   {vector_time:8.2f}s ({rows / vector_time:,.0f} rows/s)")
+    print(f"Speedup:            {legacy_time / vector_time:8.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and benchmark vectorized DOS parsing")
+    parser.add_argument('--corpus', type=int, default=200_000, help="Fuzzed values for the equivalence check")
+    parser.add_argument('--rows', type=int, default=2_000_000, help="Rows in the throughput benchmark")
+    parser.add_argument('--unique', type=int, nargs='+', default=[3_000, 200_000],
+                        help="Distinct date strings in the benchmark column")
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    ok = check_equivalence([fuzzed_date(rng) for _ in range(args.corpus)])
+    for unique_dates in args.unique:
+        benchmark(args.rows, unique_dates, rng)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+bench_name_scoring.py
+
+Benchmarks the batched NameScorer against the original per-row fuzzywuzzy
+loop from map_to_fm on synthetic FileMaker orders (10k, 100k and 1M rows by
+default). Scores from both paths are compared before timings are reported.
+
+Usage:
+    python bench_name_scoring.py [--sizes 10000 100000 1000000] [--queries 20]
+"""
+import sys
+import time
+import random
+import argparse
+from pathlib import Path
+from fuzzywuzzy import fuzz
+
+# Add the project root to Python path
+project_root = str(Path(__file__).resolve().parents[2])
+sys.path.append(project_root)
+
+try:
+    from preprocess.utils.name_scoring import NameScorer
+    from preprocess.utils.map_to_fm import normalize_text
+    from preprocess.utils.bench_data import random_name, synthetic_orders
+except ImportError:
+    from name_scoring import NameScorer
+    from map_to_fm import normalize_text
+    from bench_data import random_name, synthetic_orders
+
+
+def legacy_scores(json_name, df_orders):
+    """Original map_to_fm loop: score every order row by row."""
+    scores = []
+    for _, row in df_orders.iterrows():
+        token_sort_score = fuzz.token_sort_ratio(json_name, row['PatientName'])
+        token_set_score = fuzz.token_set_ratio(json_name, row['PatientName'])
+        scores.append((token_sort_score, token_set_score))
+    return scores
+
+
+def run_size(size, query_count, legacy_limit, rng):
+    print(f"\n=== {size:,} orders ===")
+    df_orders, _ = synthetic_orders(size, rng)
+    queries = [normalize_text(random_name(rng)) for _ in range(query_count)]
+
+    start = time.perf_counter()
+    scorer = NameScorer(df_orders['PatientName'].tolist())
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sort_scores, set_scores = scorer.score(queries)
+    batch_time = time.perf_counter() - start
+
+    # The legacy loop gets slow fast, so only time a few queries and scale up
+    legacy_queries = queries[:max(1, min(query_count, legacy_limit))]
+    start = time.perf_counter()
+    mismatches = 0
+    for qi, query in enumerate(legacy_queries):
+        for col, (token_sort_score, token_set_score) in enumerate(legacy_scores(query, df_orders)):
+            if sort_scores[qi, col] != token_sort_score or set_scores[qi, col] != token_set_score:
+                mismatches += 1
+    legacy_time = (time.perf_counter() - start) * query_count / len(legacy_queries)
+
+    print(f"NameScorer build:      {build_time:8.2f}s")
+    print(f"NameScorer batch:      {batch_time:8.2f}s for {query_count} claims")
+    print(f"Legacy loop (est.):    {legacy_time:8.2f}s for {query_count} claims "
+          f"(measured on {len(legacy_queries)})")
+    print(f"Speedup:               {legacy_time / batch_time:8.1f}x")
+    if mismatches:
+        print(f"❌ {mismatches} score mismatches against fuzzywuzzy")
+    else:
+        print("✔ Scores identical to fuzzywuzzy")
+    return mismatches == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batched FileMaker name scoring")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--queries', type=int, default=20, help="Claim names scored per size")
+    parser.add_argument('--legacy-queries', type=int, default=2,
+                        help="Claims actually run through the legacy loop (time is extrapolated)")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    ok = all([run_size(size, args.queries, args.legacy_queries, rng) for size in args.sizes])
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+date_parsing.py
+
+Column-at-a-time date parsing for map_to_fm. VALIDATION_FORMATS is shared
+with validatejson, whose per-field parse_date stays on strptime.
+
+Dates are matched with the same regular expressions datetime.strptime uses
+for %Y/%y/%m/%d, tried format by format in order, and converted to epoch days
+with integer arithmetic. Only distinct values are parsed, so a column with
+millions of repeated DOS strings costs roughly as much as its unique dates.
+"""
+import re
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+# Formats accepted by map_to_fm.parse_date, in the order they are tried
+MAPPING_FORMATS = ("%Y-%m-%d", "%m/%d/%Y", "%m/%d/%y")
+
+# Formats accepted by validatejson.parse_date, in the order they are tried
+VALIDATION_FORMATS = ("%m/%d/%y", "%m/%d/%Y")
+
+EPOCH = datetime(1970, 1, 1)
+
+# Same patterns as the stdlib _strptime module
+_DIRECTIVES = {
+    'Y': r"(?P<Y>\d\d\d\d)",
+    'y': r"(?P<y>\d\d)",
+    'm': r"(?P<m>1[0-2]|0[1-9]|[1-9])",
+    'd': r"(?P<d>3[0-1]|[1-2]\d|0[1-9]|[1-9]| [1-9])",
+}
+
+_DAYS_IN_MONTH = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31], dtype=np.int64)
+
+
+def _format_regex(fmt):
+    """Compile a strptime format made of %Y/%y/%m/%d and literals into a full-match regex."""
+    parts = re.split(r"%(.)", fmt)
+    pattern = ''.join(_DIRECTIVES[part] if i % 2 else re.escape(part) for i, part in enumerate(parts))
+    return re.compile(r"^" + pattern + r"\Z", re.IGNORECASE)
+
+
+def _days_from_civil(year, month, day):
+    """Epoch days for proleptic Gregorian dates (vectorized)."""
+    year = year - (month <= 2)
+    era = np.floor_divide(year, 400)
+    year_of_era = year - era * 400
+    day_of_year = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def _valid_dates(year, month, day):
+    """Mask of (year, month, day) triples datetime would accept."""
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    month_length = _DAYS_IN_MONTH[np.clip(month, 1, 12) - 1] + ((month == 2) & leap)
+    return (year >= 1) & (year <= 9999) & (day >= 1) & (day <= month_length)
+
+
+def _to_int(column):
+    # int() rather than a numeric cast: \d also matches non-ASCII digits, as in strptime
+    return np.array([int(value) for value in column], dtype=np.int64)
+
+
+def _parse_unique(text, formats):
+    """Parse an array of distinct strings; returns float epoch days with NaN for failures."""
+    days = np.full(len(text), np.nan)
+    remaining = pd.Series(text, dtype=object)
+    for fmt in formats:
+        if remaining.empty:
+            break
+        fields = remaining.str.extract(_format_regex(fmt))
+        matched = fields.notna().all(axis=1).to_numpy()
+        if not matched.any():
+            continue
+        fields = fields[matched]
+        if 'Y' in fields:
+            year = _to_int(fields['Y'])
+        else:
+            year = _to_int(fields['y'])
+            year = np.where(year <= 68, year + 2000, year + 1900)
+        month = _to_int(fields['m'])
+        day = _to_int(fields['d'])
+
+        valid = _valid_dates(year, month, day)
+        index = fields.index.to_numpy()[valid]
+        days[index] = _days_from_civil(year[valid], month[valid], day[valid])
+        remaining = remaining.drop(index)
+    return days
+
+
+def parse_epoch_days(values, formats=MAPPING_FORMATS, first_of_range=True):
+    """
+    Parse a column of date strings into epoch days.
+
+    Gives the same dates as map_to_fm.parse_date(str(value)) for every
+    non-null value (with the default arguments): empty strings and unparsable
+    values become <NA>, and "A - B" ranges keep the first date. Columns that
+    are already datetime64 are floored to the day.
+
+    Args:
+        values: Series or array-like of date values
+        formats: strptime formats to try, in order
+        first_of_range: Take the first date of "A - B" ranges
+
+    Returns:
+        Int64 Series of days since 1970-01-01, aligned with values
+    """
+    series = values if isinstance(values, pd.Series) else pd.Series(values, dtype=object)
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        days = series.dt.floor('D').to_numpy(dtype='datetime64[D]').astype(np.int64)
+        return pd.Series(days, index=series.index, dtype='Int64').mask(series.isna())
+
+    codes, uniques = pd.factorize(series)
+    if not len(uniques):
+        return pd.Series(pd.NA, index=series.index, dtype='Int64')
+    text = pd.Series(np.asarray(uniques, dtype=object), dtype=object).map(str)
+    if first_of_range:
+        text = text.str.split(' - ', n=1).str[0]
+    unique_days = _parse_unique(text.to_numpy(dtype=object), formats)
+
+    days = np.where(codes >= 0, unique_days[np.maximum(codes, 0)], np.nan)
+    return pd.Series(days, index=series.index).astype('Int64')
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+fake_vision.py
+
+Offline stand-in for google.cloud.vision.ImageAnnotatorClient, used by the
+"fake" OCR engine (OCR_ENGINE=fake or OCR_FAKE_VISION=1). batch_annotate_files
+answers after a simulated network latency with the PDF's embedded text
+(PyMuPDF), in the same response shape as Vision. Images carry no text layer,
+so batch_annotate_images answers with an annotation registered for the image
+(register_image) or else a deterministic line of text derived from the
+image bytes, in pixel coordinates like Vision. Lets the OCR stage be load tested without
+Google credentials or quota; max_in_flight records the highest number of
+concurrent requests seen.
+"""
+import os
+import time
+import hashlib
+import random
+import threading
+from io import BytesIO
+from types import SimpleNamespace
+import fitz  # PyMuPDF
+from PIL import Image
+
+# Shared annotation builder - handle both package import and direct script execution
+try:
+    from preprocess.utils.ocr_layout import page_annotation
+except ImportError:
+    from ocr_layout import page_annotation
+
+FAKE_VISION_LATENCY_MS = float(os.getenv('FAKE_VISION_LATENCY_MS', '800'))
+FAKE_VISION_JITTER_MS = float(os.getenv('FAKE_VISION_JITTER_MS', '200'))
+FAKE_VISION_ERROR_RATE = float(os.getenv('FAKE_VISION_ERROR_RATE', '0'))
+
+
+class ResourceExhausted(RuntimeError):
+    """Quota error, like google.api_core.exceptions.ResourceExhausted."""
+
+    code = 429
+
+
+class FakeTextAnnotation(SimpleNamespace):
+    """Page annotation; converts to a dict like proto-plus TextAnnotation.to_dict."""
+
+    @classmethod
+    def to_dict(cls, instance):
+        return {'pages': instance.pages, 'text': instance.text}
+
+
+class FakeImageAnnotatorClient:
+    """Answers batch_annotate_files like Vision DOCUMENT_TEXT_DETECTION on PDF content."""
+
+    def __init__(self, latency_ms=FAKE_VISION_LATENCY_MS, jitter_ms=FAKE_VISION_JITTER_MS,
+                 error_rate=FAKE_VISION_ERROR_RATE):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.calls = 0
+        self.image_pages = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def register_image(self, image: bytes, annotation: dict):
+        """Answer requests for this image with the given page annotation (pixel coordinates)."""
+        self.image_pages[hashlib.sha256(image).hexdigest()] = annotation
+
+    def batch_annotate_files(self, requests):
+        return self._respond(self._annotate_file, requests)
+
+    def batch_annotate_images(self, requests):
+        return self._respond(self._annotate_image, requests)
+
+    def _respond(self, annotate, requests):
+        with self.lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            delay = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+            time.sleep(max(0.0, delay) / 1000)
+            if random.random() < self.error_rate:
+                raise ResourceExhausted("Fake Vision: quota exceeded")
+            return SimpleNamespace(responses=[annotate(request) for request in requests])
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def _annotate_file(self, request):
+        pages = []
+        with fitz.open(stream=request.input_config.content, filetype="pdf") as document:
+            for page in document:
+                annotation = FakeTextAnnotation(**page_annotation(page, confidence=0.99))
+                pages.append(SimpleNamespace(full_text_annotation=annotation, error=SimpleNamespace(message='')))
+        return SimpleNamespace(responses=pages, error=SimpleNamespace(message=''))
+
+    def _annotate_image(self, request):
+        digest = hashlib.sha256(request.image.content).hexdigest()
+        annotation = self.image_pages.get(digest)
+        if annotation is None:
+            with Image.open(BytesIO(request.image.content)) as image:
+                width, height = image.size
+            annotation = text_annotation(f"FAKE OCR {digest[:12]}", width, height)
+        return SimpleNamespace(full_text_annotation=FakeTextAnnotation(**annotation),
+                               error=SimpleNamespace(message=''))
+
+
+def text_annotation(text: str, width: int, height: int) -> dict:
+    """One line of words across the top of a width x height pixel page, as a TextAnnotation dict."""
+    words, left = [], width // 20
+    word_height, char_width = height // 100, width // 100
+    for word in text.split():
+        right = left + char_width * len(word)
+        vertices = [{'x': x, 'y': y} for x, y in ((left, word_height), (right, word_height),
+                                                   (right, 2 * word_height), (left, 2 * word_height))]
+        words.append({
+            'bounding_box': {'vertices': vertices, 'normalized_vertices': []},
+            'symbols': [{'text': char, 'confidence': 0.99} for char in word],
+            'confidence': 0.99,
+        })
+        left = right + char_width
+    page = {'width': width, 'height': height, 'blocks': [{'paragraphs': [{'words': words}]}]}
+    return {'pages': [page], 'text': f"{text}\n"}
@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+"""
+fm_index.py
+
+Lookup structures built once over the FileMaker orders snapshot so that
+map_to_fm only fuzzy-scores a small candidate set per HCFA claim instead of
+every order.
+
+Names are blocked on their character multiset. normalize_text() reduces every
+name to a single run of sorted alphanumerics, so fuzzywuzzy's token_sort_ratio
+and token_set_ratio both collapse to the plain indel ratio 2*M/T, and M can
+never exceed the number of characters the two names share. Indexing the rarest
+characters of each name (prefix filtering) therefore finds every order that
+could reach the composite threshold, and nothing that could is ever dropped.
+
+Dates of service are kept as sorted epoch-day integer arrays per order, so
+the +/- 14 day window test for a name's candidates is one binary search per
+claim day over all of them at once.
+CPT codes are grouped once per order for tie-breaking between candidates.
+
+The whole index can be saved as a set of Arrow IPC files keyed by the ETags of
+the source Parquet objects and memory-mapped back at startup, so mapping
+doesn't have to re-parse and re-group the snapshot on every run.
+"""
+import os
+import json
+import math
+import time
+import shutil
+import hashlib
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+try:
+    from preprocess.utils.name_scoring import NameScorer, process_name
+except ImportError:
+    from name_scoring import NameScorer, process_name
+
+# Lowest indel ratio that can still round up to a composite score of 90.
+# Kept slightly under 0.895 so float rounding can never cost us a match.
+MIN_NAME_RATIO = 0.89
+
+# DOS window used by the mapping step (days either side of a claim DOS)
+DOS_WINDOW_DAYS = 14
+
+EPOCH = datetime(1970, 1, 1)
+
+# DosIndex.day_keys layout: order position * DAY_KEY_SPAN + epoch day + DAY_KEY_OFFSET
+DAY_KEY_SPAN = 1 << 32
+DAY_KEY_OFFSET = 1 << 31
+
+# Bump whenever the saved index layout or build logic changes
+INDEX_VERSION = 2
+
+# Order columns carried into the index and returned by OrderIndex.order()
+ORDER_COLUMNS = ['Order_ID', 'FileMaker_Record_Number', 'Patient_Last_Name', 'Patient_First_Name', 'PatientName']
+
+
+def name_tokens(processed):
+    """Turn a processed name into (char, occurrence) tokens so set overlap equals multiset overlap."""
+    counts = {}
+    tokens = []
+    for char in processed:
+        counts[char] = counts.get(char, 0) + 1
+        tokens.append((char, counts[char]))
+    return tokens
+
+
+def min_overlap(length):
+    """Smallest number of shared characters any qualifying partner can have."""
+    return max(1, math.ceil(MIN_NAME_RATIO * length / (2 - MIN_NAME_RATIO) - 1e-9))
+
+
+def length_bounds(length):
+    """Range of partner lengths that can still reach MIN_NAME_RATIO."""
+    low = MIN_NAME_RATIO * length / (2 - MIN_NAME_RATIO)
+    high = length * (2 - MIN_NAME_RATIO) / MIN_NAME_RATIO
+    return low, high
+
+
+def epoch_day(date):
+    """Days since 1970-01-01 for a parsed date."""
+    return (date - EPOCH).days
+
+
+class BlockingIndex:
+    """
+    Candidate-blocking index over the orders.
+
+    Positions returned by candidates() are order positions in ascending
+    order, so scoring them visits orders in the same order as a full scan.
+    """
+
+    def __init__(self, lengths, unblocked, frequency, postings):
+        self.lengths = lengths
+        # Orders we can't reason about (multi-token names) are always candidates
+        self.unblocked = unblocked
+        # Global token order: rarest first keeps posting lists short
+        self.frequency = frequency
+        self.postings = postings
+
+    @classmethod
+    def from_names(cls, processed):
+        """Build the index from names already run through process_name."""
+        lengths = np.fromiter((len(p) for p in processed), dtype=np.int64, count=len(processed))
+
+        unblocked = []
+        token_lists = []
+        for pos, name in enumerate(processed):
+            if " " in name:
+                unblocked.append(pos)
+                token_lists.append([])
+            else:
+                token_lists.append(name_tokens(name))
+
+        frequency = {}
+        for tokens in token_lists:
+            for token in tokens:
+                frequency[token] = frequency.get(token, 0) + 1
+
+        index = cls(lengths, np.array(unblocked, dtype=np.int64), frequency, {})
+        postings = {}
+        for pos, tokens in enumerate(token_lists):
+            if not tokens:
+                continue
+            for token in index._prefix(tokens):
+                postings.setdefault(token, []).append(pos)
+        index.postings = {token: np.array(positions, dtype=np.int64) for token, positions in postings.items()}
+        return index
+
+    def _prefix(self, tokens):
+        """Rarest tokens of a name that must overlap with any qualifying partner."""
+        ordered = sorted(tokens, key=lambda t: (self.frequency.get(t, 0), t))
+        return ordered[:len(tokens) - min_overlap(len(tokens)) + 1]
+
+    def candidates(self, json_name):
+        """
+        Return positions of orders whose name could reach the composite threshold.
+
+        Returns None when the claim name can't be blocked and the caller
+        has to fall back to an exhaustive scan.
+        """
+        processed = process_name(json_name)
+        if not processed:
+            return np.empty(0, dtype=np.int64)
+        if " " in processed:
+            return None
+
+        tokens = name_tokens(processed)
+        low, high = length_bounds(len(tokens))
+
+        postings = [self.postings[token] for token in self._prefix(tokens) if token in self.postings]
+        positions = np.concatenate(postings + [self.unblocked])
+        lengths = self.lengths[positions]
+        keep = (lengths >= low - 1e-9) & (lengths <= high + 1e-9)
+        keep[len(positions) - len(self.unblocked):] = True
+        return _sorted_unique(positions[keep])
+
+
+class DosIndex:
+    """
+    Dates of service per order as epoch days.
+
+    order_days holds every order's days sorted ascending, with offsets giving
+    each order's slice (CSR layout). day_keys folds the order position into
+    each day (position * DAY_KEY_SPAN + day), which keeps it sorted, so the
+    window test for many orders is a single searchsorted per claim day.
+    """
+
+    def __init__(self, offsets, order_days):
+        self.offsets = offsets
+        self.order_days = order_days
+        owners = np.repeat(np.arange(len(offsets) - 1, dtype=np.int64), np.diff(offsets))
+        self.day_keys = owners * DAY_KEY_SPAN + (order_days + DAY_KEY_OFFSET)
+
+    @classmethod
+    def from_pairs(cls, positions, days, order_count):
+        """Build the index from (order position, epoch day) pairs."""
+        positions = np.asarray(positions, dtype=np.int64)
+        days = np.asarray(days, dtype=np.int64)
+
+        by_order = np.lexsort((days, positions))
+        counts = np.bincount(positions, minlength=order_count)
+        offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        return cls(offsets, days[by_order])
+
+    def days_for(self, pos):
+        """Sorted epoch days for one order."""
+        return self.order_days[self.offsets[pos]:self.offsets[pos + 1]]
+
+    def has_dos_within(self, pos, claim_days, window=DOS_WINDOW_DAYS):
+        """True if the order has a DOS within the window of any claim day."""
+        days = self.days_for(pos)
+        if not len(days):
+            return False
+        claim_days = np.asarray(claim_days, dtype=np.int64)
+        idx = np.searchsorted(days, claim_days - window, side='left')
+        found = idx < len(days)
+        return bool(np.any(days[idx[found]] <= claim_days[found] + window))
+
+    def orders_with_dos_within(self, positions, claim_days, window=DOS_WINDOW_DAYS):
+        """has_dos_within for an array of order positions, as a boolean mask over them."""
+        positions = np.asarray(positions, dtype=np.int64)
+        base = positions * DAY_KEY_SPAN + DAY_KEY_OFFSET
+        found = np.zeros(len(positions), dtype=bool)
+        for day in claim_days:
+            # First DOS of each order at or after the window start, if it's still inside the window
+            idx = np.searchsorted(self.day_keys, base + (day - window), side='left')
+            inside = idx < len(self.day_keys)
+            inside[inside] = self.day_keys[idx[inside]] <= base[inside] + (day + window)
+            found |= inside
+        return found
+
+
+class OrderIndex:
+    """
+    Everything map_to_fm needs to match claims against one FileMaker snapshot.
+
+    orders is an Arrow table with one row per order (ORDER_COLUMNS plus the
+    processed name and per-order dos_days / cpts lists). Rows are only turned
+    into Python objects when a claim actually matches them.
+    """
+
+    def __init__(self, orders, blocking, dos, name_scorer=None):
+        self.orders = orders
+        self.blocking = blocking
+        self.dos = dos
+        self.name_scorer = name_scorer or _name_scorer(orders)
+        cpts = _single_chunk(orders.column('cpts'))
+        self.cpt_offsets = cpts.offsets.to_numpy()
+        self.cpt_values = cpts.values
+
+    def __len__(self):
+        return self.orders.num_rows
+
+    @classmethod
+    def build(cls, df_orders, line_items_df):
+        """
+        Build the index from normalized orders and line items with DOS as epoch days.
+
+        Line items are joined to orders on Order_ID, so orders sharing an
+        Order_ID all get the same dates and CPT codes.
+        """
+        df_orders = df_orders.reset_index(drop=True)
+        order_positions = pd.DataFrame({'Order_ID': df_orders['Order_ID'].values,
+                                        'pos': np.arange(len(df_orders), dtype=np.int64)})
+
+        # (position, epoch day) pairs for every valid DOS
+        dated = line_items_df.loc[line_items_df['DOS'].notna(), ['Order_ID', 'DOS']]
+        dated = dated.assign(day=dated['DOS'].astype(np.int64))
+        dos_pairs = order_positions.merge(dated[['Order_ID', 'day']], on='Order_ID', how='inner')
+        dos = DosIndex.from_pairs(dos_pairs['pos'].to_numpy(), dos_pairs['day'].to_numpy(), len(df_orders))
+
+        # (position, CPT) pairs, stripped and de-duplicated
+        coded = line_items_df.loc[line_items_df['CPT'].notna(), ['Order_ID', 'CPT']]
+        coded = coded.assign(CPT=coded['CPT'].astype(str).str.strip()).drop_duplicates()
+        cpt_pairs = order_positions.merge(coded, on='Order_ID', how='inner').sort_values('pos', kind='stable')
+        cpt_counts = np.bincount(cpt_pairs['pos'].to_numpy(), minlength=len(df_orders))
+        cpt_offsets = np.concatenate(([0], np.cumsum(cpt_counts))).astype(np.int64)
+
+        processed = [process_name(name) for name in df_orders['PatientName']]
+        blocking = BlockingIndex.from_names(processed)
+
+        orders = pa.Table.from_pandas(df_orders[ORDER_COLUMNS], preserve_index=False)
+        orders = orders.append_column('processed_name', pa.array(processed, type=pa.string()))
+        orders = orders.append_column('dos_days', pa.LargeListArray.from_arrays(
+            pa.array(dos.offsets, type=pa.int64()), pa.array(dos.order_days, type=pa.int64())))
+        orders = orders.append_column('cpts', pa.LargeListArray.from_arrays(
+            pa.array(cpt_offsets, type=pa.int64()), pa.array(cpt_pairs['CPT'].tolist(), type=pa.string())))
+        return cls(orders, blocking, dos)
+
+    def order(self, pos):
+        """Order fields for one position as a plain dict."""
+        return {col: self.orders.column(col)[pos].as_py() for col in ORDER_COLUMNS}
+
+    def cpts_for(self, pos):
+        """CPT codes for one order position."""
+        return frozenset(self.cpt_values[self.cpt_offsets[pos]:self.cpt_offsets[pos + 1]].to_pylist())
+
+    def candidates(self, json_name, dos_days):
+        """Blocked candidate positions for a claim (None means scan every order)."""
+        positions = self.blocking.candidates(json_name)
+        if positions is None:
+            return None
+        return positions[self.dos.orders_with_dos_within(positions, dos_days)]
+
+    def save(self, directory):
+        """Write the index as Arrow IPC files into directory."""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        _write_table(directory / 'orders.arrow', self.orders)
+
+        tokens = sorted(self.blocking.frequency)
+        postings = [self.blocking.postings.get(token, np.empty(0, dtype=np.int64)) for token in tokens]
+        posting_offsets = np.concatenate(([0], np.cumsum([len(p) for p in postings]))).astype(np.int64)
+        posting_values = np.concatenate(postings) if postings else np.empty(0, dtype=np.int64)
+        _write_table(directory / 'tokens.arrow', pa.table({
+            'char': pa.array([t[0] for t in tokens], type=pa.string()),
+            'occurrence': pa.array([t[1] for t in tokens], type=pa.int32()),
+            'frequency': pa.array([self.blocking.frequency[t] for t in tokens], type=pa.int64()),
+            'positions': pa.LargeListArray.from_arrays(pa.array(posting_offsets, type=pa.int64()),
+                                                       pa.array(posting_values, type=pa.int64()))
+        }))
+
+    @classmethod
+    def load(cls, directory):
+        """Memory-map an index written by save()."""
+        directory = Path(directory)
+        orders = _read_table(directory / 'orders.arrow')
+        tokens = _read_table(directory / 'tokens.arrow')
+
+        dos_days = _single_chunk(orders.column('dos_days'))
+        dos = DosIndex(dos_days.offsets.to_numpy(), dos_days.values.to_numpy())
+
+        chars = tokens.column('char').to_pylist()
+        occurrences = tokens.column('occurrence').to_pylist()
+        frequencies = tokens.column('frequency').to_pylist()
+        positions = _single_chunk(tokens.column('positions'))
+        offsets = positions.offsets.to_numpy()
+        values = positions.values.to_numpy()
+        frequency = {}
+        postings = {}
+        for i, token in enumerate(zip(chars, occurrences)):
+            frequency[token] = frequencies[i]
+            if offsets[i + 1] > offsets[i]:
+                postings[token] = values[offsets[i]:offsets[i + 1]]
+
+        name_scorer = _name_scorer(orders)
+        blocking = BlockingIndex(name_scorer.lengths, np.flatnonzero(name_scorer.multi_token), frequency, postings)
+        return cls(orders, blocking, dos, name_scorer)
+
+
+def _sorted_unique(positions):
+    """Distinct positions in ascending order (sort and drop repeats; cheaper than np.unique here)."""
+    positions = np.sort(positions)
+    if len(positions):
+        positions = positions[np.concatenate(([True], positions[1:] != positions[:-1]))]
+    return positions
+
+
+def _name_scorer(orders):
+    return NameScorer(_single_chunk(orders.column('PatientName')), _single_chunk(orders.column('processed_name')))
+
+
+def _single_chunk(column):
+    """Return a ChunkedArray as one contiguous Array (zero-copy when it already is)."""
+    return column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()
+
+
+def _write_table(path, table):
+    with pa.OSFile(str(path), 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table.combine_chunks())
+
+
+def _read_table(path):
+    return pa.ipc.open_file(pa.memory_map(str(path), 'r')).read_all()
+
+
+def index_path(root, sources):
+    """Directory holding the index built from the given {key: ETag} sources."""
+    digest = hashlib.sha1(json.dumps(sources, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return Path(root) / f"v{INDEX_VERSION}-{digest}"
+
+
+def load_saved_order_index(root, sources):
+    """Load the saved index for these sources, or None if there isn't a current one."""
+    path = index_path(root, sources)
+    try:
+        with open(path / 'meta.json', 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != INDEX_VERSION or meta.get('sources') != sources:
+        return None
+    return OrderIndex.load(path)
+
+
+def save_order_index(order_index, root, sources):
+    """
+    Persist an index for these sources and remove older builds.
+
+    The index is written to a temporary directory and renamed into place,
+    with meta.json written last so a half-written build is never loaded.
+    A published index is never replaced: when another process published the
+    same build first, ours is discarded and theirs kept (the two are built from
+    the same sources). Only builds published before this one started are
+    removed, so a concurrent run's fresh build survives until the next save.
+    """
+    started = time.time()
+    path = index_path(root, sources)
+    temp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+    shutil.rmtree(temp_path, ignore_errors=True)
+    order_index.save(temp_path)
+    with open(temp_path / 'meta.json', 'w', encoding='utf-8') as f:
+        json.dump({
+            'version': INDEX_VERSION,
+            'sources': sources,
+            'orders': len(order_index),
+            'built_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }, f, indent=4)
+
+    try:
+        os.rename(temp_path, path)
+    except OSError:
+        if not (path / 'meta.json').exists():
+            raise
+        shutil.rmtree(temp_path, ignore_errors=True)
+
+    for old in Path(root).glob('v*'):
+        if old == path or not old.is_dir() or '.tmp-' in old.name:
+            continue
+        try:
+            published = (old / 'meta.json').stat().st_mtime
+        except OSError:
+            continue
+        if published < started:
+            shutil.rmtree(old, ignore_errors=True)
+    return path
@@ -7,7 +7,7 @@ Processes OCR text output through LLM to extract structured data.
 import os
 import sys
 import logging
-import tempfile
+import itertools
 import json
 from pathlib import Path
 from dotenv import load_dotenv
@@ -20,12 +20,11 @@ sys.path.append(str(PROJECT_ROOT))
 # Load environment variables from the root .env file
 load_dotenv(PROJECT_ROOT / '.env')
 
-# Import S3 helper functions - handle both direct script execution and module import
+# Import storage helpers - handle both package import and direct script execution
 try:
-    from utils.s3_utils import list_objects, download, upload, move
+    from preprocess.utils.storage import iter_objects, download_bytes, upload_bytes, move, batched_deletes
 except ImportError:
-    # If running directly from utils directory
-    from s3_utils import list_objects, download, upload, move
+    from storage import iter_objects, download_bytes, upload_bytes, move, batched_deletes
 
 # S3 prefixes (override in .env if needed)
 INPUT_PREFIX = os.getenv('LLM_INPUT_PREFIX', 'data/hcfa_txt/')
@@ -87,69 +86,78 @@ def clean_gpt_output(raw: str) -> str:
     return txt.strip()
 
 
+def load_prompt() -> str:
+    """Load the extraction prompt template."""
+    with open(PROMPT_PATH, 'r', encoding='utf-8') as pf:
+        return pf.read()
+
+
+def iter_txt_keys(limit=None):
+    """
+    Stream OCR text keys waiting for extraction, starting with the first listing
+    page. Only keys directly under INPUT_PREFIX are listed, so archived/ never is.
+    """
+    txt_keys = (k for k in iter_objects(INPUT_PREFIX, recursive=False) if k.lower().endswith('.txt'))
+    if limit:
+        txt_keys = itertools.islice(txt_keys, int(limit))
+    return txt_keys
+
+
+def extract_document(key: str, prompt: str):
+    """
+    Extract JSON from one OCR text file and archive the text.
+
+    Returns:
+        Key of the uploaded JSON, or None if extraction failed (the error is logged)
+    """
+    print(f"→ Processing s3://{S3_BUCKET}/{key}")
+    try:
+        ocr_text = download_bytes(key).decode('utf-8')
+        raw_output = extract_data_via_llm(prompt, ocr_text)
+        cleaned = clean_gpt_output(raw_output)
+
+        if not cleaned.startswith('{'):
+            raise ValueError('LLM output not JSON')
+
+        parsed = json.loads(cleaned)
+        parsed = fix_all_charges(parsed)
+
+        # Print JSON structure for debugging
+        print("\nJSON Structure:")
+        print(json.dumps(parsed, indent=2))
+        print("\nChecking required fields:")
+        print(f"patient_info.patient_name: {parsed.get('patient_info', {}).get('patient_name', 'MISSING')}")
+        service_lines = parsed.get('service_lines', [])
+        print(f"service_lines[0].date_of_service: {service_lines[0].get('date_of_service', 'MISSING') if service_lines else 'NO SERVICE LINES'}")
+
+        # Upload JSON to S3
+        base = os.path.splitext(os.path.basename(key))[0]
+        s3_json_key = f"{OUTPUT_PREFIX}{base}.json"
+        upload_bytes(json.dumps(parsed, indent=4).encode('utf-8'), s3_json_key, content_type='application/json')
+        print(f"✔ Uploaded JSON to s3://{S3_BUCKET}/{s3_json_key}")
+
+        # Archive original text
+        archived_key = key.replace(INPUT_PREFIX, ARCHIVE_PREFIX)
+        move(key, archived_key)
+        print(f"✔ Archived text to s3://{S3_BUCKET}/{archived_key}\n")
+        return s3_json_key
+
+    except Exception as e:
+        err = f"❌ Extraction error {key}: {e}"
+        print(err)
+        upload_bytes((err + '\n').encode('utf-8'), LOG_PREFIX)
+        return None
+
+
 def process_llm_s3(limit=None):
     print(f"Starting LLM extraction run against bucket: {S3_BUCKET} (prefix: {INPUT_PREFIX})")
     # Load prompt template
-    with open(PROMPT_PATH, 'r', encoding='utf-8') as pf:
-        prompt = pf.read()
+    prompt = load_prompt()
 
-    txt_keys = [k for k in list_objects(INPUT_PREFIX) if k.lower().endswith('.txt')]
-    if limit:
-        txt_keys = txt_keys[:int(limit)]
-
-    for key in txt_keys:
-        print(f"→ Processing s3://{S3_BUCKET}/{key}")
-        local_txt = download(key, os.path.join(tempfile.gettempdir(), os.path.basename(key)))
-        json_local = None
-        try:
-            ocr_text = open(local_txt, 'r', encoding='utf-8').read()
-            raw_output = extract_data_via_llm(prompt, ocr_text)
-            cleaned = clean_gpt_output(raw_output)
-
-            if not cleaned.startswith('{'):
-                raise ValueError('LLM output not JSON')
-
-            parsed = json.loads(cleaned)
-            parsed = fix_all_charges(parsed)
-
-            # Print JSON structure for debugging
-            print("\nJSON Structure:")
-            print(json.dumps(parsed, indent=2))
-            print("\nChecking required fields:")
-            print(f"patient_info.patient_name: {parsed.get('patient_info', {}).get('patient_name', 'MISSING')}")
-            service_lines = parsed.get('service_lines', [])
-            print(f"service_lines[0].date_of_service: {service_lines[0].get('date_of_service', 'MISSING') if service_lines else 'NO SERVICE LINES'}")
-
-            # Write JSON locally
-            json_local = tempfile.mktemp(suffix='.json')
-            with open(json_local, 'w', encoding='utf-8') as jf:
-                json.dump(parsed, jf, indent=4)
-
-            # Upload JSON to S3
-            base = os.path.splitext(os.path.basename(key))[0]
-            s3_json_key = f"{OUTPUT_PREFIX}{base}.json"
-            upload(json_local, s3_json_key)
-            print(f"✔ Uploaded JSON to s3://{S3_BUCKET}/{s3_json_key}")
-
-            # Archive original text
-            archived_key = key.replace(INPUT_PREFIX, ARCHIVE_PREFIX)
-            move(key, archived_key)
-            print(f"✔ Archived text to s3://{S3_BUCKET}/{archived_key}\n")
-
-        except Exception as e:
-            err = f"❌ Extraction error {key}: {e}"
-            print(err)
-            log_local = tempfile.mktemp(suffix='.log')
-            with open(log_local, 'a', encoding='utf-8') as logf:
-                logf.write(err + '\n')
-            upload(log_local, LOG_PREFIX)
-            os.remove(log_local)
-
-        finally:
-            if os.path.exists(local_txt):
-                os.remove(local_txt)
-            if json_local and os.path.exists(json_local):
-                os.remove(json_local)
+    # Archived text is removed from the input folder in batches
+    with batched_deletes():
+        for key in iter_txt_keys(limit):
+            extract_document(key, prompt)
 
     print("LLM extraction complete.")
 
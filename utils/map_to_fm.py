@@ -9,33 +9,74 @@ Uses Parquet files in S3 for matching instead of local SQLite database.
 import os
 import sys
 import json
-import tempfile
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from datetime import datetime
 from pathlib import Path
-import pandas as pd
-import pyarrow.parquet as pq
-import s3fs
-from fuzzywuzzy import fuzz
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+from pyarrow import fs as pa_fs
 from dotenv import load_dotenv
 
 # Add the project root to Python path
 project_root = str(Path(__file__).resolve().parents[2])
 sys.path.append(project_root)
 
-# Import S3 helper functions
-from utils.s3_utils import list_objects, download, upload, move
+# Import storage helpers - handle both package import and direct script execution
+try:
+    from preprocess.utils.storage import iter_objects, download_bytes, move, replace_object, batched_deletes
+except ImportError:
+    from storage import iter_objects, download_bytes, move, replace_object, batched_deletes
+
+# Import matching index - handle both package import and direct script execution
+try:
+    from preprocess.utils.fm_index import (ORDER_COLUMNS, DOS_WINDOW_DAYS, OrderIndex, epoch_day,
+                                           load_saved_order_index, save_order_index)
+    from preprocess.utils.name_scoring import NAME_THRESHOLD
+    from preprocess.utils.parquet_cache import fetch_cached, remote_etag
+    from preprocess.utils.date_parsing import parse_epoch_days
+    from preprocess.utils.mapping_report import publish_report
+except ImportError:
+    from fm_index import (ORDER_COLUMNS, DOS_WINDOW_DAYS, OrderIndex, epoch_day,
+                          load_saved_order_index, save_order_index)
+    from name_scoring import NAME_THRESHOLD
+    from parquet_cache import fetch_cached, remote_etag
+    from date_parsing import parse_epoch_days
+    from mapping_report import publish_report
 
 # Load environment variables
 load_dotenv()
 
 S3_BUCKET = os.getenv('S3_BUCKET')
 
+# Set to true to score every order instead of the blocked candidate set (auditing)
+EXHAUSTIVE_SCAN = os.getenv('MAPPING_EXHAUSTIVE_SCAN', 'false').lower() in ('1', 'true', 'yes')
+
+# Number of claims scored together in one batch
+BATCH_SIZE = int(os.getenv('MAPPING_BATCH_SIZE', '256'))
+
+# Worker processes mapping claims in parallel (1 maps in this process)
+MAPPING_WORKERS = int(os.getenv('MAPPING_WORKERS', '1'))
+
 # S3 paths
 VALID_PREFIX = 'data/hcfa_json/valid/'
 MAPPED_PREFIX = 'data/hcfa_json/valid/mapped/'
 UNMAPPED_PREFIX = 'data/hcfa_json/valid/unmapped/'
 STAGING_PREFIX = 'data/hcfa_json/valid/mapped/staging/'
 PARQUET_PREFIX = 'data/filemaker/'
+ORDERS_KEY = f"{PARQUET_PREFIX}orders.parquet"
+LINE_ITEMS_KEY = f"{PARQUET_PREFIX}line_items.parquet"
+
+# Line item columns used for matching (everything else is never read)
+LINE_ITEM_COLUMNS = ['Order_ID', 'DOS', 'CPT']
+
+# Above this many DOS windows a single min..max range is pushed down instead
+MAX_PUSHDOWN_WINDOWS = 64
+
+# Where the prebuilt matching index is kept between runs. Set to an empty
+# string to skip persistence and index only the orders near each run's claims.
+INDEX_DIR = os.getenv('FM_INDEX_DIR', str(Path(project_root) / '.cache' / 'fm_index'))
 
 def normalize_text(text):
     """
@@ -93,186 +134,422 @@ def parse_date(date_str):
             continue
     return None
 
-def date_diff_days(date1, date2):
-    """Calculate difference in days between two dates, handling None values."""
-    if date1 is None or date2 is None:
-        return float('inf')  # Return infinity if either date is None
-    return abs((date1 - date2).days)
+def dos_windows(claim_days, window=DOS_WINDOW_DAYS):
+    """Merge claim dates of service +/- window into sorted, non-overlapping (start, end) epoch-day ranges."""
+    windows = []
+    for day in sorted(set(claim_days)):
+        if windows and day - window <= windows[-1][1] + 1:
+            windows[-1] = (windows[-1][0], day + window)
+        else:
+            windows.append((day - window, day + window))
+    return windows
+
+def in_windows(days, windows):
+    """Mask of epoch days (Int64 Series, <NA> never matches) that fall inside any window."""
+    starts = np.array([start for start, _ in windows], dtype=np.int64)
+    ends = np.array([end for _, end in windows], dtype=np.int64)
+    values = days.fillna(np.iinfo(np.int64).min).to_numpy(dtype=np.int64)
+    idx = np.searchsorted(starts, values, side='right') - 1
+    return (idx >= 0) & (values <= ends[np.maximum(idx, 0)])
+
+def open_parquet_dataset(path):
+    """Open a cached Parquet file as a memory-mapped pyarrow dataset."""
+    return ds.dataset(str(path), format='parquet', filesystem=pa_fs.LocalFileSystem(use_mmap=True))
 
-def load_orders_to_dataframe():
-    """Load orders from S3 Parquet files into DataFrame."""
+def dos_filter(dataset, windows):
+    """
+    Filter expression keeping line items whose DOS falls in the windows.
+    
+    Only possible when DOS is stored as a date or naive timestamp, in which
+    case row groups are skipped using their min/max statistics. Returns None
+    for text DOS columns; those are filtered after parsing instead.
+    """
+    dos_type = dataset.schema.field('DOS').type
+    if not (pa.types.is_date(dos_type) or (pa.types.is_timestamp(dos_type) and dos_type.tz is None)):
+        return None
+    if len(windows) > MAX_PUSHDOWN_WINDOWS:
+        windows = [(windows[0][0], windows[-1][1])]
+    
+    expression = None
+    try:
+        for start, end in windows:
+            lower = pa.scalar(int(start), type=pa.date32()).cast(dos_type)
+            upper = pa.scalar(int(end) + 1, type=pa.date32()).cast(dos_type)
+            in_range = (ds.field('DOS') >= lower) & (ds.field('DOS') < upper)
+            expression = in_range if expression is None else expression | in_range
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        # Window outside the column's representable range, read everything
+        return None
+    return expression
+
+def order_id_filter(dataset, order_ids):
+    """Filter expression keeping rows whose Order_ID is in order_ids (None if the types don't line up)."""
+    values = pa.array(order_ids)
+    if isinstance(values, pa.ChunkedArray):
+        # Arrow-backed pandas columns come back chunked, isin needs a single array
+        values = values.combine_chunks()
+    try:
+        values = values.cast(dataset.schema.field('Order_ID').type)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+        return None
+    return ds.field('Order_ID').isin(values)
+
+def load_orders_to_dataframe(windows=None):
+    """
+    Load orders and line items from the S3 Parquet snapshot into DataFrames.
+    
+    Only the columns used for matching are read. When DOS windows are given
+    (see dos_windows), only orders with a line item DOS inside a window are
+    loaded, along with all of their line items; no other order can pass the
+    DOS check for those claims.
+    
+    Returns the normalized orders, the line items with DOS parsed to epoch
+    days, and the {key: ETag} of the Parquet objects they were read from.
+    """
     print("Loading data from S3 Parquet files...")
     
-    # Initialize S3 filesystem
-    s3 = s3fs.S3FileSystem()
+    # Read Parquet files through the local cache (only re-downloaded when the ETag changes)
+    orders_file = fetch_cached(ORDERS_KEY)
+    line_items_file = fetch_cached(LINE_ITEMS_KEY)
+    orders = open_parquet_dataset(orders_file.path)
+    line_items = open_parquet_dataset(line_items_file.path)
     
-    # Read orders Parquet file
-    orders_path = f"s3://{S3_BUCKET}/{PARQUET_PREFIX}orders.parquet"
-    line_items_path = f"s3://{S3_BUCKET}/{PARQUET_PREFIX}line_items.parquet"
+    orders_filter = line_items_filter = None
+    if windows is not None:
+        print(f"Finding orders with DOS in {len(windows)} claim window(s)...")
+        dated = line_items.to_table(columns=['Order_ID', 'DOS'], filter=dos_filter(line_items, windows)).to_pandas()
+        window_mask = in_windows(parse_epoch_days(dated['DOS']), windows)
+        order_ids = dated.loc[window_mask, 'Order_ID'].drop_duplicates()
+        orders_filter = order_id_filter(orders, order_ids)
+        line_items_filter = order_id_filter(line_items, order_ids)
     
     print("Loading orders...")
-    orders_df = pd.read_parquet(orders_path)
+    df = orders.to_table(columns=ORDER_COLUMNS, filter=orders_filter).to_pandas()
     print("Loading line items...")
-    line_items_df = pd.read_parquet(line_items_path)
+    line_items_df = line_items.to_table(columns=LINE_ITEM_COLUMNS, filter=line_items_filter).to_pandas()
     
-    # Clean and convert DOS dates in line items
+    # Clean and convert DOS dates in line items (same results as parse_date, as epoch days)
     print("Processing DOS dates...")
-    line_items_df['DOS'] = line_items_df['DOS'].apply(lambda x: parse_date(str(x)) if pd.notna(x) else None)
-    
-    # Group DOS by Order_ID, keeping only valid dates
-    dos_groups = (line_items_df[line_items_df['DOS'].notna()]
-                 .groupby('Order_ID')['DOS']
-                 .agg(list)
-                 .reset_index())
-    dos_groups.columns = ['Order_ID', 'DOS_List']
-    
-    # Merge orders with DOS list
-    df = pd.merge(orders_df, dos_groups, on='Order_ID', how='left')
-    
-    # Select required columns
-    df = df[['Order_ID', 'FileMaker_Record_Number', 'Patient_Last_Name', 'Patient_First_Name', 'PatientName', 'DOS_List']]
+    line_items_df['DOS'] = parse_epoch_days(line_items_df['DOS'])
     
     # Normalize name columns
     for col in ['Patient_Last_Name', 'Patient_First_Name', 'PatientName']:
         df[col] = df[col].apply(normalize_text)
     
     print(f"Loaded {len(df)} records from Parquet files")
-    return df, line_items_df
+    sources = {ORDERS_KEY: orders_file.etag, LINE_ITEMS_KEY: line_items_file.etag}
+    return df.reset_index(drop=True), line_items_df, sources
+
+def build_order_index():
+    """Build the matching index from the current FileMaker snapshot and save it to INDEX_DIR."""
+    df, line_items_df, sources = load_orders_to_dataframe()
+    
+    print("Building matching index...")
+    order_index = OrderIndex.build(df, line_items_df)
+    if not INDEX_DIR:
+        print("FM_INDEX_DIR is empty, matching index not saved")
+        return order_index
+    path = save_order_index(order_index, INDEX_DIR, sources)
+    print(f"Saved matching index for {len(order_index)} orders to {path}")
+    return order_index
+
+def load_order_index(claim_days=None):
+    """
+    Memory-map the prebuilt matching index for the current snapshot.
+    
+    Only HEAD requests are made against S3; the index is rebuilt when the
+    ETag of either source Parquet object changed.
+    
+    With persistence disabled (empty FM_INDEX_DIR) an in-memory index is
+    built instead, restricted to orders with a DOS near claim_days.
+    """
+    if not INDEX_DIR:
+        windows = dos_windows(claim_days) if claim_days is not None else None
+        df, line_items_df, _ = load_orders_to_dataframe(windows)
+        print("Building matching index...")
+        return OrderIndex.build(df, line_items_df)
+    
+    sources = {key: remote_etag(key) for key in (ORDERS_KEY, LINE_ITEMS_KEY)}
+    order_index = load_saved_order_index(INDEX_DIR, sources)
+    if order_index is not None:
+        print(f"Loaded matching index for {len(order_index)} orders")
+        return order_index
+    
+    print("Matching index missing or out of date, rebuilding...")
+    return build_order_index()
 
-def get_cpts_for_order(order_id, line_items_df):
-    """Get CPT codes for an order from line items DataFrame."""
-    cpts = line_items_df[line_items_df['Order_ID'] == order_id]['CPT'].dropna().unique()
-    return {str(cpt).strip() for cpt in cpts}
+def load_claim(key):
+    """Download a claim JSON and extract the normalized name and DOS list used for matching."""
+    filename = os.path.basename(key)
+    json_data = json.loads(download_bytes(key))
+    
+    original_name = json_data.get("patient_info", {}).get("patient_name", "")
+    
+    dos_list = []
+    for entry in json_data.get("service_lines", []):
+        dos = parse_date(entry.get("date_of_service", ""))
+        if dos:
+            dos_list.append(dos)
+    
+    return {
+        'key': key,
+        'filename': filename,
+        'json_data': json_data,
+        'original_name': original_name,
+        'json_name': normalize_text(original_name),
+        'dos_list': dos_list,
+        'dos_days': [epoch_day(dos) for dos in dos_list]
+    }
 
-def process_mapping_s3():
-    """Process JSON files and find matches in FileMaker database."""
-    df_orders, df_line_items = load_orders_to_dataframe()
+def find_candidate_matches(name_hits, dos_days, order_index):
+    """
+    Keep the name hits (composite >= 90) that have a DOS within 14 days of the claim.
+    
+    name_hits are (position, token_sort, token_set, composite) tuples from
+    NameScorer.match, already in order position order. dos_days are the
+    claim's dates of service as epoch days.
+    """
+    candidate_matches = []
+    for pos, token_sort_score, token_set_score, composite_score in name_hits:
+        if order_index.dos.has_dos_within(pos, dos_days, 14):
+            candidate_matches.append({
+                'composite_score': composite_score,
+                'token_sort_score': token_sort_score,
+                'token_set_score': token_set_score,
+                'pos': pos,
+                'row': order_index.order(pos)
+            })
+    
+    return candidate_matches
+
+def best_candidate(candidate_matches, json_data, order_index):
+    """The candidate with the most CPT codes in common with the claim, then the best name score (None if none)."""
+    if len(candidate_matches) == 1:
+        return candidate_matches[0]
+    if not candidate_matches:
+        return None
+    
+    # Enhanced logic: sort candidates by CPT match score, then name score
+    json_cpts = {line.get("cpt_code", "").strip() 
+               for line in json_data.get("service_lines", []) 
+               if line.get("cpt_code")}
+    
+    enriched_matches = []
+    for match in candidate_matches:
+        db_cpts = order_index.cpts_for(match['pos'])
+        cpt_score = len(json_cpts & db_cpts)
+        enriched_matches.append((cpt_score, match['composite_score'], match))
+    
+    enriched_matches.sort(reverse=True, key=lambda x: (x[0], x[1]))
+    return enriched_matches[0][2]
+
+def map_claim(claim, candidate_matches, order_index):
+    """Pick the best candidate for a claim and move it to mapped or unmapped. Returns the match details."""
+    filename = claim['filename']
+    json_data = claim['json_data']
+    
+    best_match = best_candidate(candidate_matches, json_data, order_index)
+    
+    result = None
+    if best_match:
+        # Add FileMaker info to JSON in a new mapping_info section
+        json_data["mapping_info"] = {
+            "order_id": str(best_match['row']['Order_ID']),
+            "filemaker_number": str(best_match['row']['FileMaker_Record_Number']),
+            "mapping_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+        
+        # Write updated JSON to mapped folder and remove the original
+        new_key = f"{MAPPED_PREFIX}{filename}"
+        replace_object(claim['key'], new_key, json.dumps(json_data, indent=4).encode('utf-8'),
+                       content_type='application/json')
+        print(f"✔ Mapped: {filename} -> Order {best_match['row']['Order_ID']}")
+        
+        result = {
+            'json_filename': filename,
+            'json_name_original': claim['original_name'],
+            'json_name_normalized': claim['json_name'],
+            'db_name_original': best_match['row']['PatientName'],
+            'db_order_id': best_match['row']['Order_ID'],
+            'db_filemaker_number': best_match['row']['FileMaker_Record_Number'],
+            'token_sort_score': best_match['token_sort_score'],
+            'token_set_score': best_match['token_set_score'],
+            'composite_score': best_match['composite_score']
+        }
+    else:
+        print(f"❌ No match found: {filename}")
+        new_key = f"{UNMAPPED_PREFIX}{filename}"
+        move(claim['key'], new_key)
+    
+    return result
+
+def map_batch(batch, order_index, exhaustive=False):
+    """
+    Score a batch of claims in one NameScorer call and map each claim.
+    Originals are deleted together once the batch is mapped.
+    
+    Returns (results, processed_count) with results in batch order.
+    """
+    results = []
+    processed_files = 0
+    
+    # Score every name in the batch in one call
+    try:
+        candidates = None
+        if not exhaustive:
+            candidates = [order_index.candidates(c['json_name'], c['dos_days']) for c in batch]
+        name_hits = order_index.name_scorer.match([c['json_name'] for c in batch], NAME_THRESHOLD, candidates)
+    except Exception as e:
+        print(f"Error scoring batch of {len(batch)} files: {str(e)}")
+        return results, processed_files
+    
+    with batched_deletes():
+        for claim, hits in zip(batch, name_hits):
+            try:
+                candidate_matches = find_candidate_matches(hits, claim['dos_days'], order_index)
+                result = map_claim(claim, candidate_matches, order_index)
+                if result:
+                    results.append(result)
+                processed_files += 1
+            except Exception as e:
+                print(f"Error processing {claim['filename']}: {str(e)}")
+                continue
+    
+    return results, processed_files
+
+# Matching index and scan mode for pool workers, inherited from the parent on fork
+_worker_index = None
+_worker_exhaustive = False
+
+def _init_worker(order_index, exhaustive):
+    global _worker_index, _worker_exhaustive
+    _worker_index = order_index
+    _worker_exhaustive = exhaustive
+    # The pool already uses every core, keep cdist single-threaded per worker
+    _worker_index.name_scorer.workers = 1
+
+def _map_batch_worker(batch):
+    return map_batch(batch, _worker_index, _worker_exhaustive)
+
+def _load_claim_or_skip(key):
+    """Download a claim; claims without a name or DOS are moved to unmapped and None is returned."""
+    filename = os.path.basename(key)
+    print(f"\nProcessing: {filename}")
+    
+    try:
+        claim = load_claim(key)
+        if not claim['json_name'] or not claim['dos_list']:
+            print(f"❌ Missing name or DOS: {filename}")
+            new_key = f"{UNMAPPED_PREFIX}{filename}"
+            move(key, new_key)
+            return None
+        return claim
+    except Exception as e:
+        print(f"Error processing {filename}: {str(e)}")
+        return None
+
+def map_document(key, order_index, exhaustive=None):
+    """
+    Map a single claim as soon as it is validated (streaming pipeline).
+    
+    Returns:
+        The match details, or None if the claim was not mapped
+    """
+    if exhaustive is None:
+        exhaustive = EXHAUSTIVE_SCAN
+    claim = _load_claim_or_skip(key)
+    if claim is None:
+        return None
+    results, _ = map_batch([claim], order_index, exhaustive)
+    return results[0] if results else None
+
+def iter_claim_keys():
+    """Stream JSON files from valid prefix (mapped/unmapped sub-folders are never listed)."""
+    all_keys = iter_objects(VALID_PREFIX, recursive=False)
+    return (k for k in all_keys if k.lower().endswith('.json') 
+            and k.count('/') == 3  # Only process files directly in valid/
+            and not any(x in k for x in ['mapped', 'unmapped', 'staging']))
+
+def process_mapping_s3(exhaustive=None, workers=None):
+    """
+    Process JSON files and find matches in FileMaker database.
+    
+    All claims are downloaded first, then scored in batches of BATCH_SIZE
+    with one NameScorer call per batch. With more than one worker, batches
+    are mapped by a process pool that shares the loaded matching index
+    (inherited on fork, memory-mapped pages stay shared); results are
+    collected in listing order regardless of which worker finishes first.
+    The match details are published as a Parquet report (see mapping_report).
+    
+    Args:
+        exhaustive: Score every order instead of the blocked candidate set.
+                    Defaults to the MAPPING_EXHAUSTIVE_SCAN setting.
+        workers: Number of worker processes. Defaults to MAPPING_WORKERS.
+    
+    Returns:
+        List of match details for every mapped claim.
+    """
+    run_started_at = datetime.now()
+    if exhaustive is None:
+        exhaustive = EXHAUSTIVE_SCAN
+    if workers is None:
+        workers = MAPPING_WORKERS
+    workers = max(1, workers)
     
-    # Get list of JSON files from valid prefix
     print("Listing files in S3...")
-    all_keys = list_objects(VALID_PREFIX)
-    json_keys = [k for k in all_keys if k.lower().endswith('.json') 
-                and k.count('/') == 3  # Only process files directly in valid/
-                and not any(x in k for x in ['mapped', 'unmapped', 'staging'])]
+    json_keys = iter_claim_keys()
     
-    print(f"Found {len(json_keys)} files to process")
     processed_files = 0
     results = []
     
-    for key in json_keys:
-        filename = os.path.basename(key)
-        print(f"\nProcessing: {filename}")
+    # Claims are read first so their DOS can bound what is read from FileMaker;
+    # downloads start while the listing is still paging
+    with batched_deletes():
+        if workers > 1:
+            with ThreadPool(workers) as pool:
+                loaded = list(pool.imap(_load_claim_or_skip, json_keys))
+        else:
+            loaded = [_load_claim_or_skip(key) for key in json_keys]
+    claims = [claim for claim in loaded if claim is not None]
+    print(f"Found {len(loaded)} files to process")
+    
+    if not claims:
+        print(f"\nProcessed {processed_files} files")
+        return results
+    
+    order_index = load_order_index([day for claim in claims for day in claim['dos_days']])
+    if exhaustive:
+        print("Exhaustive scan enabled, blocking index will not be used")
+    
+    if workers == 1:
+        batches = (claims[start:start + BATCH_SIZE] for start in range(0, len(claims), BATCH_SIZE))
+        for batch in batches:
+            batch_results, batch_processed = map_batch(batch, order_index, exhaustive)
+            results.extend(batch_results)
+            processed_files += batch_processed
+    else:
+        # Smaller batches when there are few claims so every worker gets some
+        batch_size = max(1, min(BATCH_SIZE, -(-len(claims) // (workers * 4))))
+        batches = [claims[start:start + batch_size] for start in range(0, len(claims), batch_size)]
+        print(f"Mapping {len(claims)} claims in {len(batches)} batches with {workers} workers")
         
-        try:
-            # Download JSON file
-            local_json = os.path.join(tempfile.gettempdir(), filename)
-            download(key, local_json)
-            
-            with open(local_json, 'r') as f:
-                json_data = json.load(f)
-            
-            original_name = json_data.get("patient_info", {}).get("patient_name", "")
-            json_name = normalize_text(original_name)
-            
-            dos_list = []
-            for entry in json_data.get("service_lines", []):
-                dos = parse_date(entry.get("date_of_service", ""))
-                if dos:
-                    dos_list.append(dos)
-            
-            if not json_name or not dos_list:
-                print(f"❌ Missing name or DOS: {filename}")
-                new_key = f"{UNMAPPED_PREFIX}{filename}"
-                move(key, new_key)
-                continue
-            
-            candidate_matches = []
-            for _, row in df_orders.iterrows():
-                token_sort_score = fuzz.token_sort_ratio(json_name, row['PatientName'])
-                token_set_score = fuzz.token_set_ratio(json_name, row['PatientName'])
-                composite_score = (token_sort_score + token_set_score) / 2
-                
-                if composite_score >= 90:
-                    db_dos_list = row.get('DOS_List', [])
-                    if not db_dos_list:
-                        continue
-                    
-                    for json_dos in dos_list:
-                        for db_dos in db_dos_list:
-                            if date_diff_days(json_dos, db_dos) <= 14:
-                                candidate_matches.append({
-                                    'composite_score': composite_score,
-                                    'token_sort_score': token_sort_score,
-                                    'token_set_score': token_set_score,
-                                    'row': row
-                                })
-                                break
-                        else:
-                            continue
-                        break
-            
-            best_match = None
-            if len(candidate_matches) == 1:
-                best_match = candidate_matches[0]
-            elif len(candidate_matches) > 1:
-                # Enhanced logic: sort candidates by CPT match score, then name score
-                json_cpts = {line.get("cpt_code", "").strip() 
-                           for line in json_data.get("service_lines", []) 
-                           if line.get("cpt_code")}
-                
-                enriched_matches = []
-                for match in candidate_matches:
-                    order_id = match['row']['Order_ID']
-                    db_cpts = get_cpts_for_order(order_id, df_line_items)
-                    cpt_score = len(json_cpts & db_cpts)
-                    enriched_matches.append((cpt_score, match['composite_score'], match))
-                
-                enriched_matches.sort(reverse=True, key=lambda x: (x[0], x[1]))
-                best_match = enriched_matches[0][2]
-            
-            if best_match:
-                # Add FileMaker info to JSON in a new mapping_info section
-                json_data["mapping_info"] = {
-                    "order_id": str(best_match['row']['Order_ID']),
-                    "filemaker_number": str(best_match['row']['FileMaker_Record_Number']),
-                    "mapping_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                }
-                
-                # Write updated JSON back to file
-                with open(local_json, 'w') as f:
-                    json.dump(json_data, f, indent=4)
-                
-                # Upload to mapped folder
-                new_key = f"{MAPPED_PREFIX}{filename}"
-                upload(local_json, new_key)
-                move(key, new_key)
-                print(f"✔ Mapped: {filename} -> Order {best_match['row']['Order_ID']}")
-                
-                results.append({
-                    'json_filename': filename,
-                    'json_name_original': original_name,
-                    'json_name_normalized': json_name,
-                    'db_name_original': best_match['row']['PatientName'],
-                    'db_order_id': best_match['row']['Order_ID'],
-                    'db_filemaker_number': best_match['row']['FileMaker_Record_Number'],
-                    'token_sort_score': best_match['token_sort_score'],
-                    'token_set_score': best_match['token_set_score'],
-                    'composite_score': best_match['composite_score']
-                })
-            else:
-                print(f"❌ No match found: {filename}")
-                new_key = f"{UNMAPPED_PREFIX}{filename}"
-                move(key, new_key)
-            
-            # Clean up
-            os.remove(local_json)
-            processed_files += 1
-            
-        except Exception as e:
-            print(f"Error processing {filename}: {str(e)}")
-            continue
+        # Fork so workers inherit the index instead of unpickling a copy each
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+        with context.Pool(workers, initializer=_init_worker, initargs=(order_index, exhaustive)) as pool:
+            for batch_results, batch_processed in pool.imap(_map_batch_worker, batches):
+                results.extend(batch_results)
+                processed_files += batch_processed
     
     print(f"\nProcessed {processed_files} files")
+    try:
+        publish_report(results, run_started_at)
+    except Exception as e:
+        print(f"Error publishing mapping report: {str(e)}")
+    return results
 
 if __name__ == "__main__":
-    process_mapping_s3()
+    if '--build-index' in sys.argv:
+        build_order_index()
+    else:
+        process_mapping_s3()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+mapping_report.py
+
+Publishes the match details collected by map_to_fm as a columnar Parquet
+report. Every run writes one file to a per-run prefix and the same file into
+an append-only dataset partitioned by run date (Hive style, run_date=YYYY-MM-DD),
+so match quality can be queried across months of runs without re-running
+fuzzy matching.
+"""
+import os
+import sys
+from io import BytesIO
+from datetime import datetime
+from pathlib import Path
+import pyarrow as pa
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+
+# Add the project root to Python path
+project_root = str(Path(__file__).resolve().parents[2])
+sys.path.append(project_root)
+
+# Import storage helpers - handle both package import and direct script execution
+try:
+    from preprocess.utils.storage import upload_bytes
+except ImportError:
+    from storage import upload_bytes
+
+# Load environment variables
+load_dotenv()
+
+REPORT_PREFIX = os.getenv('MAPPING_REPORT_PREFIX', 'data/reports/mapping/')
+RUNS_PREFIX = f"{REPORT_PREFIX}runs/"
+DATASET_PREFIX = f"{REPORT_PREFIX}dataset/"
+
+# run_date is not stored in the files, it comes from the dataset partition path
+REPORT_SCHEMA = pa.schema([
+    ('run_id', pa.string()),
+    ('run_started_at', pa.timestamp('us')),
+    ('json_filename', pa.string()),
+    ('json_name_original', pa.string()),
+    ('json_name_normalized', pa.string()),
+    ('db_name_original', pa.string()),
+    ('db_order_id', pa.string()),
+    ('db_filemaker_number', pa.string()),
+    ('token_sort_score', pa.int16()),
+    ('token_set_score', pa.int16()),
+    ('composite_score', pa.float64()),
+])
+
+
+def _as_string(value):
+    return None if value is None else str(value)
+
+
+def results_to_table(results, run_id, run_started_at):
+    """Convert map_to_fm result dicts into a table with REPORT_SCHEMA."""
+    columns = {
+        'run_id': [run_id] * len(results),
+        'run_started_at': [run_started_at] * len(results),
+    }
+    for field in REPORT_SCHEMA:
+        if field.name in columns:
+            continue
+        values = [result.get(field.name) for result in results]
+        if pa.types.is_string(field.type):
+            values = [_as_string(value) for value in values]
+        columns[field.name] = values
+    return pa.table(columns, schema=REPORT_SCHEMA)
+
+
+def publish_report(results, run_started_at=None):
+    """
+    Write the results of one mapping run as Parquet and upload it to S3.
+
+    Args:
+        results: Match detail dicts returned by process_mapping_s3
+        run_started_at: Start time of the run (defaults to now)
+
+    Returns:
+        (run report key, dataset partition key)
+    """
+    run_started_at = run_started_at or datetime.now()
+    run_id = run_started_at.strftime("mapping_%Y%m%d_%H%M%S")
+    table = results_to_table(results, run_id, run_started_at)
+
+    run_key = f"{RUNS_PREFIX}{run_id}.parquet"
+    dataset_key = f"{DATASET_PREFIX}run_date={run_started_at:%Y-%m-%d}/{run_id}.parquet"
+
+    buffer = BytesIO()
+    pq.write_table(table, buffer, compression='zstd')
+    upload_bytes(buffer.getvalue(), run_key)
+    upload_bytes(buffer.getvalue(), dataset_key)
+
+    print(f"Published mapping report with {table.num_rows} matches to {run_key}")
+    return run_key, dataset_key
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+name_scoring.py
+
+Batched fuzzy name scoring for map_to_fm. Scores a batch of claim names
+against the FileMaker PatientName column with rapidfuzz's cdist (NumPy-backed,
+multi-core) and reproduces the integer token_sort_ratio / token_set_ratio
+values fuzzywuzzy returns for the same pair.
+
+Requires python-Levenshtein (the Levenshtein module) next to fuzzywuzzy.
+Without it fuzzywuzzy silently falls back to difflib, whose ratios are not
+the indel ratio computed here, so the import below fails fast instead.
+"""
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import Levenshtein  # noqa: F401 - fuzzywuzzy must score with it, see above
+from fuzzywuzzy import fuzz
+from fuzzywuzzy import utils as fuzz_utils
+from rapidfuzz.distance import Indel
+from rapidfuzz.process import cdist
+
+# Composite score an order needs to count as a name match
+NAME_THRESHOLD = 90
+
+# Orders scored per cdist call, bounds the size of the distance matrix
+CHUNK_SIZE = 100_000
+
+
+def process_name(name):
+    """Apply the same preprocessing fuzzywuzzy uses before scoring."""
+    if not name:
+        return ""
+    return fuzz_utils.full_process(name, force_ascii=True)
+
+
+class NameScorer:
+    """
+    Scores claim names against a fixed list of FileMaker names.
+
+    Names are preprocessed once with fuzzywuzzy's own full_process. For
+    single-token names (everything normalize_text produces) token_sort_ratio
+    and token_set_ratio both reduce to round(100 * indel ratio), which is
+    computed here for the whole batch at once. Pairs involving multi-token
+    names fall back to fuzzywuzzy itself so the scores always agree.
+
+    Names are held as Arrow string arrays so a scorer over a memory-mapped
+    index never has to turn every name into a Python object.
+    """
+
+    def __init__(self, names, processed=None, workers=-1):
+        self.names = names if isinstance(names, pa.Array) else pa.array(list(names), type=pa.string())
+        if processed is None:
+            processed = [process_name(name) for name in self.names.to_pylist()]
+        self.processed = processed if isinstance(processed, pa.Array) else pa.array(processed, type=pa.string())
+        self.lengths = pc.utf8_length(self.processed).to_numpy(zero_copy_only=False).astype(np.int64)
+        self.multi_token = pc.match_substring(self.processed, " ").to_numpy(zero_copy_only=False)
+        self.workers = workers
+
+    def __len__(self):
+        return len(self.names)
+
+    def _score_block(self, queries, positions):
+        """Return (token_sort, token_set) int16 matrices for queries x positions."""
+        processed = [process_name(q) for q in queries]
+        q_lengths = np.array([len(p) for p in processed], dtype=np.int64)
+        choices = self.processed.take(pa.array(positions, type=pa.int64())).to_pylist()
+        c_lengths = self.lengths[positions]
+
+        dist = cdist(processed, choices, scorer=Indel.distance, dtype=np.int32, workers=self.workers)
+        lensum = q_lengths[:, None] + c_lengths[None, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = 1.0 - dist / lensum
+        sort_scores = np.rint(100 * ratio)
+
+        # fuzzywuzzy: empty vs empty is 100 for token_sort and 0 for token_set,
+        # a single empty side is 0 for both
+        q_empty = (q_lengths == 0)[:, None]
+        c_empty = (c_lengths == 0)[None, :]
+        sort_scores = np.where(q_empty | c_empty, np.where(q_empty & c_empty, 100, 0), sort_scores)
+        set_scores = np.where(q_empty | c_empty, 0, sort_scores)
+        sort_scores = sort_scores.astype(np.int16)
+        set_scores = set_scores.astype(np.int16)
+
+        # Exact fuzzywuzzy fallback wherever token handling matters
+        multi_cols = np.flatnonzero(self.multi_token[positions])
+        for qi, query in enumerate(queries):
+            cols = range(len(choices)) if " " in processed[qi] else multi_cols
+            for ci in cols:
+                name = self.names[int(positions[ci])].as_py()
+                sort_scores[qi, ci] = fuzz.token_sort_ratio(query, name)
+                set_scores[qi, ci] = fuzz.token_set_ratio(query, name)
+
+        return sort_scores, set_scores
+
+    def score(self, queries):
+        """Return full (token_sort, token_set) matrices of shape (len(queries), len(self))."""
+        sort_scores = np.zeros((len(queries), len(self)), dtype=np.int16)
+        set_scores = np.zeros((len(queries), len(self)), dtype=np.int16)
+        for start in range(0, len(self), CHUNK_SIZE):
+            positions = np.arange(start, min(start + CHUNK_SIZE, len(self)))
+            sort_block, set_block = self._score_block(queries, positions)
+            sort_scores[:, positions] = sort_block
+            set_scores[:, positions] = set_block
+        return sort_scores, set_scores
+
+    def match(self, queries, threshold=NAME_THRESHOLD, candidates=None):
+        """
+        Find names whose composite score reaches the threshold.
+
+        Args:
+            queries: Claim names (as returned by normalize_text)
+            threshold: Minimum composite score
+            candidates: Optional list with one array of positions per query
+                        (None entries mean score every name for that query)
+
+        Returns:
+            One list per query of (position, token_sort, token_set, composite)
+            tuples in ascending position order.
+        """
+        if candidates is None:
+            candidates = [None] * len(queries)
+        results = [[] for _ in queries]
+
+        # Queries without a candidate list are scored together against every name
+        full_scan = [i for i, c in enumerate(candidates) if c is None]
+        if full_scan and len(self):
+            batch = [queries[i] for i in full_scan]
+            for start in range(0, len(self), CHUNK_SIZE):
+                positions = np.arange(start, min(start + CHUNK_SIZE, len(self)))
+                sort_block, set_block = self._score_block(batch, positions)
+                self._collect(full_scan, positions, sort_block, set_block, threshold, results)
+
+        for i, positions in enumerate(candidates):
+            if positions is None or not len(positions):
+                continue
+            positions = np.asarray(positions, dtype=np.int64)
+            sort_block, set_block = self._score_block([queries[i]], positions)
+            self._collect([i], positions, sort_block, set_block, threshold, results)
+
+        return results
+
+    @staticmethod
+    def _collect(query_ids, positions, sort_block, set_block, threshold, results):
+        composite = (sort_block.astype(np.float64) + set_block) / 2
+        for row, qi in enumerate(query_ids):
+            for col in np.flatnonzero(composite[row] >= threshold):
+                results[qi].append((
+                    int(positions[col]),
+                    int(sort_block[row, col]),
+                    int(set_block[row, col]),
+                    float(composite[row, col])
+                ))
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+ocr_cache.py
+
+Content-addressed cache of OCR results. Entries are keyed by the SHA-256 of
+the page PDF bytes and hold the OCR text and the full page annotations, as
+gzipped JSON. They are kept in a local directory (OCR_CACHE_DIR) and under a
+storage prefix (OCR_CACHE_PREFIX) shared by every machine; either can be
+disabled by setting it empty. Re-uploaded batches and re-queued pages are
+then answered without another Vision request.
+"""
+import os
+import sys
+import gzip
+import json
+import hashlib
+import logging
+import tempfile
+from pathlib import Path
+from dotenv import load_dotenv
+
+# Get the project root directory
+project_root = Path(__file__).resolve().parents[2]
+sys.path.append(str(project_root))
+
+# Load environment variables from .env
+load_dotenv(project_root / '.env')
+
+# Import storage helpers - handle both package import and direct script execution
+try:
+    from preprocess.utils.storage import STORAGE_ERRORS, download_bytes, upload_bytes
+except ImportError:
+    from storage import STORAGE_ERRORS, download_bytes, upload_bytes
+
+OCR_CACHE_DIR = os.getenv('OCR_CACHE_DIR', str(project_root / '.cache' / 'ocr'))
+OCR_CACHE_PREFIX = os.getenv('OCR_CACHE_PREFIX', 'data/ocr_cache/')
+
+
+def content_hash(content: bytes) -> str:
+    """Cache key for a PDF: hex SHA-256 of its bytes."""
+    return hashlib.sha256(content).hexdigest()
+
+
+def _relative_path(digest: str) -> str:
+    # Two-character fan-out keeps directories and listing pages small
+    return f"{digest[:2]}/{digest}.json.gz"
+
+
+def _decode(data: bytes) -> dict:
+    return json.loads(gzip.decompress(data).decode('utf-8'))
+
+
+def _write_local(path: Path, data: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_name = tempfile.mkstemp(dir=path.parent, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_name, path)
+    finally:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+
+
+def get(digest: str):
+    """
+    Cached OCR result for a content hash, or None.
+
+    The local directory is checked first; entries found under the storage
+    prefix are copied to it for the next lookup.
+    """
+    logger = logging.getLogger("OCR Cache")
+    local_path = Path(OCR_CACHE_DIR) / _relative_path(digest) if OCR_CACHE_DIR else None
+    if local_path is not None:
+        try:
+            return _decode(local_path.read_bytes())
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable cache entry {local_path}: {str(e)}")
+
+    if not OCR_CACHE_PREFIX:
+        return None
+    try:
+        data = download_bytes(f"{OCR_CACHE_PREFIX}{_relative_path(digest)}")
+        entry = _decode(data)
+    except FileNotFoundError:
+        return None
+    except (*STORAGE_ERRORS, ValueError) as e:
+        logger.warning(f"Could not read OCR cache entry {digest}: {str(e)}")
+        return None
+
+    if local_path is not None:
+        try:
+            _write_local(local_path, data)
+        except OSError as e:
+            logger.warning(f"Could not write {local_path}: {str(e)}")
+    return entry
+
+
+def put(digest: str, entry: dict):
+    """Store an OCR result; failures are logged, never raised."""
+    logger = logging.getLogger("OCR Cache")
+    data = gzip.compress(json.dumps(entry, separators=(',', ':')).encode('utf-8'))
+    if OCR_CACHE_DIR:
+        local_path = Path(OCR_CACHE_DIR) / _relative_path(digest)
+        try:
+            _write_local(local_path, data)
+        except OSError as e:
+            logger.warning(f"Could not write {local_path}: {str(e)}")
+    if OCR_CACHE_PREFIX:
+        try:
+            upload_bytes(data, f"{OCR_CACHE_PREFIX}{_relative_path(digest)}", content_type='application/gzip')
+        except STORAGE_ERRORS as e:
+            logger.warning(f"Could not upload OCR cache entry {digest}: {str(e)}")
@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+"""
+ocr_engines.py
+
+OCR engines used by ocr_hcfa. Every engine turns PDF bytes into results of
+the form {'text', 'pages', 'engine'}, where pages holds one Vision-style
+TextAnnotation dict per PDF page (see ocr_layout).
+
+- vision: Google Vision Document Text Detection. Several single-page PDFs
+  are merged into each request and calls are paced by a token bucket. The
+  client is created on first use, so importing needs no credentials.
+- fake:   Vision code path against the offline client in fake_vision.
+- local:  PyMuPDF text layer and Tesseract (through PyMuPDF), run in a
+  process pool across all cores. Needs no network or Google credentials.
+
+Engines also take rendered page images (annotate_images / ocr_images), so a
+stage that already rasterized a PDF does not have it rendered a second time
+(see preview_ocr).
+
+OCR_ENGINE selects the engine for a run. With OCR_FALLBACK_ENGINE set,
+documents go to the fallback engine while the primary reports exhausted
+quota (HTTP 429 / RESOURCE_EXHAUSTED).
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import multiprocessing
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+import fitz  # PyMuPDF
+from PyPDF2 import PdfReader, PdfWriter
+from dotenv import load_dotenv
+
+# Get the project root directory (2 levels up from this file)
+PROJECT_ROOT = Path(__file__).resolve().parent.parent.parent
+sys.path.append(str(PROJECT_ROOT))
+
+# Load environment variables from the root .env file
+load_dotenv(PROJECT_ROOT / '.env')
+
+# Rate limiting and annotation helpers - handle both package import and direct script execution
+try:
+    from preprocess.utils.rate_limit import TokenBucket
+    from preprocess.utils.ocr_layout import page_annotation
+    from preprocess.utils.text_layer import is_usable_page
+except ImportError:
+    from rate_limit import TokenBucket
+    from ocr_layout import page_annotation
+    from text_layer import is_usable_page
+
+OCR_FAKE_VISION = os.getenv('OCR_FAKE_VISION', '').lower() in ('1', 'true', 'yes')
+OCR_ENGINE = os.getenv('OCR_ENGINE', 'fake' if OCR_FAKE_VISION else 'vision').lower()
+OCR_FALLBACK_ENGINE = os.getenv('OCR_FALLBACK_ENGINE', '').lower()
+# Seconds the fallback engine is used after the primary ran out of quota
+OCR_FALLBACK_COOLDOWN = float(os.getenv('OCR_FALLBACK_COOLDOWN', '300'))
+
+# Vision requests in flight at once, and the project quota they are paced to
+VISION_MAX_IN_FLIGHT = int(os.getenv('VISION_MAX_IN_FLIGHT', '8'))
+VISION_REQUESTS_PER_MINUTE = float(os.getenv('VISION_REQUESTS_PER_MINUTE', '1800'))
+VISION_BURST = int(os.getenv('VISION_BURST', str(VISION_MAX_IN_FLIGHT)))
+
+# Pages per synchronous file request; Vision annotates at most 5 and takes one file per call
+VISION_PAGES_PER_REQUEST = min(5, max(1, int(os.getenv('VISION_PAGES_PER_REQUEST', '5'))))
+# Page images per synchronous image request (Vision takes at most 16)
+VISION_IMAGES_PER_REQUEST = min(16, max(1, int(os.getenv('VISION_IMAGES_PER_REQUEST', '16'))))
+
+# Local engine: worker processes, and how pages are read
+# (auto: text layer when it is usable, otherwise Tesseract; tesseract: always OCR; text: text layer only)
+LOCAL_OCR_WORKERS = int(os.getenv('LOCAL_OCR_WORKERS', str(os.cpu_count() or 1)))
+LOCAL_OCR_MODE = os.getenv('LOCAL_OCR_MODE', 'auto').lower()
+LOCAL_OCR_LANGUAGE = os.getenv('LOCAL_OCR_LANGUAGE', 'eng')
+LOCAL_OCR_DPI = int(os.getenv('LOCAL_OCR_DPI', '300'))
+
+# Results from these engines are stored in the OCR cache
+CACHED_ENGINES = ('vision',)
+
+
+def is_quota_error(error: Exception) -> bool:
+    """True for Vision quota/rate errors (google.api_core ResourceExhausted / TooManyRequests)."""
+    if type(error).__name__ in ('ResourceExhausted', 'TooManyRequests'):
+        return True
+    # HTTPStatus.TOO_MANY_REQUESTS on google.api_core errors; never matched on the message,
+    # which can hold unrelated numbers such as timestamped keys
+    return getattr(error, 'code', None) == 429
+
+
+def page_text(pages) -> str:
+    """Document text from its page annotations."""
+    return "\n".join(page['text'] for page in pages if page is not None)
+
+
+class OCREngine:
+    """
+    Base class: subclasses implement annotate(contents) -> page annotations
+    per PDF, and annotate_images(images) -> one page annotation per image.
+    """
+
+    name = None
+    # Documents worth keeping in flight, and per unit of work
+    max_in_flight = 1
+    batch_size = 1
+
+    def annotate(self, contents) -> list:
+        raise NotImplementedError
+
+    async def annotate_async(self, contents, executor=None) -> list:
+        return await asyncio.get_running_loop().run_in_executor(executor, self.annotate, contents)
+
+    def ocr(self, contents) -> list:
+        """OCR results for each PDF, in the order given."""
+        return [self._result(pages) for pages in self.annotate(contents)]
+
+    async def ocr_async(self, contents, executor=None) -> list:
+        return [self._result(pages) for pages in await self.annotate_async(contents, executor)]
+
+    def annotate_images(self, images) -> list:
+        raise NotImplementedError
+
+    def ocr_images(self, images) -> dict:
+        """OCR result for one document from its encoded page images (PNG/JPEG bytes), in page order."""
+        return self._result(self.annotate_images(images))
+
+    def _result(self, pages) -> dict:
+        return {'text': page_text(pages), 'pages': pages, 'engine': self.name}
+
+
+class VisionEngine(OCREngine):
+    """
+    Google Vision Document Text Detection.
+
+    batch_annotate_files takes a single file per request and annotates up to
+    VISION_PAGES_PER_REQUEST pages of it, so documents are merged into one PDF
+    per request and the page responses are split back per document.
+    """
+
+    name = 'vision'
+    max_in_flight = VISION_MAX_IN_FLIGHT
+    batch_size = VISION_PAGES_PER_REQUEST
+
+    def __init__(self):
+        self._client = None
+        self._client_lock = threading.Lock()
+        # Shared by every thread and task that calls Vision in this process
+        self.rate_limiter = TokenBucket.per_minute(VISION_REQUESTS_PER_MINUTE, VISION_BURST)
+
+    @property
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                self._client = self._create_client()
+            return self._client
+
+    def _create_client(self):
+        from google.cloud import vision
+        # Set credentials path relative to project root
+        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = str(PROJECT_ROOT / 'googlecloud.json')
+        return vision.ImageAnnotatorClient()
+
+    def _file_request(self, content: bytes):
+        from google.cloud.vision_v1 import types
+        input_config = types.InputConfig(
+            content=content,
+            mime_type='application/pdf'
+        )
+        feature = types.Feature(
+            type_=types.Feature.Type.DOCUMENT_TEXT_DETECTION
+        )
+        return types.AnnotateFileRequest(
+            input_config=input_config,
+            features=[feature]
+        )
+
+    def annotate(self, contents) -> list:
+        annotations = [None] * len(contents)
+        for group in self._pack_requests(contents):
+            self.rate_limiter.wait()
+            for (index, _), pages in zip(group, self._annotate_group(contents, group)):
+                annotations[index] = pages
+        return annotations
+
+    async def annotate_async(self, contents, executor=None) -> list:
+        """annotate without blocking the event loop; requests are sent concurrently."""
+        loop = asyncio.get_running_loop()
+
+        async def annotate(group):
+            await self.rate_limiter.wait_async()
+            return await loop.run_in_executor(executor, self._annotate_group, contents, group)
+
+        groups = self._pack_requests(contents)
+        annotations = [None] * len(contents)
+        for group, group_pages in zip(groups, await asyncio.gather(*(annotate(group) for group in groups))):
+            for (index, _), pages in zip(group, group_pages):
+                annotations[index] = pages
+        return annotations
+
+    def annotate_images(self, images) -> list:
+        pages = []
+        for start in range(0, len(images), VISION_IMAGES_PER_REQUEST):
+            self.rate_limiter.wait()
+            pages.extend(self._annotate_images(images[start:start + VISION_IMAGES_PER_REQUEST]))
+        return pages
+
+    def _pack_requests(self, contents):
+        """Group documents as (index, page count) lists of at most VISION_PAGES_PER_REQUEST pages."""
+        groups, current, pages = [], [], 0
+        for index, content in enumerate(contents):
+            count = len(PdfReader(BytesIO(content)).pages)
+            if current and pages + count > VISION_PAGES_PER_REQUEST:
+                groups.append(current)
+                current, pages = [], 0
+            current.append((index, count))
+            pages += count
+        if current:
+            groups.append(current)
+        return groups
+
+    def _annotate_group(self, contents, group) -> list:
+        """One Vision request for a group of documents; returns the page annotations of each."""
+        pages = self._annotate_pages(_merge_pdfs([contents[index] for index, _ in group]))
+        annotations, start = [], 0
+        for _, count in group:
+            annotations.append(pages[start:start + count])
+            start += count
+        return annotations
+
+    def _annotate_pages(self, content: bytes) -> list:
+        """Document Text Detection on one PDF; each page's annotation as a dict, None where nothing was found."""
+        response = self.client.batch_annotate_files(requests=[self._file_request(content)])
+        pages = []
+        for file_resp in response.responses:
+            # Like images, files and their pages fail one by one instead of failing the whole request
+            if file_resp.error.message:
+                raise RuntimeError(f"Vision file annotation failed: {file_resp.error.message}")
+            for page_resp in file_resp.responses:
+                if page_resp.error.message:
+                    raise RuntimeError(f"Vision page annotation failed: {page_resp.error.message}")
+                annotation = page_resp.full_text_annotation
+                # proto-plus messages convert themselves to plain dicts
+                pages.append(type(annotation).to_dict(annotation) if annotation else None)
+        return pages
+
+    def _image_request(self, image: bytes):
+        from google.cloud.vision_v1 import types
+        feature = types.Feature(
+            type_=types.Feature.Type.DOCUMENT_TEXT_DETECTION
+        )
+        return types.AnnotateImageRequest(
+            image=types.Image(content=image),
+            features=[feature]
+        )
+
+    def _annotate_images(self, images) -> list:
+        """Document Text Detection on page images in one request; vertices come back in pixels."""
+        response = self.client.batch_annotate_images(requests=[self._image_request(image) for image in images])
+        pages = []
+        for image_resp in response.responses:
+            # Images fail one by one instead of failing the whole request
+            if image_resp.error.message:
+                raise RuntimeError(f"Vision image annotation failed: {image_resp.error.message}")
+            annotation = image_resp.full_text_annotation
+            pages.append(type(annotation).to_dict(annotation) if annotation else None)
+        return pages
+
+
+class FakeVisionEngine(VisionEngine):
+    """The Vision engine against fake_vision.FakeImageAnnotatorClient."""
+
+    name = 'fake'
+
+    def _create_client(self):
+        try:
+            from preprocess.utils.fake_vision import FakeImageAnnotatorClient
+        except ImportError:
+            from fake_vision import FakeImageAnnotatorClient
+        return FakeImageAnnotatorClient()
+
+    def _file_request(self, content: bytes):
+        return SimpleNamespace(input_config=SimpleNamespace(content=content, mime_type='application/pdf'))
+
+    def _image_request(self, image: bytes):
+        return SimpleNamespace(image=SimpleNamespace(content=image))
+
+
+def _merge_pdfs(contents) -> bytes:
+    if len(contents) == 1:
+        return contents[0]
+    writer = PdfWriter()
+    for content in contents:
+        for page in PdfReader(BytesIO(content)).pages:
+            writer.add_page(page)
+    merged = BytesIO()
+    writer.write(merged)
+    return merged.getvalue()
+
+
+def _local_annotate(content: bytes, mode=LOCAL_OCR_MODE, language=LOCAL_OCR_LANGUAGE, dpi=LOCAL_OCR_DPI) -> list:
+    """Page annotations of one PDF from its text layer and/or Tesseract (runs in a worker process)."""
+    pages = []
+    with fitz.open(stream=content, filetype="pdf") as document:
+        for page in document:
+            textpage = None
+            if mode == 'tesseract' or (mode == 'auto' and not is_usable_page(page)):
+                textpage = page.get_textpage_ocr(language=language, dpi=dpi, full=True)
+            annotation = page_annotation(page, textpage)
+            pages.append(annotation if annotation['text'].strip() else None)
+    return pages
+
+
+def _local_annotate_image(image: bytes, language=LOCAL_OCR_LANGUAGE, dpi=LOCAL_OCR_DPI):
+    """Page annotation of one page image from Tesseract (runs in a worker process)."""
+    # Wrapped in a one-page PDF sized by the image resolution, so boxes come out normalized
+    with fitz.open(stream=image) as picture:
+        pdf_bytes = picture.convert_to_pdf()
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as document:
+        page = document[0]
+        textpage = page.get_textpage_ocr(language=language, dpi=dpi, full=True)
+        annotation = page_annotation(page, textpage)
+    return annotation if annotation['text'].strip() else None
+
+
+class LocalEngine(OCREngine):
+    """PyMuPDF text layer / Tesseract OCR in a process pool of LOCAL_OCR_WORKERS."""
+
+    name = 'local'
+
+    def __init__(self, workers=LOCAL_OCR_WORKERS, mode=LOCAL_OCR_MODE):
+        self.workers = max(1, workers)
+        self.mode = mode
+        self.max_in_flight = self.workers * 2
+        self.batch_size = self.workers
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    @property
+    def pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                # Spawned workers are safe to start from the pipeline's threads
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def annotate(self, contents) -> list:
+        return list(self.pool.map(_local_annotate, contents, [self.mode] * len(contents)))
+
+    async def annotate_async(self, contents, executor=None) -> list:
+        futures = [asyncio.wrap_future(self.pool.submit(_local_annotate, content, self.mode)) for content in contents]
+        return list(await asyncio.gather(*futures))
+
+    def annotate_images(self, images) -> list:
+        return list(self.pool.map(_local_annotate_image, images))
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+class FallbackEngine(OCREngine):
+    """
+    Use the primary engine; when it runs out of quota, send documents to the
+    fallback engine for OCR_FALLBACK_COOLDOWN seconds before trying it again.
+    """
+
+    def __init__(self, primary, fallback, cooldown=OCR_FALLBACK_COOLDOWN):
+        self.primary = primary
+        self.fallback = fallback
+        self.cooldown = cooldown
+        self.name = primary.name
+        self.max_in_flight = primary.max_in_flight
+        self.batch_size = primary.batch_size
+        self.fallback_until = 0.0
+
+    def _use_fallback(self):
+        return time.monotonic() < self.fallback_until
+
+    def _quota_exhausted(self, error):
+        logging.getLogger("OCR Engines").warning(
+            f"{self.primary.name} quota exhausted ({str(error)}), "
+            f"using {self.fallback.name} for {self.cooldown:.0f}s")
+        self.fallback_until = time.monotonic() + self.cooldown
+
+    def ocr(self, contents) -> list:
+        if not self._use_fallback():
+            try:
+                return self.primary.ocr(contents)
+            except Exception as e:
+                if not is_quota_error(e):
+                    raise
+                self._quota_exhausted(e)
+        return self.fallback.ocr(contents)
+
+    def ocr_images(self, images) -> dict:
+        if not self._use_fallback():
+            try:
+                return self.primary.ocr_images(images)
+            except Exception as e:
+                if not is_quota_error(e):
+                    raise
+                self._quota_exhausted(e)
+        return self.fallback.ocr_images(images)
+
+    async def ocr_async(self, contents, executor=None) -> list:
+        if not self._use_fallback():
+            try:
+                return await self.primary.ocr_async(contents, executor)
+            except Exception as e:
+                if not is_quota_error(e):
+                    raise
+                self._quota_exhausted(e)
+        return await self.fallback.ocr_async(contents, executor)
+
+
+ENGINES = {
+    'vision': VisionEngine,
+    'fake': FakeVisionEngine,
+    'local': LocalEngine,
+}
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def _engine(name):
+    with _engines_lock:
+        if name not in _engines:
+            if name not in ENGINES:
+                raise ValueError(f"Unknown OCR engine '{name}' (expected one of {', '.join(ENGINES)})")
+            _engines[name] = ENGINES[name]()
+        return _engines[name]
+
+
+def get_engine(name=None, fallback=None) -> OCREngine:
+    """
+    Shared engine instance for a run.
+
+    Args:
+        name: Engine name, defaults to OCR_ENGINE
+        fallback: Engine used while the primary is out of quota, defaults to
+                  OCR_FALLBACK_ENGINE ('' for none)
+    """
+    name = (name or OCR_ENGINE).lower()
+    fallback = (OCR_FALLBACK_ENGINE if fallback is None else fallback).lower()
+    engine = _engine(name)
+    if not fallback or fallback == name:
+        return engine
+    fallback_engine = _engine(fallback)
+    key = f"{name}+{fallback}"
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = FallbackEngine(engine, fallback_engine)
+        return _engines[key]
@@ -5,16 +5,30 @@ ocr_hcfa_s3.py
 Fetches HCFA PDFs from S3, runs OCR via Google Vision,
 writes extracted text back to S3, archives processed PDFs,
 and logs any errors.
+
+The OCR engine is pluggable (see ocr_engines): Google Vision by default, the
+offline fake Vision client, or local PyMuPDF/Tesseract, selected with
+OCR_ENGINE or per run, optionally with a fallback engine for when Vision
+quota runs out. With Vision, up to five single-page PDFs are merged into
+each request and the page results are fanned back out to one text file per
+PDF. Work is driven by asyncio tasks with up to VISION_MAX_IN_FLIGHT
+requests in flight, paced by a token bucket that keeps within
+VISION_REQUESTS_PER_MINUTE.
+
+Electronically generated PDFs whose embedded text layer is usable (see
+text_layer) skip OCR and take their text straight from the PDF. OCR results
+are cached by PDF content hash (see ocr_cache), so byte-identical pages are
+never sent to Vision twice. Besides the text, the word layout of
+each document is stored as Parquet under OCR_LAYOUT_PREFIX (see ocr_layout).
 """
 import os
 import sys
+import asyncio
 import logging
-import tempfile
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from dotenv import load_dotenv
-import boto3
-from google.cloud import vision
-from google.cloud.vision_v1 import types
 
 # Get the project root directory (2 levels up from this file)
 PROJECT_ROOT = Path(__file__).resolve().parent.parent.parent
@@ -23,105 +37,305 @@ sys.path.append(str(PROJECT_ROOT))
 # Load environment variables from the root .env file
 load_dotenv(PROJECT_ROOT / '.env')
 
-# Set credentials path relative to project root
-os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = str(PROJECT_ROOT / 'googlecloud.json')
+# Import storage helpers - handle both package import and direct script execution
+try:
+    from preprocess.utils.storage import iter_objects, download_bytes, upload_bytes, move, batched_deletes
+except ImportError:
+    from storage import iter_objects, download_bytes, upload_bytes, move, batched_deletes
 
-# Import S3 helper functions
-from utils.s3_utils import list_objects, download, upload, move
-
-# Initialize Vision API client
-vision_client = vision.ImageAnnotatorClient()
+# OCR engines, result cache and layout - handle both package import and direct script execution
+try:
+    from preprocess.utils import ocr_cache
+    from preprocess.utils.ocr_engines import get_engine, page_text, CACHED_ENGINES
+    from preprocess.utils.ocr_layout import layout_parquet
+    from preprocess.utils.text_layer import text_layer_pages
+except ImportError:
+    import ocr_cache
+    from ocr_engines import get_engine, page_text, CACHED_ENGINES
+    from ocr_layout import layout_parquet
+    from text_layer import text_layer_pages
 
 # S3 prefixes
 INPUT_PREFIX = os.getenv('OCR_INPUT_PREFIX', 'data/hcfa_pdf/')
 ARCHIVE_PREFIX = os.getenv('OCR_ARCHIVE_PREFIX', 'data/hcfa_pdf/archived/')
 OUTPUT_PREFIX = os.getenv('OCR_OUTPUT_PREFIX', 'data/hcfa_txt/')
+# Word layout Parquet per document (empty to disable)
+LAYOUT_PREFIX = os.getenv('OCR_LAYOUT_PREFIX', 'data/hcfa_layout/')
 LOG_PREFIX = os.getenv('OCR_LOG_PREFIX', 'logs/ocr_errors.log')
 S3_BUCKET = os.getenv('S3_BUCKET')
 
+# Take text from PDFs with a usable embedded text layer instead of OCRing them
+OCR_USE_TEXT_LAYER = os.getenv('OCR_USE_TEXT_LAYER', 'true').lower() in ('1', 'true', 'yes')
 
-def ocr_pdf_with_vision(local_pdf_path: str) -> str:
-    """Run Google Vision Document Text Detection on the PDF file."""
-    with open(local_pdf_path, 'rb') as f:
-        content = f.read()
 
-    input_config = types.InputConfig(
-        content=content,
-        mime_type='application/pdf'
-    )
-    feature = types.Feature(
-        type_=types.Feature.Type.DOCUMENT_TEXT_DETECTION
-    )
-    request = types.AnnotateFileRequest(
-        input_config=input_config,
-        features=[feature]
-    )
+def ocr_results(contents, engine=None) -> list:
+    """
+    OCR results ({'text', 'pages', 'engine'}) for each PDF. PDFs with a usable
+    text layer are read directly, the others come from the content-addressed
+    cache where possible. Only the rest go to the engine; results of
+    CACHED_ENGINES are then cached.
+    """
+    engine = engine or get_engine()
+    results = [text_layer_result(content) for content in contents]
+    digests = {}
+    for index, result in enumerate(results):
+        if result is None:
+            digests[index] = ocr_cache.content_hash(contents[index])
+            results[index] = ocr_cache.get(digests[index])
+    misses = [index for index in digests if results[index] is None]
+    if misses:
+        fresh = engine.ocr([contents[index] for index in misses])
+        for index, result in zip(misses, fresh):
+            results[index] = cache_result(digests[index], result)
+    return results
 
-    response = vision_client.batch_annotate_files(requests=[request])
-    texts = []
-    for file_resp in response.responses:
-        for page_resp in file_resp.responses:
-            if page_resp.full_text_annotation:
-                texts.append(page_resp.full_text_annotation.text)
-    return "\n".join(texts)
 
+async def ocr_results_async(contents, executor=None, engine=None) -> list:
+    """ocr_results for the event loop; text layer checks and cache reads and writes run on executor."""
+    engine = engine or get_engine()
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(*(loop.run_in_executor(executor, text_layer_result, content)
+                                     for content in contents))
+    digests = {index: ocr_cache.content_hash(contents[index])
+               for index, result in enumerate(results) if result is None}
+    cached = await asyncio.gather(*(loop.run_in_executor(executor, ocr_cache.get, digest)
+                                    for digest in digests.values()))
+    for index, result in zip(digests, cached):
+        results[index] = result
+    misses = [index for index in digests if results[index] is None]
+    if misses:
+        fresh = await engine.ocr_async([contents[index] for index in misses], executor)
+        for index, result in zip(misses, fresh):
+            results[index] = await loop.run_in_executor(executor, cache_result, digests[index], result)
+    return results
+
+
+def text_layer_result(content: bytes):
+    """The PDF's own text as an OCR result if its text layer is usable, otherwise None."""
+    if not OCR_USE_TEXT_LAYER:
+        return None
+    try:
+        pages = text_layer_pages(content)
+    except Exception as e:
+        logging.getLogger("OCR Processing").warning(f"Could not read text layer: {str(e)}")
+        return None
+    if pages is None:
+        return None
+    return {'text': page_text(pages), 'pages': pages, 'engine': 'text_layer'}
+
+
+def cache_result(digest, result) -> dict:
+    """
+    Store a fresh engine result under its PDF content hash if the engine's results are cached.
+    Results with a missing page annotation are not cached, so a partial answer is not served forever.
+    """
+    pages = result['pages']
+    if result['engine'] in CACHED_ENGINES and pages and all(page is not None for page in pages):
+        ocr_cache.put(digest, result)
+    return result
 
-def process_ocr_s3():
-    """Process PDFs with OCR, save text output, and archive processed PDFs."""
-    logger = logging.getLogger("OCR Processing")
-    
-    # List all PDFs in source folder (excluding archived)
-    pdf_keys = [key for key in list_objects(INPUT_PREFIX) 
-                if key.lower().endswith('.pdf') 
-                and not key.startswith(ARCHIVE_PREFIX)]
-    
-    if not pdf_keys:
-        logger.info("No PDFs found to process")
-        return
 
-    logger.info(f"Found {len(pdf_keys)} PDFs to process")
+def iter_pdf_keys():
+    """
+    Stream PDFs directly in the source folder (archived/ and preview/ are never listed),
+    processing starts with the first listing page.
+    """
+    return (key for key in iter_objects(INPUT_PREFIX, recursive=False)
+            if key.lower().endswith('.pdf') 
+            and not key.startswith(ARCHIVE_PREFIX))
+
+
+def ocr_document(key: str):
+    """
+    OCR one PDF, save its text and archive the PDF.
     
-    for key in pdf_keys:
-        pdf_name = Path(key).name
-        logger.info(f"Processing {pdf_name}")
-        
+    Returns:
+        Key of the text output, or None if OCR failed (the error is logged)
+    """
+    return ocr_documents([key])[0]
+
+
+def ocr_documents(keys, engine=None):
+    """
+    OCR several PDFs in shared engine requests, save their text and archive them.
+
+    Returns:
+        Key of each text output, None where OCR failed (the error is logged)
+    """
+    logger = logging.getLogger("OCR Processing")
+    txt_keys = [None] * len(keys)
+    contents = {}
+    for index, key in enumerate(keys):
+        logger.info(f"Processing {Path(key).name}")
         try:
-            # Create temp directory for processing
-            with tempfile.TemporaryDirectory() as temp_dir:
-                temp_path = Path(temp_dir)
-                
-                # Download PDF
-                local_pdf = temp_path / pdf_name
-                download(key, str(local_pdf))
-                
-                # Perform OCR
-                extracted = ocr_pdf_with_vision(str(local_pdf))
-                
-                # Write text locally
-                base_name = local_pdf.stem
-                local_txt = temp_path / f"{base_name}.txt"
-                with open(local_txt, 'w', encoding='utf-8') as f:
-                    f.write(extracted)
-
-                # Upload text to S3
-                s3_txt_key = f"{OUTPUT_PREFIX}{base_name}.txt"
-                upload(str(local_txt), s3_txt_key)
-                logger.info(f"Saved OCR text: {s3_txt_key}")
-
-                # Move processed PDF to archived folder
-                archive_key = f"{ARCHIVE_PREFIX}{pdf_name}"
-                move(key, archive_key)
-                logger.info(f"Archived PDF to: {archive_key}")
+            # Download PDF into memory
+            contents[index] = download_bytes(key)
+        except Exception as e:
+            log_ocr_error(key, e)
+    if not contents:
+        return txt_keys
 
+    try:
+        results = ocr_results(list(contents.values()), engine)
+    except Exception as e:
+        for index in contents:
+            log_ocr_error(keys[index], e)
+        return txt_keys
+
+    for index, result in zip(contents, results):
+        try:
+            txt_keys[index] = save_ocr_text(keys[index], result['text'], result['pages'])
         except Exception as e:
-            logger.error(f"Error processing {pdf_name}: {str(e)}", exc_info=True)
-            # Write error to log file
-            log_local = temp_path / "error.log"
-            with open(log_local, 'w', encoding='utf-8') as logf:
-                logf.write(f"Error OCR {key}: {str(e)}\n")
-            upload(str(log_local), LOG_PREFIX)
+            log_ocr_error(keys[index], e)
+    return txt_keys
+
+
+async def ocr_documents_async(keys, executor=None, engine=None):
+    """ocr_documents for the event loop: storage calls and engine requests run on executor."""
+    logger = logging.getLogger("OCR Processing")
+    loop = asyncio.get_running_loop()
+    txt_keys = [None] * len(keys)
+
+    async def log_error(key, error):
+        await loop.run_in_executor(executor, log_ocr_error, key, error)
+
+    for key in keys:
+        logger.info(f"Processing {Path(key).name}")
+    downloads = await asyncio.gather(*(loop.run_in_executor(executor, download_bytes, key) for key in keys),
+                                     return_exceptions=True)
+    contents = {}
+    for index, content in enumerate(downloads):
+        if isinstance(content, Exception):
+            await log_error(keys[index], content)
+        else:
+            contents[index] = content
+    if not contents:
+        return txt_keys
 
-    logger.info("OCR processing complete")
+    try:
+        results = await ocr_results_async(list(contents.values()), executor, engine)
+    except Exception as e:
+        for index in contents:
+            await log_error(keys[index], e)
+        return txt_keys
+
+    for index, result in zip(contents, results):
+        try:
+            txt_keys[index] = await loop.run_in_executor(executor, save_ocr_text, keys[index],
+                                                         result['text'], result['pages'])
+        except Exception as e:
+            await log_error(keys[index], e)
+    return txt_keys
+
+
+def save_ocr_text(key: str, extracted: str, pages=None) -> str:
+    """
+    Upload the OCR text for a PDF (and its word layout when page annotations
+    are given) and archive the PDF. Returns the text key.
+    """
+    logger = logging.getLogger("OCR Processing")
+    pdf_name = Path(key).name
+
+    # Upload text to S3
+    base_name = Path(pdf_name).stem
+    s3_txt_key = f"{OUTPUT_PREFIX}{base_name}.txt"
+    upload_bytes(extracted.encode('utf-8'), s3_txt_key, content_type='text/plain; charset=utf-8')
+    logger.info(f"Saved OCR text: {s3_txt_key}")
+
+    # Upload word layout for region-based extraction
+    if pages is not None and LAYOUT_PREFIX:
+        layout_key = f"{LAYOUT_PREFIX}{base_name}.parquet"
+        upload_bytes(layout_parquet(pages), layout_key)
+        logger.info(f"Saved OCR layout: {layout_key}")
+
+    # Move processed PDF to archived folder
+    archive_key = f"{ARCHIVE_PREFIX}{pdf_name}"
+    move(key, archive_key)
+    logger.info(f"Archived PDF to: {archive_key}")
+    return s3_txt_key
+
+
+def log_ocr_error(key: str, error: Exception):
+    """Log an OCR failure for a PDF and append it to the error log in storage."""
+    logger = logging.getLogger("OCR Processing")
+    logger.error(f"Error processing {Path(key).name}: {str(error)}", exc_info=error)
+    # Write error to log file
+    upload_bytes(f"Error OCR {key}: {str(error)}\n".encode('utf-8'), LOG_PREFIX)
+
+
+async def process_ocr_async(max_in_flight=None, engine=None):
+    """
+    OCR every pending PDF with up to max_in_flight engine requests in progress,
+    each covering up to engine.batch_size single-page PDFs.
+
+    Returns:
+        Number of PDFs processed
+    """
+    engine = engine or get_engine()
+    max_in_flight = max(1, max_in_flight or engine.max_in_flight)
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(max_in_flight)
+    groups = _chunks(iter_pdf_keys(), engine.batch_size)
+    pdf_count = 0
+    tasks = set()
+
+    async def run(keys):
+        try:
+            await ocr_documents_async(keys, executor, engine)
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_in_flight, thread_name_prefix="ocr") as executor:
+        while True:
+            # A task is only created once a slot is free, so the listing is read as work drains
+            await slots.acquire()
+            keys = await loop.run_in_executor(executor, next, groups, None)
+            if keys is None:
+                slots.release()
+                break
+            pdf_count += len(keys)
+            task = asyncio.create_task(run(keys))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+    return pdf_count
+
+
+def _chunks(keys, size):
+    keys = iter(keys)
+    while True:
+        chunk = list(itertools.islice(keys, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def process_ocr_s3(engine=None):
+    """
+    Process PDFs with OCR, save text output, and archive processed PDFs.
+
+    Args:
+        engine: OCR engine name for this run (vision, fake or local), defaults to OCR_ENGINE
+    """
+    logger = logging.getLogger("OCR Processing")
+    engine = get_engine(engine)
+    logger.info(f"OCR engine: {engine.name}")
+    
+    # Archived PDFs are removed from the input folder in batches
+    with batched_deletes():
+        if engine.max_in_flight > 1:
+            pdf_count = asyncio.run(process_ocr_async(engine=engine))
+        else:
+            pdf_count = 0
+            for keys in _chunks(iter_pdf_keys(), engine.batch_size):
+                pdf_count += len(keys)
+                ocr_documents(keys, engine)
+
+    if not pdf_count:
+        logger.info("No PDFs found to process")
+        return
+    logger.info(f"OCR processing complete for {pdf_count} PDFs")
 
 
 if __name__ == '__main__':
@@ -131,4 +345,4 @@ if __name__ == '__main__':
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
         handlers=[logging.StreamHandler(sys.stdout)]
     )
-    process_ocr_s3()
+    process_ocr_s3(sys.argv[1] if len(sys.argv) > 1 else None)
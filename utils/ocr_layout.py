@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+ocr_layout.py
+
+Flattens Vision page annotations into one row per recognized word (page,
+block, paragraph, text, confidence and a bounding box normalized to 0-1 of
+the page) and serializes them as Parquet. The OCR stage stores one layout
+file per document next to its text, so CMS-1500 boxes can later be read by
+region without running OCR again.
+
+page_annotation builds the same annotation shape from a PyMuPDF page, for
+OCR engines other than Vision.
+"""
+from io import BytesIO
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+LAYOUT_SCHEMA = pa.schema([
+    ('page', pa.int16()),
+    ('block', pa.int32()),
+    ('paragraph', pa.int32()),
+    ('word', pa.int32()),
+    ('text', pa.string()),
+    ('confidence', pa.float32()),
+    ('x0', pa.float32()),
+    ('y0', pa.float32()),
+    ('x1', pa.float32()),
+    ('y1', pa.float32()),
+])
+
+
+def _word_box(word, width, height):
+    """(x0, y0, x1, y1) of a word from its normalized vertices; pixel vertices are scaled by the page size."""
+    box = word.get('bounding_box') or {}
+    vertices = box.get('normalized_vertices') or []
+    scale_x = scale_y = 1.0
+    if not vertices and width and height:
+        # Image requests report vertices in pixels
+        vertices = box.get('vertices') or []
+        scale_x, scale_y = 1.0 / width, 1.0 / height
+    if not vertices:
+        return None
+    xs = [vertex.get('x', 0) * scale_x for vertex in vertices]
+    ys = [vertex.get('y', 0) * scale_y for vertex in vertices]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def layout_rows(pages):
+    """
+    Yield one row dict per word in a document's page annotations.
+
+    pages holds one TextAnnotation dict per PDF page (None for pages
+    without text), as returned for each PDF by OCREngine.annotate (see
+    ocr_engines) and stored in OCR results under 'pages'.
+    """
+    for page_number, annotation in enumerate(pages, start=1):
+        if not annotation:
+            continue
+        # Each per-page annotation of a file request holds exactly that page
+        for page in annotation.get('pages', []):
+            for block_idx, block in enumerate(page.get('blocks', [])):
+                for paragraph_idx, paragraph in enumerate(block.get('paragraphs', [])):
+                    for word_idx, word in enumerate(paragraph.get('words', [])):
+                        box = _word_box(word, page.get('width'), page.get('height')) or (None,) * 4
+                        yield {
+                            'page': page_number,
+                            'block': block_idx,
+                            'paragraph': paragraph_idx,
+                            'word': word_idx,
+                            'text': ''.join(symbol.get('text', '') for symbol in word.get('symbols', [])),
+                            'confidence': word.get('confidence'),
+                            'x0': box[0],
+                            'y0': box[1],
+                            'x1': box[2],
+                            'y1': box[3],
+                        }
+
+
+def layout_table(pages) -> pa.Table:
+    """Word layout of a document as a table with LAYOUT_SCHEMA."""
+    return pa.Table.from_pylist(list(layout_rows(pages)), schema=LAYOUT_SCHEMA)
+
+
+def layout_parquet(pages) -> bytes:
+    """Word layout of a document as Parquet bytes."""
+    buffer = BytesIO()
+    pq.write_table(layout_table(pages), buffer, compression='zstd')
+    return buffer.getvalue()
+
+
+def page_annotation(page, textpage=None, confidence=None) -> dict:
+    """
+    Vision-style TextAnnotation dict (text, pages > blocks > paragraphs >
+    words) for a PyMuPDF page, from its text layer or an OCR textpage.
+    """
+    width, height = page.rect.width, page.rect.height
+    blocks = {}
+    for x0, y0, x1, y1, text, block_no, line_no, _ in page.get_text("words", textpage=textpage):
+        vertices = [{'x': x / width, 'y': y / height} for x, y in ((x0, y0), (x1, y0), (x1, y1), (x0, y1))]
+        word = {
+            'bounding_box': {'vertices': [], 'normalized_vertices': vertices},
+            'symbols': [{'text': char, 'confidence': confidence} for char in text],
+            'confidence': confidence,
+        }
+        paragraphs = blocks.setdefault(block_no, {})
+        paragraphs.setdefault(line_no, []).append(word)
+    layout = {
+        'width': int(width),
+        'height': int(height),
+        'blocks': [{'paragraphs': [{'words': words} for words in paragraphs.values()]}
+                   for paragraphs in blocks.values()],
+    }
+    return {'pages': [layout], 'text': page.get_text(textpage=textpage)}
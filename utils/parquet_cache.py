@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+parquet_cache.py
+
+Local on-disk cache for the FileMaker Parquet snapshot in storage (S3 by default).
+Each cached object is revalidated with a HEAD request and only downloaded
+again when its ETag or LastModified changes. Cached files are read with
+memory mapping instead of being pulled over the network on every run.
+"""
+import os
+import sys
+import json
+import logging
+import tempfile
+from collections import namedtuple
+from pathlib import Path
+import pandas as pd
+from dotenv import load_dotenv
+
+# Get the project root directory
+project_root = Path(__file__).resolve().parents[2]
+sys.path.append(str(project_root))
+
+# Load environment variables from .env
+load_dotenv(project_root / '.env')
+
+# Import storage helpers - handle both package import and direct script execution
+try:
+    from preprocess.utils.storage import STORAGE_ERRORS, download, head
+except ImportError:
+    from storage import STORAGE_ERRORS, download, head
+
+CACHE_DIR = Path(os.getenv('FM_CACHE_DIR', str(project_root / '.cache' / 'filemaker')))
+
+CachedObject = namedtuple('CachedObject', ['path', 'etag', 'last_modified'])
+
+
+def _meta_path(local_path: Path) -> Path:
+    return local_path.with_name(local_path.name + '.meta.json')
+
+
+def _read_meta(local_path: Path):
+    try:
+        with open(_meta_path(local_path), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def fetch_cached(key: str) -> CachedObject:
+    """
+    Return a local copy of a stored object, downloading it only if it changed.
+
+    If storage can't be reached but a cached copy exists, the cached copy is used.
+    """
+    logger = logging.getLogger("Parquet Cache")
+    local_path = CACHE_DIR / key
+    cached_meta = _read_meta(local_path) if local_path.exists() else None
+
+    try:
+        info = head(key)
+    except STORAGE_ERRORS as e:
+        if cached_meta:
+            logger.warning(f"Could not revalidate {key} ({str(e)}), using cached copy")
+            return CachedObject(local_path, cached_meta['etag'], cached_meta['last_modified'])
+        raise
+
+    meta = {
+        'etag': info.etag,
+        'last_modified': info.last_modified.isoformat()
+    }
+    if cached_meta == meta:
+        logger.info(f"Cache hit for {key} (ETag {meta['etag']})")
+        return CachedObject(local_path, meta['etag'], meta['last_modified'])
+
+    # Download next to the target and swap it in atomically
+    logger.info(f"Downloading {key} to cache")
+    local_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_name = tempfile.mkstemp(dir=local_path.parent, suffix='.part')
+    os.close(fd)
+    try:
+        download(key, temp_name)
+        os.replace(temp_name, local_path)
+    finally:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+
+    with open(_meta_path(local_path), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    return CachedObject(local_path, meta['etag'], meta['last_modified'])
+
+
+def remote_etag(key: str) -> str:
+    """
+    Current ETag of a stored object from a HEAD request, without downloading it.
+
+    Falls back to the cached copy's ETag if storage can't be reached.
+    """
+    try:
+        return head(key).etag
+    except STORAGE_ERRORS:
+        cached_meta = _read_meta(CACHE_DIR / key)
+        if cached_meta:
+            return cached_meta['etag']
+        raise
+
+
+def read_cached_parquet(key: str, **kwargs) -> pd.DataFrame:
+    """Read a stored Parquet object through the local cache using memory mapping."""
+    cached = fetch_cached(key)
+    return pd.read_parquet(cached.path, memory_map=True, **kwargs)
@@ -5,13 +5,12 @@ pdf_preview.py
 Generates preview images from PDF files by converting the first page to an image
 and creating three cropped sections (header, service lines, footer).
 Uses PyMuPDF (fitz) for PDF processing without system dependencies.
+render_page and upload_previews are shared with preview_ocr, which renders
+each page once for both previews and OCR.
 """
-import os
 import sys
 import logging
-import tempfile
 import fitz  # PyMuPDF
-import boto3
 from PIL import Image
 from io import BytesIO
 from pathlib import Path
@@ -24,86 +23,81 @@ sys.path.append(str(project_root))
 # Load environment variables from .env
 load_dotenv(project_root / '.env')
 
-# Import S3 helper functions
-from utils.s3_utils import list_objects, download, upload, move
+# Import storage helpers - handle both package import and direct script execution
+try:
+    from preprocess.utils.storage import iter_objects, download_bytes, upload_bytes, exists
+except ImportError:
+    from storage import iter_objects, download_bytes, upload_bytes, exists
+
+PREVIEW_PREFIX = 'data/hcfa_pdf/preview/'
+
+# Resolution the first page is rendered at
+PREVIEW_DPI = 300
+
+def render_page(page, dpi: int = PREVIEW_DPI) -> Image.Image:
+    """Render a PyMuPDF page to an RGB image at the given resolution."""
+    zoom = dpi / 72  # zoom factor to achieve the resolution
+    mat = fitz.Matrix(zoom, zoom)  # zoom matrix
+    pix = page.get_pixmap(matrix=mat, alpha=False)
+    
+    # Convert to PIL Image directly from pixmap bytes
+    return Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+
+def preview_sections(image: Image.Image) -> dict:
+    """Header, service lines and footer crops of a rendered first page, by file name."""
+    width, height = image.size
+    
+    # Calculate crop dimensions
+    header_height = int(height * 0.25)
+    service_lines_height = int(height * 0.40)
+    footer_start = int(height * 0.75)
+    
+    return {
+        'header.png': image.crop((0, 0, width, header_height)),
+        'service_lines.png': image.crop((0, header_height, width, header_height + service_lines_height)),
+        'footer.png': image.crop((0, footer_start, width, height))
+    }
+
+def upload_previews(base_filename: str, image: Image.Image):
+    """Crop a rendered first page and upload the sections under the preview folder."""
+    logger = logging.getLogger("PDF Preview")
+    for filename, img in preview_sections(image).items():
+        # Encode image in memory
+        buffer = BytesIO()
+        img.save(buffer, 'PNG')
+        
+        # Upload to preview folder with PDF name as prefix
+        s3_key = f"{PREVIEW_PREFIX}{base_filename}/{filename}"
+        upload_bytes(buffer.getvalue(), s3_key, content_type='image/png')
+        logger.info(f"Uploaded preview {s3_key}")
+
+def previews_exist(base_filename: str) -> bool:
+    """True if the previews of a PDF were already uploaded."""
+    return exists(f"{PREVIEW_PREFIX}{base_filename}/header.png")
 
 def generate_pdf_previews(pdf_filename: str):
     """
-    Generate preview images from a PDF file stored in S3.
+    Generate preview images from a PDF file in storage.
     
     Args:
-        pdf_filename: Name of the PDF file in S3
+        pdf_filename: Name of the PDF file under data/hcfa_pdf/
     """
     logger = logging.getLogger("PDF Preview")
-    s3_client = boto3.client('s3')
-    bucket = os.getenv('S3_BUCKET', 'bill-review-prod')
     source_prefix = 'data/hcfa_pdf/'
-    preview_prefix = 'data/hcfa_pdf/preview/'
     
     pdf_document = None
-    temp_dir = None
     
     try:
-        # Create temp directory for working files
-        temp_dir = tempfile.mkdtemp()
-        temp_path = Path(temp_dir)
-        
-        # Download PDF from S3
-        pdf_path = temp_path / pdf_filename
-        s3_client.download_file(
-            bucket,
-            f"{source_prefix}{pdf_filename}",
-            str(pdf_path)
-        )
-        logger.info(f"Downloaded {pdf_filename} from S3")
-        
-        # Open PDF and convert first page to image
-        pdf_document = fitz.open(str(pdf_path))
-        first_page = pdf_document[0]
-        
-        # Convert to high-quality image (300 DPI)
-        zoom = 300 / 72  # zoom factor to achieve 300 DPI
-        mat = fitz.Matrix(zoom, zoom)  # zoom matrix
-        pix = first_page.get_pixmap(matrix=mat, alpha=False)
-        
-        # Convert to PIL Image directly from pixmap bytes
-        image = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        width, height = image.size
+        # Download PDF into memory
+        pdf_bytes = download_bytes(f"{source_prefix}{pdf_filename}")
+        logger.info(f"Downloaded {pdf_filename}")
         
-        # Calculate crop dimensions
-        header_height = int(height * 0.25)
-        service_lines_height = int(height * 0.40)
-        footer_start = int(height * 0.75)
+        # Open PDF and convert first page to a high-quality image
+        pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
+        image = render_page(pdf_document[0])
         
-        # Crop sections
-        header = image.crop((0, 0, width, header_height))
-        service_lines = image.crop((0, header_height, width, header_height + service_lines_height))
-        footer = image.crop((0, footer_start, width, height))
-        
-        # Get base filename without extension
-        base_filename = Path(pdf_filename).stem
-        
-        # Save and upload each section
-        sections = {
-            'header.png': header,
-            'service_lines.png': service_lines,
-            'footer.png': footer
-        }
-        
-        for filename, img in sections.items():
-            # Save image to temp file
-            temp_image_path = temp_path / filename
-            img.save(temp_image_path, 'PNG')
-            
-            # Upload to S3 in preview folder with PDF name as prefix
-            s3_key = f"{preview_prefix}{base_filename}/{filename}"
-            s3_client.upload_file(
-                str(temp_image_path),
-                bucket,
-                s3_key,
-                ExtraArgs={'ContentType': 'image/png'}
-            )
-            logger.info(f"Uploaded preview {s3_key}")
+        # Save and upload each section with the PDF name as prefix
+        upload_previews(Path(pdf_filename).stem, image)
             
     except Exception as e:
         logger.error(f"Error generating previews for {pdf_filename}: {str(e)}", exc_info=True)
@@ -112,53 +106,51 @@ def generate_pdf_previews(pdf_filename: str):
         # Clean up resources
         if pdf_document:
             pdf_document.close()
-        if temp_dir and os.path.exists(temp_dir):
-            try:
-                import shutil
-                shutil.rmtree(temp_dir, ignore_errors=True)
-            except Exception as e:
-                logger.warning(f"Failed to cleanup temp directory: {str(e)}")
+
+def preview_document(pdf_key: str) -> bool:
+    """
+    Generate previews for one PDF unless they already exist.
+    
+    Returns:
+        True if previews were generated
+    """
+    logger = logging.getLogger("PDF Preview")
+    pdf_file = pdf_key.split('/')[-1]
+    base_name = Path(pdf_file).stem
+    
+    # Check if previews already exist
+    if previews_exist(base_name):
+        logger.debug(f"Previews already exist for {pdf_file}")
+        return False
+    logger.info(f"Generating previews for {pdf_file}")
+    generate_pdf_previews(pdf_file)
+    return True
+
+def iter_pdf_keys():
+    """Stream PDFs directly in the source directory as the listing pages arrive."""
+    source_prefix = 'data/hcfa_pdf/'
+    return (key for key in iter_objects(source_prefix, recursive=False)
+            if key.lower().endswith('.pdf'))
 
 def process_previews_s3():
     """Process all PDFs in the source directory that don't have previews."""
     logger = logging.getLogger("PDF Preview")
-    s3_client = boto3.client('s3')
-    bucket = os.getenv('S3_BUCKET', 'bill-review-prod')
-    source_prefix = 'data/hcfa_pdf/'
-    preview_prefix = 'data/hcfa_pdf/preview/'
     
     try:
-        # List all PDFs in source directory
-        pdf_files = [obj['Key'].split('/')[-1] for obj in s3_client.list_objects_v2(
-            Bucket=bucket,
-            Prefix=source_prefix
-        ).get('Contents', []) if obj['Key'].lower().endswith('.pdf')]
-        
-        if not pdf_files:
-            logger.info("No PDFs found to process")
-            return
-        
-        logger.info(f"Found {len(pdf_files)} PDFs to process")
-        
         # Process each PDF that doesn't already have previews
-        for pdf_file in pdf_files:
+        pdf_count = 0
+        for pdf_key in iter_pdf_keys():
+            pdf_count += 1
             try:
-                base_name = Path(pdf_file).stem
-                preview_path = f"{preview_prefix}{base_name}/"
-                
-                # Check if previews already exist
-                try:
-                    s3_client.head_object(Bucket=bucket, Key=f"{preview_path}header.png")
-                    logger.debug(f"Previews already exist for {pdf_file}")
-                    continue
-                except:
-                    logger.info(f"Generating previews for {pdf_file}")
-                    generate_pdf_previews(pdf_file)
+                preview_document(pdf_key)
             except Exception as e:
                 logger.error(f"Error in preview processing: {str(e)}", exc_info=True)
                 continue
         
-        logger.info("Preview generation complete")
+        if not pdf_count:
+            logger.info("No PDFs found to process")
+            return
+        logger.info(f"Preview generation complete for {pdf_count} PDFs")
         
     except Exception as e:
         logger.error(f"Error in preview processing: {str(e)}", exc_info=True)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+preview_ocr.py
+
+Combined preview and OCR stage: each PDF is downloaded once and each page is
+rasterized once. The first page's 300 DPI rendering gives the three preview
+crops (see pdf_preview), and the same renderings are compressed to grayscale
+images and sent to the OCR engine instead of the PDF, so Vision does not
+render the page again. Text, word layout and archiving are then the same as
+in ocr_hcfa.
+
+PDFs with a usable text layer or a cached OCR result are only rendered for
+their previews; when the previews already exist too, nothing is rendered.
+"""
+import os
+import sys
+import logging
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import fitz  # PyMuPDF
+from dotenv import load_dotenv
+
+# Get the project root directory
+project_root = Path(__file__).resolve().parents[2]
+sys.path.append(str(project_root))
+
+# Load environment variables from .env
+load_dotenv(project_root / '.env')
+
+# Storage, preview and OCR helpers - handle both package import and direct script execution
+try:
+    from preprocess.utils import ocr_cache
+    from preprocess.utils.storage import download_bytes, batched_deletes
+    from preprocess.utils.pdf_preview import PREVIEW_DPI, render_page, upload_previews, previews_exist
+    from preprocess.utils.ocr_engines import get_engine
+    from preprocess.utils.ocr_hcfa import (iter_pdf_keys, text_layer_result, cache_result,
+                                           save_ocr_text, log_ocr_error)
+except ImportError:
+    import ocr_cache
+    from storage import download_bytes, batched_deletes
+    from pdf_preview import PREVIEW_DPI, render_page, upload_previews, previews_exist
+    from ocr_engines import get_engine
+    from ocr_hcfa import iter_pdf_keys, text_layer_result, cache_result, save_ocr_text, log_ocr_error
+
+# Encoding of the page images sent to OCR (JPEG or PNG)
+OCR_IMAGE_FORMAT = os.getenv('OCR_IMAGE_FORMAT', 'JPEG').upper()
+OCR_IMAGE_QUALITY = int(os.getenv('OCR_IMAGE_QUALITY', '85'))
+
+# Documents processed at once by process_preview_ocr_s3
+PREVIEW_OCR_WORKERS = int(os.getenv('PREVIEW_OCR_WORKERS', '8'))
+
+
+def encode_ocr_image(image, dpi: int = PREVIEW_DPI) -> bytes:
+    """Compress a rendered page for OCR: grayscale, JPEG (or PNG), tagged with its resolution."""
+    buffer = BytesIO()
+    gray = image.convert('L')
+    if OCR_IMAGE_FORMAT == 'PNG':
+        gray.save(buffer, 'PNG', optimize=True, dpi=(dpi, dpi))
+    else:
+        gray.save(buffer, 'JPEG', quality=OCR_IMAGE_QUALITY, dpi=(dpi, dpi))
+    return buffer.getvalue()
+
+
+def preview_ocr_document(pdf_key: str, engine=None):
+    """
+    Generate the previews of one PDF and OCR it from the same rendering, then
+    save its text and layout and archive the PDF.
+
+    Returns:
+        Key of the text output, or None if OCR failed (the error is logged)
+    """
+    logger = logging.getLogger("Preview OCR")
+    base_name = Path(pdf_key).stem
+    logger.info(f"Processing {Path(pdf_key).name}")
+
+    try:
+        # Download PDF into memory, once for both previews and OCR
+        content = download_bytes(pdf_key)
+
+        digest = None
+        result = text_layer_result(content)
+        if result is None:
+            digest = ocr_cache.content_hash(content)
+            result = ocr_cache.get(digest)
+        needs_previews = not previews_exist(base_name)
+
+        images = []
+        if result is None or needs_previews:
+            with fitz.open(stream=content, filetype="pdf") as document:
+                for number, page in enumerate(document):
+                    # Only the first page is needed when OCR is already answered
+                    if number and result is not None:
+                        break
+                    image = render_page(page)
+                    if number == 0 and needs_previews:
+                        # A failed preview does not hold the document back from OCR
+                        try:
+                            upload_previews(base_name, image)
+                        except Exception as e:
+                            logger.error(f"Error generating previews for {Path(pdf_key).name}: {str(e)}",
+                                         exc_info=True)
+                    if result is None:
+                        images.append(encode_ocr_image(image))
+
+        if result is None:
+            result = cache_result(digest, (engine or get_engine()).ocr_images(images))
+        return save_ocr_text(pdf_key, result['text'], result['pages'])
+    except Exception as e:
+        log_ocr_error(pdf_key, e)
+        return None
+
+
+def process_preview_ocr_s3(engine=None):
+    """
+    Generate previews and OCR text for every pending PDF, rendering each page once.
+
+    Args:
+        engine: OCR engine name for this run (vision, fake or local), defaults to OCR_ENGINE
+    """
+    logger = logging.getLogger("Preview OCR")
+    engine = get_engine(engine)
+    logger.info(f"OCR engine: {engine.name}")
+
+    # Archived PDFs are removed from the input folder in batches
+    with batched_deletes():
+        with ThreadPoolExecutor(max(1, PREVIEW_OCR_WORKERS), thread_name_prefix="preview-ocr") as executor:
+            txt_keys = list(executor.map(lambda key: preview_ocr_document(key, engine), iter_pdf_keys()))
+
+    if not txt_keys:
+        logger.info("No PDFs found to process")
+        return
+    logger.info(f"Previews and OCR complete for {len(txt_keys)} PDFs")
+
+
+if __name__ == '__main__':
+    # Setup basic logging when run directly
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+    process_preview_ocr_s3(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+rate_limit.py
+
+Token bucket rate limiter for calls against remote API quotas (Google Vision).
+Callers reserve a token and sleep until it is due, so one bucket can be
+shared by worker threads (wait) and asyncio tasks (wait_async) alike.
+"""
+import time
+import asyncio
+import threading
+
+
+class TokenBucket:
+    """
+    Allow `rate` calls per second on average with bursts of up to `capacity`.
+    A rate of 0 or less disables limiting.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = max(1, capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def per_minute(cls, requests_per_minute, capacity=None):
+        return cls(requests_per_minute / 60, capacity)
+
+    def _reserve(self):
+        """Take a token (possibly one not refilled yet) and return the seconds until it is due."""
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def wait(self):
+        """Block the calling thread until a call is allowed."""
+        delay = self._reserve()
+        if delay:
+            time.sleep(delay)
+
+    async def wait_async(self):
+        """Suspend the calling task until a call is allowed."""
+        delay = self._reserve()
+        if delay:
+            await asyncio.sleep(delay)
@@ -9,7 +9,7 @@ and archives the original batch files.
 import os
 import sys
 import logging
-import tempfile
+from io import BytesIO
 from datetime import datetime
 from pathlib import Path
 from PyPDF2 import PdfReader, PdfWriter
@@ -22,8 +22,12 @@ sys.path.append(str(project_root))
 # Load environment variables from .env
 load_dotenv(project_root / '.env')
 
-# Import S3 helper functions
-from utils.s3_utils import list_objects, download, upload, move
+# Import storage helpers - handle both package import and direct script execution
+try:
+    from preprocess.utils.storage import (iter_objects, download_bytes, upload_bytes, move,
+                                          batched_deletes, log_progress)
+except ImportError:
+    from storage import iter_objects, download_bytes, upload_bytes, move, batched_deletes, log_progress
 
 # S3 prefixes
 INPUT_PREFIX = os.getenv('INPUT_PREFIX', 'data/batches/')
@@ -31,41 +35,38 @@ OUTPUT_PREFIX = os.getenv('OUTPUT_PREFIX', 'data/hcfa_pdf/')  # Simplified outpu
 ARCHIVE_PREFIX = os.getenv('ARCHIVE_PREFIX', 'data/batches/archived/')
 
 
-def split_and_upload(batch_key: str, batch_idx: int, timestamp: str):
-    """Download a batch PDF, split pages, upload splits, and archive original."""
+def iter_split_pages(batch_key: str, batch_idx: int, timestamp: str):
+    """
+    Download a batch PDF, split pages and upload the splits, yielding each
+    page key as soon as it is uploaded. The original is archived after the
+    last page.
+    """
     logger = logging.getLogger("Split HCFA")
     bucket = os.getenv('S3_BUCKET')
     logger.info(f"Processing s3://{bucket}/{batch_key} (batch #{batch_idx})")
 
     try:
-        # Download batch PDF to temp directory
-        temp_dir = Path(tempfile.gettempdir())
-        local_pdf = temp_dir / Path(batch_key).name
-        download(batch_key, str(local_pdf))
+        # Download batch PDF into memory as concurrent ranged parts (batches can be hundreds of MB)
+        batch_pdf = download_bytes(batch_key, progress=log_progress(f"Downloading {batch_key}", logger),
+                                   multipart=True)
+        reader = PdfReader(BytesIO(batch_pdf))
 
-        # Read and split PDF pages
-        reader = PdfReader(str(local_pdf))
+        # Split PDF pages
         for page_idx, page in enumerate(reader.pages, start=1):
             writer = PdfWriter()
             writer.add_page(page)
 
-            # Write page to a temporary file
-            local_out = Path(tempfile.mktemp(suffix=".pdf"))
-            with open(local_out, "wb") as f:
-                writer.write(f)
+            # Write page to an in-memory buffer
+            page_pdf = BytesIO()
+            writer.write(page_pdf)
 
             # Create filename with datetime_batch_page format
             output_filename = f"{timestamp}_{batch_idx:02d}_{page_idx:03d}.pdf"
             s3_key = f"{OUTPUT_PREFIX}{output_filename}"
             
-            upload(str(local_out), s3_key)
+            upload_bytes(page_pdf.getvalue(), s3_key, content_type='application/pdf')
             logger.info(f"Uploaded {s3_key}")
-
-            # Clean up local page file
-            local_out.unlink()
-
-        # Clean up batch PDF
-        local_pdf.unlink()
+            yield s3_key
 
         # Archive original in timestamped subfolder
         archive_subfolder = f"batch_{timestamp}"
@@ -78,6 +79,26 @@ def split_and_upload(batch_key: str, batch_idx: int, timestamp: str):
         raise
 
 
+def split_and_upload(batch_key: str, batch_idx: int, timestamp: str):
+    """Download a batch PDF, split pages, upload splits, and archive original. Returns the page keys."""
+    return list(iter_split_pages(batch_key, batch_idx, timestamp))
+
+
+def list_batch_keys():
+    """Batch PDFs waiting directly in INPUT_PREFIX."""
+    # List files directly in the input directory (archived batches are never listed)
+    all_keys = list(iter_objects(INPUT_PREFIX, recursive=False))
+    logging.getLogger("Split HCFA").info(f"Found {len(all_keys)} total files in {INPUT_PREFIX}")
+    
+    # Filter for PDFs only in the root batches directory (not in subdirectories)
+    return [
+        k for k in all_keys 
+        if k.lower().endswith('.pdf') 
+        and k.count('/') == 2  # Only files directly in data/batches/
+        and not 'archived' in k.lower()  # Exclude anything from archived folders
+    ]
+
+
 def process_batch_s3():
     """Process all batch PDFs in S3, splitting them into individual pages."""
     logger = logging.getLogger("Split HCFA")
@@ -85,17 +106,7 @@ def process_batch_s3():
         # Create timestamp for this run (used in filenames)
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         
-        # List all files in the input directory
-        all_keys = list_objects(INPUT_PREFIX)
-        logger.info(f"Found {len(all_keys)} total files in {INPUT_PREFIX}")
-        
-        # Filter for PDFs only in the root batches directory (not in subdirectories)
-        pdf_keys = [
-            k for k in all_keys 
-            if k.lower().endswith('.pdf') 
-            and k.count('/') == 2  # Only files directly in data/batches/
-            and not 'archived' in k.lower()  # Exclude anything from archived folders
-        ]
+        pdf_keys = list_batch_keys()
         
         if not pdf_keys:
             logger.warning(f"No PDF batches found to process in {INPUT_PREFIX}")
@@ -105,8 +116,9 @@ def process_batch_s3():
         for key in pdf_keys:
             logger.info(f"  - {key}")
             
-        for idx, key in enumerate(pdf_keys, start=1):
-            split_and_upload(key, idx, timestamp)
+        with batched_deletes():
+            for idx, key in enumerate(pdf_keys, start=1):
+                split_and_upload(key, idx, timestamp)
         logger.info("All batches processed.")
     except Exception as e:
         logger.error(f"Error in batch processing: {str(e)}", exc_info=True)
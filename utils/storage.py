@@ -0,0 +1,609 @@
+#!/usr/bin/env python3
+"""
+storage.py
+
+Storage backends used by every preprocessing stage. Objects are addressed by
+S3-style keys ("data/hcfa_pdf/x.pdf") and live either in the S3 bucket or in
+a local directory tree, selected with STORAGE_BACKEND ("s3" or "local").
+The local backend lets the whole pipeline run against a directory on a
+laptop or CI box without touching the production bucket.
+
+The module-level list_objects/download/upload/move functions have the same
+signatures as utils.s3_utils and go through the configured backend.
+download_bytes/upload_bytes/open_object/upload_fileobj move content in
+memory or as a stream so stages don't need local temp files.
+
+Inside a batched_deletes() block, move() and replace_object() copy or write
+the destination right away and queue the source deletes, which are sent as
+DeleteObjects requests of up to 1,000 keys, at the latest
+S3_DELETE_FLUSH_SECONDS after the first one was queued.
+"""
+import os
+import sys
+import shutil
+import logging
+import hashlib
+import tempfile
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from io import BytesIO
+from datetime import datetime, timezone
+from pathlib import Path
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from dotenv import load_dotenv
+
+# Get the project root directory
+project_root = Path(__file__).resolve().parents[2]
+sys.path.append(str(project_root))
+
+# Load environment variables from .env
+load_dotenv(project_root / '.env')
+
+S3_BUCKET = os.getenv('S3_BUCKET')
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 's3').lower()
+STORAGE_ROOT = os.getenv('STORAGE_ROOT', str(project_root / 'storage'))
+
+# S3 connection pool and retry policy, shared by every thread in the process
+S3_MAX_CONNECTIONS = int(os.getenv('S3_MAX_CONNECTIONS', '50'))
+S3_MAX_ATTEMPTS = int(os.getenv('S3_MAX_ATTEMPTS', '5'))
+S3_RETRY_MODE = os.getenv('S3_RETRY_MODE', 'adaptive')
+S3_TCP_KEEPALIVE = os.getenv('S3_TCP_KEEPALIVE', 'true').lower() in ('1', 'true', 'yes')
+S3_CONNECT_TIMEOUT = float(os.getenv('S3_CONNECT_TIMEOUT', '10'))
+S3_READ_TIMEOUT = float(os.getenv('S3_READ_TIMEOUT', '60'))
+
+# Sub-prefixes listed concurrently by iter_objects(fan_out=True)
+S3_LIST_WORKERS = int(os.getenv('S3_LIST_WORKERS', '16'))
+
+# DeleteObjects accepts at most 1,000 keys per request
+DELETE_BATCH_SIZE = 1000
+# Longest a queued source delete waits, so a killed process leaves few moved sources behind
+S3_DELETE_FLUSH_SECONDS = float(os.getenv('S3_DELETE_FLUSH_SECONDS', '5'))
+
+# Objects above the threshold are transferred as concurrent ranged / multipart parts
+MB = 1024 * 1024
+S3_MULTIPART_THRESHOLD = int(float(os.getenv('S3_MULTIPART_THRESHOLD_MB', '16')) * MB)
+S3_MULTIPART_CHUNKSIZE = int(float(os.getenv('S3_MULTIPART_CHUNKSIZE_MB', '16')) * MB)
+S3_TRANSFER_CONCURRENCY = int(os.getenv('S3_TRANSFER_CONCURRENCY', '10'))
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD,
+    multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+    max_concurrency=S3_TRANSFER_CONCURRENCY,
+    use_threads=True
+)
+
+# Chunk size for local stream copies
+COPY_CHUNK_SIZE = MB
+
+# Errors raised when the backend can't be reached or an object is missing
+STORAGE_ERRORS = (BotoCoreError, ClientError, OSError)
+
+ObjectInfo = namedtuple('ObjectInfo', ['key', 'size', 'etag', 'last_modified'])
+
+
+def _is_not_found(error):
+    return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+
+class _Progress:
+    """
+    Adapts boto3's per-chunk byte counts (reported from several transfer
+    threads) to progress(transferred, total) calls with running totals.
+    """
+
+    def __init__(self, progress, total):
+        self.progress = progress
+        self.total = total
+        self.transferred = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, bytes_amount):
+        with self.lock:
+            self.transferred += bytes_amount
+            transferred = self.transferred
+        self.progress(transferred, self.total)
+
+
+def _copy_stream(source, dest, progress=None, total=None):
+    tracker = _Progress(progress, total) if progress else None
+    while True:
+        chunk = source.read(COPY_CHUNK_SIZE)
+        if not chunk:
+            break
+        dest.write(chunk)
+        if tracker:
+            tracker(len(chunk))
+
+
+class S3Storage:
+    """Objects stored in an S3 bucket."""
+
+    name = 's3'
+
+    def __init__(self, bucket=S3_BUCKET):
+        self.bucket = bucket
+        self.client = s3_client()
+
+    def list_objects(self, prefix):
+        """All keys under prefix, in key order."""
+        return list(self.iter_objects(prefix))
+
+    def _pages(self, prefix, delimiter=None):
+        paginator = self.client.get_paginator('list_objects_v2')
+        params = {'Bucket': self.bucket, 'Prefix': prefix}
+        if delimiter:
+            params['Delimiter'] = delimiter
+        return paginator.paginate(**params)
+
+    def iter_objects(self, prefix, recursive=True, fan_out=False):
+        """
+        Yield keys under prefix page by page (1,000 keys per request).
+
+        Args:
+            prefix: Key prefix, usually ending in '/'
+            recursive: Include keys in sub-prefixes ("folders"); when False
+                       only keys directly under prefix are listed
+            fan_out: List each '/' sub-prefix on its own thread. Keys
+                     directly under prefix come first, then each sub-prefix
+                     in order, so the order is no longer strict key order.
+        """
+        if recursive and not fan_out:
+            for page in self._pages(prefix):
+                yield from (obj['Key'] for obj in page.get('Contents', []))
+            return
+
+        sub_prefixes = []
+        for page in self._pages(prefix, delimiter='/'):
+            yield from (obj['Key'] for obj in page.get('Contents', []))
+            sub_prefixes.extend(common['Prefix'] for common in page.get('CommonPrefixes', []))
+        if not recursive or not sub_prefixes:
+            return
+
+        with ThreadPoolExecutor(min(S3_LIST_WORKERS, len(sub_prefixes))) as executor:
+            for keys in executor.map(self.list_objects, sub_prefixes):
+                yield from keys
+
+    def head(self, key):
+        """ObjectInfo for a key; raises FileNotFoundError if it doesn't exist."""
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if _is_not_found(e):
+                raise FileNotFoundError(f"s3://{self.bucket}/{key}") from e
+            raise
+        return ObjectInfo(key, response['ContentLength'], response['ETag'].strip('"'), response['LastModified'])
+
+    def exists(self, key):
+        try:
+            self.head(key)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _callback(self, progress, total):
+        return _Progress(progress, total) if progress else None
+
+    def download(self, key, local_path, progress=None):
+        total = self.head(key).size if progress else None
+        self.client.download_file(self.bucket, key, str(local_path), Config=TRANSFER_CONFIG,
+                                  Callback=self._callback(progress, total))
+        return str(local_path)
+
+    def upload(self, local_path, key, content_type=None, progress=None):
+        extra_args = {'ContentType': content_type} if content_type else None
+        total = os.path.getsize(local_path) if progress else None
+        self.client.upload_file(str(local_path), self.bucket, key, ExtraArgs=extra_args,
+                                Config=TRANSFER_CONFIG, Callback=self._callback(progress, total))
+
+    def open_object(self, key):
+        """Read-only stream over an object's content (the GetObject body)."""
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+        except ClientError as e:
+            if _is_not_found(e):
+                raise FileNotFoundError(f"s3://{self.bucket}/{key}") from e
+            raise
+
+    def download_bytes(self, key, progress=None, multipart=False):
+        """
+        Object content as bytes. Small objects are one GetObject; with
+        multipart=True (or a progress callback) large objects are fetched as
+        concurrent ranged GETs per TRANSFER_CONFIG.
+        """
+        if not multipart and not progress:
+            with closing(self.open_object(key)) as body:
+                return body.read()
+        total = self.head(key).size if progress else None
+        buffer = BytesIO()
+        self.client.download_fileobj(self.bucket, key, buffer, Config=TRANSFER_CONFIG,
+                                     Callback=self._callback(progress, total))
+        return buffer.getvalue()
+
+    def upload_bytes(self, data, key, content_type=None, progress=None):
+        if len(data) >= S3_MULTIPART_THRESHOLD or progress:
+            self.upload_fileobj(BytesIO(data), key, content_type, progress, total=len(data))
+            return
+        extra_args = {'ContentType': content_type} if content_type else {}
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data, **extra_args)
+
+    def upload_fileobj(self, fileobj, key, content_type=None, progress=None, total=None):
+        extra_args = {'ContentType': content_type} if content_type else None
+        self.client.upload_fileobj(fileobj, self.bucket, key, ExtraArgs=extra_args,
+                                   Config=TRANSFER_CONFIG, Callback=self._callback(progress, total))
+
+    def copy(self, source_key, dest_key):
+        """Server-side copy, the content never leaves S3."""
+        self.client.copy_object(Bucket=self.bucket, Key=dest_key,
+                                CopySource={'Bucket': self.bucket, 'Key': source_key})
+
+    def move(self, source_key, dest_key):
+        self.copy(source_key, dest_key)
+        self.delete(source_key)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def delete_many(self, keys):
+        """Delete keys with DeleteObjects, 1,000 per request. Returns the keys that failed."""
+        failed = []
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            objects = [{'Key': key} for key in keys[start:start + DELETE_BATCH_SIZE]]
+            response = self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': objects, 'Quiet': True})
+            failed.extend(error['Key'] for error in response.get('Errors', []))
+        return failed
+
+
+class LocalStorage:
+    """Objects stored as files under a root directory, one file per key."""
+
+    name = 'local'
+
+    def __init__(self, root=STORAGE_ROOT):
+        self.root = Path(root)
+
+    def _path(self, key):
+        return self.root / key
+
+    def list_objects(self, prefix):
+        """All keys under prefix, in key order (same as S3)."""
+        return list(self.iter_objects(prefix))
+
+    def iter_objects(self, prefix, recursive=True, fan_out=False):
+        """Yield keys under prefix in key order (fan_out has no effect locally)."""
+        # Only walk the directory the prefix points into
+        base = self.root / prefix.rpartition('/')[0]
+        if not base.is_dir():
+            return
+        keys = []
+        for dirpath, dirnames, filenames in os.walk(base):
+            if not recursive:
+                dirnames.clear()
+            for filename in filenames:
+                if filename.endswith('.part'):
+                    continue
+                key = Path(dirpath, filename).relative_to(self.root).as_posix()
+                if key.startswith(prefix):
+                    keys.append(key)
+        yield from sorted(keys)
+
+    def head(self, key):
+        """ObjectInfo for a key; raises FileNotFoundError if it doesn't exist."""
+        stat = self._path(key).stat()
+        etag = hashlib.md5(f"{stat.st_mtime_ns}-{stat.st_size}".encode()).hexdigest()
+        last_modified = datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc)
+        return ObjectInfo(key, stat.st_size, etag, last_modified)
+
+    def exists(self, key):
+        return self._path(key).is_file()
+
+    def download(self, key, local_path, progress=None):
+        if not progress:
+            shutil.copyfile(self._path(key), local_path)
+            return str(local_path)
+        with open(self._path(key), 'rb') as source, open(local_path, 'wb') as dest:
+            _copy_stream(source, dest, progress, self._path(key).stat().st_size)
+        return str(local_path)
+
+    def upload(self, local_path, key, content_type=None, progress=None):
+        with open(local_path, 'rb') as f:
+            self.upload_fileobj(f, key, content_type, progress, os.path.getsize(local_path))
+
+    def open_object(self, key):
+        return open(self._path(key), 'rb')
+
+    def download_bytes(self, key, progress=None, multipart=False):
+        if not progress:
+            return self._path(key).read_bytes()
+        buffer = BytesIO()
+        with open(self._path(key), 'rb') as source:
+            _copy_stream(source, buffer, progress, self._path(key).stat().st_size)
+        return buffer.getvalue()
+
+    def upload_bytes(self, data, key, content_type=None, progress=None):
+        self.upload_fileobj(BytesIO(data), key, content_type, progress, len(data))
+
+    def upload_fileobj(self, fileobj, key, content_type=None, progress=None, total=None):
+        # Write next to the target and swap it in, readers never see a partial file
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp_name = tempfile.mkstemp(dir=path.parent, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                _copy_stream(fileobj, f, progress, total)
+            os.replace(temp_name, path)
+        finally:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+
+    def copy(self, source_key, dest_key):
+        with open(self._path(source_key), 'rb') as f:
+            self.upload_fileobj(f, dest_key)
+
+    def move(self, source_key, dest_key):
+        dest = self._path(dest_key)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(self._path(source_key), dest)
+
+    def delete(self, key):
+        self._path(key).unlink(missing_ok=True)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.delete(key)
+        return []
+
+
+_s3_client = None
+_s3_client_pid = None
+_s3_client_lock = threading.Lock()
+
+
+def s3_client():
+    """
+    Process-wide S3 client with a pooled, kept-alive connection pool.
+
+    boto3 clients are thread-safe, so every stage and worker thread shares
+    this one instead of paying for client construction and TLS handshakes
+    per document. A new client is made after a fork.
+    """
+    global _s3_client, _s3_client_pid
+    with _s3_client_lock:
+        if _s3_client is None or _s3_client_pid != os.getpid():
+            config = Config(
+                max_pool_connections=S3_MAX_CONNECTIONS,
+                retries={'total_max_attempts': S3_MAX_ATTEMPTS, 'mode': S3_RETRY_MODE},
+                tcp_keepalive=S3_TCP_KEEPALIVE,
+                connect_timeout=S3_CONNECT_TIMEOUT,
+                read_timeout=S3_READ_TIMEOUT
+            )
+            # Sessions aren't thread-safe, create the client from a private one under the lock
+            _s3_client = boto3.session.Session().client('s3', config=config)
+            _s3_client_pid = os.getpid()
+        return _s3_client
+
+
+BACKENDS = {
+    S3Storage.name: S3Storage,
+    LocalStorage.name: LocalStorage,
+}
+
+_storage = None
+_storage_pid = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    """
+    The configured storage backend, created once per process.
+
+    Forked workers get their own instance instead of sharing the parent's
+    connections.
+    """
+    global _storage, _storage_pid
+    with _storage_lock:
+        if _storage is None or _storage_pid != os.getpid():
+            if STORAGE_BACKEND not in BACKENDS:
+                raise ValueError(f"Unknown STORAGE_BACKEND '{STORAGE_BACKEND}' "
+                                 f"(expected one of: {', '.join(BACKENDS)})")
+            _storage = BACKENDS[STORAGE_BACKEND]()
+            _storage_pid = os.getpid()
+        return _storage
+
+
+class DeleteBatch:
+    """
+    Source keys of moves waiting to be deleted together: sent when max_keys
+    are queued or max_age seconds after the first key was queued.
+    """
+
+    def __init__(self, storage, max_keys=DELETE_BATCH_SIZE, max_age=S3_DELETE_FLUSH_SECONDS):
+        self.storage = storage
+        self.max_keys = max(1, min(max_keys, DELETE_BATCH_SIZE))
+        self.max_age = max_age
+        self.keys = []
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def add(self, key):
+        with self.lock:
+            self.keys.append(key)
+            if len(self.keys) < self.max_keys:
+                if self.timer is None and self.max_age > 0:
+                    self.timer = threading.Timer(self.max_age, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+                return
+            keys = self._take()
+        self._delete(keys)
+
+    def flush(self):
+        with self.lock:
+            keys = self._take()
+        if keys:
+            self._delete(keys)
+
+    def _take(self):
+        keys, self.keys = self.keys, []
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        return keys
+
+    def _delete(self, keys):
+        failed = self.storage.delete_many(keys)
+        if failed:
+            logging.getLogger("Storage").warning(f"Could not delete {len(failed)} moved objects: {', '.join(failed[:10])}")
+
+
+_delete_batch = None
+_delete_batch_pid = None
+
+
+@contextmanager
+def batched_deletes(max_keys=DELETE_BATCH_SIZE, max_age=S3_DELETE_FLUSH_SECONDS):
+    """
+    Defer the source deletes of move() and replace_object() and send them as
+    batched DeleteObjects calls: when max_keys are queued, max_age seconds
+    after the first was queued, or when the block ends.
+
+    Sources stay readable until they are deleted, so a crash inside the
+    block leaves both copies rather than losing anything; the next run then
+    processes those sources again, which max_age keeps to a few documents.
+    Nested blocks share the outermost batch.
+    """
+    global _delete_batch, _delete_batch_pid
+    if _delete_batch is not None and _delete_batch_pid == os.getpid():
+        yield _delete_batch
+        return
+    _delete_batch = DeleteBatch(get_storage(), max_keys, max_age)
+    _delete_batch_pid = os.getpid()
+    try:
+        yield _delete_batch
+    finally:
+        batch, _delete_batch = _delete_batch, None
+        batch.flush()
+
+
+def _delete_source(key):
+    if _delete_batch is not None and _delete_batch_pid == os.getpid():
+        _delete_batch.add(key)
+    else:
+        get_storage().delete(key)
+
+
+def list_objects(prefix):
+    """List all object keys under a prefix."""
+    return get_storage().list_objects(prefix)
+
+
+def iter_objects(prefix, recursive=True, fan_out=False):
+    """
+    Yield object keys under a prefix as the listing pages arrive.
+
+    recursive=False lists only keys directly under prefix (archive
+    sub-folders are never listed); fan_out=True lists sub-prefixes
+    concurrently. See S3Storage.iter_objects.
+    """
+    return get_storage().iter_objects(prefix, recursive, fan_out)
+
+
+def download(key, local_path, progress=None):
+    """Download an object to local_path and return the path."""
+    return get_storage().download(key, local_path, progress)
+
+
+def upload(local_path, key, content_type=None, progress=None):
+    """Upload a local file to key (multipart above S3_MULTIPART_THRESHOLD)."""
+    get_storage().upload(local_path, key, content_type, progress)
+
+
+def download_bytes(key, progress=None, multipart=False):
+    """
+    Return an object's content as bytes.
+
+    Set multipart=True for large objects (batch PDFs) to download them as
+    concurrent ranged parts. progress(transferred_bytes, total_bytes) is
+    called as parts arrive, possibly from several threads.
+    """
+    return get_storage().download_bytes(key, progress, multipart)
+
+
+def upload_bytes(data, key, content_type=None, progress=None):
+    """Store bytes at key (multipart above S3_MULTIPART_THRESHOLD)."""
+    get_storage().upload_bytes(data, key, content_type, progress)
+
+
+def open_object(key):
+    """Open an object as a read-only binary stream (close it when done)."""
+    return get_storage().open_object(key)
+
+
+def upload_fileobj(fileobj, key, content_type=None, progress=None, total=None):
+    """Stream a readable binary file object to key (multipart, concurrent parts on S3)."""
+    get_storage().upload_fileobj(fileobj, key, content_type, progress, total)
+
+
+def log_progress(label, logger=None, step=10):
+    """Progress callback for transfers that logs every `step` percent."""
+    logger = logger or logging.getLogger("Storage")
+    lock = threading.Lock()
+    next_percent = [step]
+
+    def progress(transferred, total):
+        if not total:
+            return
+        percent = transferred * 100 // total
+        with lock:
+            if percent < next_percent[0]:
+                return
+            next_percent[0] = (percent // step + 1) * step
+            logger.info(f"{label}: {percent}% of {total / MB:.1f} MB")
+
+    return progress
+
+
+def move(source_key, dest_key):
+    """Move an object to a new key (server-side copy, then delete the source)."""
+    if source_key == dest_key:
+        return
+    if _delete_batch is None or _delete_batch_pid != os.getpid():
+        get_storage().move(source_key, dest_key)
+        return
+    get_storage().copy(source_key, dest_key)
+    _delete_batch.add(source_key)
+
+
+def replace_object(source_key, dest_key, data, content_type=None):
+    """
+    Write new content to dest_key and delete source_key.
+
+    For a move that also changes the content: one upload instead of an
+    upload followed by a copy of the old content over it.
+    """
+    get_storage().upload_bytes(data, dest_key, content_type)
+    if source_key != dest_key:
+        _delete_source(source_key)
+
+
+def delete_many(keys):
+    """Delete many objects, batched where the backend supports it. Returns the keys that failed."""
+    return get_storage().delete_many(list(keys))
+
+
+def delete(key):
+    """Delete an object (missing objects are ignored)."""
+    get_storage().delete(key)
+
+
+def head(key):
+    """ObjectInfo for key; raises FileNotFoundError if it doesn't exist."""
+    return get_storage().head(key)
+
+
+def exists(key):
+    """Whether an object exists at key."""
+    return get_storage().exists(key)
@@ -8,8 +8,6 @@ Verifies that the files contain the expected columns and data types.
 import os
 import sys
 from pathlib import Path
-import pandas as pd
-import s3fs
 from dotenv import load_dotenv
 
 # Add the project root to Python path
@@ -19,6 +17,12 @@ sys.path.append(project_root)
 # Load environment variables
 load_dotenv()
 
+# Read through the same local Parquet cache as map_to_fm
+try:
+    from preprocess.utils.parquet_cache import read_cached_parquet
+except ImportError:
+    from parquet_cache import read_cached_parquet
+
 S3_BUCKET = os.getenv('S3_BUCKET')
 PARQUET_PREFIX = 'data/filemaker/'
 
@@ -26,13 +30,9 @@ def test_orders_parquet():
     """Test the structure and content of orders.parquet"""
     print("\nTesting orders.parquet...")
     
-    # Initialize S3 filesystem
-    s3 = s3fs.S3FileSystem()
-    orders_path = f"s3://{S3_BUCKET}/{PARQUET_PREFIX}orders.parquet"
-    
     try:
         # Load orders DataFrame
-        df = pd.read_parquet(orders_path)
+        df = read_cached_parquet(f"{PARQUET_PREFIX}orders.parquet")
         
         # Required columns for mapping process
         required_columns = {
@@ -88,13 +88,9 @@ def test_line_items_parquet():
     """Test the structure and content of line_items.parquet"""
     print("\nTesting line_items.parquet...")
     
-    # Initialize S3 filesystem
-    s3 = s3fs.S3FileSystem()
-    line_items_path = f"s3://{S3_BUCKET}/{PARQUET_PREFIX}line_items.parquet"
-    
     try:
         # Load line items DataFrame
-        df = pd.read_parquet(line_items_path)
+        df = read_cached_parquet(f"{PARQUET_PREFIX}line_items.parquet")
         
         # Required columns for mapping process
         required_columns = {
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+test_preview_ocr.py
+
+Tests the render-once preview+OCR stage against the two-stage path
+(pdf_preview, then ocr_hcfa) with the fake Vision engine and local storage
+in a temporary directory. The fake is told what Vision would read from each
+rendered page, so both paths must produce the same text, word layout and
+previews, and the render-once result must be cached under the PDF hash.
+
+setup_module points storage, the OCR cache and the fake engine at the
+temporary directory and teardown_module puts them back, so importing this
+file changes nothing.
+"""
+import os
+import sys
+import shutil
+import tempfile
+from io import BytesIO
+from pathlib import Path
+import fitz  # PyMuPDF
+import pyarrow.parquet as pq
+
+# Add the project root to Python path
+project_root = str(Path(__file__).resolve().parents[2])
+sys.path.append(project_root)
+
+# Pipeline modules - handle both package import and direct script execution
+try:
+    from preprocess.utils import ocr_cache, ocr_hcfa, pdf_preview, preview_ocr, storage
+    from preprocess.utils.storage import LocalStorage, upload_bytes, download_bytes, list_objects
+    from preprocess.utils.ocr_engines import get_engine
+    from preprocess.utils.ocr_layout import page_annotation
+except ImportError:
+    import ocr_cache
+    import ocr_hcfa
+    import pdf_preview
+    import preview_ocr
+    import storage
+    from storage import LocalStorage, upload_bytes, download_bytes, list_objects
+    from ocr_engines import get_engine
+    from ocr_layout import page_annotation
+
+# Scanned-looking claims: too few words for the text layer, so both paths go to OCR
+DOCUMENTS = {
+    'claim_one.pdf': [["DOE, JOHN A", "03/14/24 73721 $250.00"]],
+    'claim_two.pdf': [["ROE, JANE", "04/01/24 72148 $410.00"], ["PAGE 2", "04/02/24 72148"]],
+}
+
+
+# Temporary directory and the settings setup_module replaced, restored by teardown_module
+_tmp_root = None
+_saved = {}
+
+
+def setup_module(module=None):
+    """Local storage and OCR cache in a temporary directory, a fake engine without latency or errors."""
+    global _tmp_root
+    _tmp_root = Path(tempfile.mkdtemp(prefix='test_preview_ocr_'))
+    client = get_engine('fake').client
+    _saved.update({
+        'storage': (storage._storage, storage._storage_pid),
+        'cache_dir': ocr_cache.OCR_CACHE_DIR,
+        'cached_engines': ocr_hcfa.CACHED_ENGINES,
+        'fake': (client.latency_ms, client.jitter_ms, client.error_rate),
+    })
+    storage._storage, storage._storage_pid = LocalStorage(_tmp_root / 'storage'), os.getpid()
+    ocr_cache.OCR_CACHE_DIR = str(_tmp_root / 'ocr_cache')
+    # Cache fake results too, so the render-once cache write can be checked
+    ocr_hcfa.CACHED_ENGINES = _saved['cached_engines'] + ('fake',)
+    client.latency_ms = client.jitter_ms = client.error_rate = 0
+
+
+def teardown_module(module=None):
+    storage._storage, storage._storage_pid = _saved.pop('storage')
+    ocr_cache.OCR_CACHE_DIR = _saved.pop('cache_dir')
+    ocr_hcfa.CACHED_ENGINES = _saved.pop('cached_engines')
+    client = get_engine('fake').client
+    client.latency_ms, client.jitter_ms, client.error_rate = _saved.pop('fake')
+    shutil.rmtree(_tmp_root, ignore_errors=True)
+
+
+def _pdf(pages) -> bytes:
+    with fitz.open() as document:
+        for lines in pages:
+            page = document.new_page()
+            for line, text in enumerate(lines):
+                page.insert_text((72, 100 + line * 40), text, fontsize=12)
+        return document.tobytes()
+
+
+def _pixel_annotation(page, width, height) -> dict:
+    """What Vision reads from a rendered page: the page's words with vertices in pixels."""
+    annotation = page_annotation(page, confidence=0.99)
+    for layout in annotation['pages']:
+        layout['width'], layout['height'] = width, height
+        for block in layout['blocks']:
+            for paragraph in block['paragraphs']:
+                for word in paragraph['words']:
+                    box = word['bounding_box']
+                    box['vertices'] = [{'x': vertex['x'] * width, 'y': vertex['y'] * height}
+                                       for vertex in box['normalized_vertices']]
+                    box['normalized_vertices'] = []
+    return annotation
+
+
+def _register_rendered_pages(client, content):
+    with fitz.open(stream=content, filetype="pdf") as document:
+        for page in document:
+            image = pdf_preview.render_page(page)
+            client.register_image(preview_ocr.encode_ocr_image(image),
+                                  _pixel_annotation(page, image.width, image.height))
+
+
+def _reset_storage():
+    for name in ('storage', 'ocr_cache'):
+        shutil.rmtree(_tmp_root / name, ignore_errors=True)
+
+
+def _upload_documents():
+    contents = {}
+    for name, pages in DOCUMENTS.items():
+        contents[name] = _pdf(pages)
+        upload_bytes(contents[name], f"{ocr_hcfa.INPUT_PREFIX}{name}")
+    return contents
+
+
+def _outputs():
+    """Text, layout table and preview images of every document."""
+    outputs = {}
+    for name in DOCUMENTS:
+        stem = Path(name).stem
+        layout = pq.read_table(BytesIO(download_bytes(f"{ocr_hcfa.LAYOUT_PREFIX}{stem}.parquet")))
+        previews = {key: download_bytes(key) for key in list_objects(f"{pdf_preview.PREVIEW_PREFIX}{stem}/")}
+        outputs[name] = {
+            'text': download_bytes(f"{ocr_hcfa.OUTPUT_PREFIX}{stem}.txt").decode('utf-8'),
+            'layout': layout.to_pylist(),
+            'previews': previews,
+        }
+    return outputs
+
+
+def _same_layout(expected, actual):
+    assert len(expected) == len(actual), f"{len(actual)} words, expected {len(expected)}"
+    for want, got in zip(expected, actual):
+        for column in ('page', 'block', 'paragraph', 'word', 'text'):
+            assert want[column] == got[column], f"{column}: {got[column]!r}, expected {want[column]!r}"
+        for column in ('x0', 'y0', 'x1', 'y1'):
+            assert abs(want[column] - got[column]) < 1e-4, f"{column}: {got[column]}, expected {want[column]}"
+
+
+def test_render_once_matches_two_stage_path():
+    engine = get_engine('fake')
+    _reset_storage()
+    _upload_documents()
+    pdf_preview.process_previews_s3()
+    ocr_hcfa.process_ocr_s3('fake')
+    two_stage = _outputs()
+
+    _reset_storage()
+    contents = _upload_documents()
+    for content in contents.values():
+        _register_rendered_pages(engine.client, content)
+    calls = engine.client.calls
+    preview_ocr.process_preview_ocr_s3('fake')
+    render_once = _outputs()
+
+    assert engine.client.calls - calls == len(DOCUMENTS), "one image request per document"
+    for name in DOCUMENTS:
+        assert render_once[name]['text'] == two_stage[name]['text'], name
+        _same_layout(two_stage[name]['layout'], render_once[name]['layout'])
+        assert len(render_once[name]['previews']) == 3
+        assert render_once[name]['previews'] == two_stage[name]['previews'], name
+        assert f"{ocr_hcfa.ARCHIVE_PREFIX}{name}" in list_objects(ocr_hcfa.ARCHIVE_PREFIX)
+
+        cached = ocr_cache.get(ocr_cache.content_hash(contents[name]))
+        assert cached is not None, f"{name} not cached under its PDF hash"
+        assert cached['text'] == render_once[name]['text']
+
+
+def test_fake_image_text_is_deterministic():
+    engine = get_engine('fake')
+    # Not registered with the fake, which answers from the image bytes alone
+    with fitz.open(stream=_pdf([["UNREGISTERED PAGE"]]), filetype="pdf") as document:
+        image = preview_ocr.encode_ocr_image(pdf_preview.render_page(document[0]))
+    first = engine.client.batch_annotate_images([engine._image_request(image)])
+    second = engine.client.batch_annotate_images([engine._image_request(image)])
+    first_text = first.responses[0].full_text_annotation.text
+    assert first_text.startswith("FAKE OCR ")
+    assert first_text == second.responses[0].full_text_annotation.text
+
+
+def main():
+    """Run all preview OCR tests"""
+    tests = [
+        test_render_once_matches_two_stage_path,
+        test_fake_image_text_is_deterministic,
+    ]
+    failed = 0
+    setup_module()
+    try:
+        for test in tests:
+            try:
+                test()
+                print(f"✔ {test.__name__}")
+            except AssertionError as e:
+                failed += 1
+                print(f"❌ {test.__name__}: {str(e)}")
+    finally:
+        teardown_module()
+
+    if failed:
+        print(f"\n❌ {failed} preview OCR tests failed")
+    else:
+        print("\n✔ All preview OCR tests passed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+test_text_layer.py
+
+Tests the text layer check that lets electronically generated PDFs skip OCR.
+Builds CMS-1500-like fixtures in memory: a vector form template with typed
+field values, the same template with the patient data embedded as an image,
+and the bare template.
+"""
+import sys
+import fitz  # PyMuPDF
+from pathlib import Path
+
+# Add the project root to Python path
+project_root = str(Path(__file__).resolve().parents[2])
+sys.path.append(project_root)
+
+# Import text layer helpers - handle both package import and direct script execution
+try:
+    from preprocess.utils.text_layer import text_layer_pages, is_usable_page, image_coverage
+except ImportError:
+    from text_layer import text_layer_pages, is_usable_page, image_coverage
+
+# Printed labels of the form, well over TEXT_LAYER_MIN_WORDS words
+TEMPLATE_LABELS = [
+    "HEALTH INSURANCE CLAIM FORM APPROVED BY NATIONAL UNIFORM CLAIM COMMITTEE (NUCC) 02/12",
+    "1. MEDICARE MEDICAID TRICARE CHAMPVA GROUP HEALTH PLAN FECA BLK LUNG OTHER",
+    "1a. INSURED'S I.D. NUMBER (For Program in Item 1)",
+    "2. PATIENT'S NAME (Last Name, First Name, Middle Initial)",
+    "3. PATIENT'S BIRTH DATE MM | DD | YY SEX M F",
+    "5. PATIENT'S ADDRESS (No., Street) CITY STATE ZIP CODE TELEPHONE",
+    "21. DIAGNOSIS OR NATURE OF ILLNESS OR INJURY Relate A-L to service line below",
+    "24. A. DATE(S) OF SERVICE From To MM | DD | YY B. PLACE OF SERVICE C. EMG",
+    "D. PROCEDURES, SERVICES, OR SUPPLIES CPT/HCPCS MODIFIER E. DIAGNOSIS POINTER F. $ CHARGES",
+    "25. FEDERAL TAX I.D. NUMBER SSN EIN 26. PATIENT'S ACCOUNT NO. 28. TOTAL CHARGE",
+    "33. BILLING PROVIDER INFO & PH # SIGNATURE OF PHYSICIAN OR SUPPLIER",
+]
+
+FIELD_VALUES = [
+    "DOE, JOHN A",
+    "01/02/1970 M",
+    "123 MAIN ST SPRINGFIELD IL 62701",
+    "03/14/24 03/14/24 11 73721 A $250.00",
+    "12-3456789 ACCT-0042 $250.00",
+]
+
+
+def _template_page(document):
+    page = document.new_page()
+    for line, text in enumerate(TEMPLATE_LABELS):
+        page.insert_text((36, 40 + line * 24), text, fontsize=8)
+    return page
+
+
+def _field_values_png() -> bytes:
+    """Patient data rendered to an image, as on forms filled by image overlay."""
+    with fitz.open() as document:
+        page = document.new_page(width=400, height=120)
+        for line, text in enumerate(FIELD_VALUES):
+            page.insert_text((5, 20 + line * 20), text, fontsize=10)
+        return page.get_pixmap(dpi=150).tobytes("png")
+
+
+def filled_pdf() -> bytes:
+    """Template with the field values typed into the text layer."""
+    with fitz.open() as document:
+        page = _template_page(document)
+        for line, text in enumerate(FIELD_VALUES):
+            page.insert_text((320, 400 + line * 24), text, fontsize=10)
+        return document.tobytes()
+
+
+def template_plus_image_pdf() -> bytes:
+    """Vector template with the patient data embedded as an image."""
+    with fitz.open() as document:
+        page = _template_page(document)
+        page.insert_image(fitz.Rect(36, 320, 576, 482), stream=_field_values_png())
+        return document.tobytes()
+
+
+def template_only_pdf() -> bytes:
+    """The printed form with nothing filled in."""
+    with fitz.open() as document:
+        _template_page(document)
+        return document.tobytes()
+
+
+def test_filled_form_uses_text_layer():
+    pages = text_layer_pages(filled_pdf())
+    assert pages is not None, "typed form should skip OCR"
+    assert "03/14/24" in pages[0]['text']
+
+
+def test_template_with_image_data_needs_ocr():
+    content = template_plus_image_pdf()
+    with fitz.open(stream=content, filetype="pdf") as document:
+        page = document[0]
+        assert len(page.get_text("words")) >= 40, "fixture labels should pass the word count"
+        assert image_coverage(page) > 0.1
+        assert not is_usable_page(page)
+    assert text_layer_pages(content) is None
+
+
+def test_template_without_field_values_needs_ocr():
+    assert text_layer_pages(template_only_pdf()) is None
+
+
+def main():
+    """Run all text layer tests"""
+    tests = [
+        test_filled_form_uses_text_layer,
+        test_template_with_image_data_needs_ocr,
+        test_template_without_field_values_needs_ocr,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✔ {test.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"❌ {test.__name__}: {str(e)}")
+
+    if failed:
+        print(f"\n❌ {failed} text layer tests failed")
+    else:
+        print("\n✔ All text layer tests passed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+text_layer.py
+
+Detects PDFs that already carry a usable embedded text layer (electronically
+generated forms), so the OCR stage can take their text straight from the PDF
+with PyMuPDF instead of sending them to OCR.
+
+A page counts as usable when it has at least TEXT_LAYER_MIN_WORDS words,
+at least TEXT_LAYER_MIN_QUALITY of its characters are letters, digits,
+punctuation or spaces, its text holds a filled-in date, and images cover at
+most TEXT_LAYER_MAX_IMAGE_COVERAGE of it. Fonts without a Unicode mapping
+extract as private-use or replacement characters and fail the quality check;
+scans have no words. A vector form template whose patient data is embedded as
+images passes on its printed labels alone, so such pages are caught by the
+date and image checks and still go to OCR.
+"""
+import os
+import re
+import string
+import fitz  # PyMuPDF
+
+# Annotation builder - handle both package import and direct script execution
+try:
+    from preprocess.utils.ocr_layout import page_annotation
+except ImportError:
+    from ocr_layout import page_annotation
+
+# A filled CMS-1500 has a few hundred words; a blank or scanned page has none
+TEXT_LAYER_MIN_WORDS = int(os.getenv('TEXT_LAYER_MIN_WORDS', '40'))
+TEXT_LAYER_MIN_QUALITY = float(os.getenv('TEXT_LAYER_MIN_QUALITY', '0.9'))
+# Share of the page images may cover; above it, data may be in the images
+TEXT_LAYER_MAX_IMAGE_COVERAGE = float(os.getenv('TEXT_LAYER_MAX_IMAGE_COVERAGE', '0.1'))
+
+# A filled-in date (MM/DD/YY, M-D-YYYY, or MM DD YY typed into the date boxes);
+# the printed form only has "MM | DD | YY" labels
+_DATE_PATTERN = re.compile(r'\b(?:\d{1,2}[/-]\d{1,2}[/-]|\d{2} \d{2} )(?:\d{4}|\d{2})\b')
+
+_PLAIN_CHARACTERS = frozenset(string.punctuation + string.whitespace + '$§°±€£')
+
+
+def text_quality(text: str) -> float:
+    """Share of characters in text that are letters, digits, punctuation or whitespace."""
+    if not text:
+        return 0.0
+    plain = sum(1 for char in text if char.isalnum() or char in _PLAIN_CHARACTERS)
+    return plain / len(text)
+
+
+def has_field_values(text: str) -> bool:
+    """True if the text holds a filled-in date, i.e. more than the printed form labels."""
+    return _DATE_PATTERN.search(text) is not None
+
+
+def image_coverage(page) -> float:
+    """Share of the page area covered by images (overlapping images are counted twice, capped at 1)."""
+    area = page.rect.width * page.rect.height
+    if not area:
+        return 0.0
+    covered = 0.0
+    for image in page.get_image_info():
+        box = fitz.Rect(image['bbox']) & page.rect
+        if not box.is_empty:
+            covered += box.width * box.height
+    return min(1.0, covered / area)
+
+
+def is_usable_page(page, words=None) -> bool:
+    """True if the page's text layer can stand in for OCR."""
+    words = page.get_text("words") if words is None else words
+    if len(words) < TEXT_LAYER_MIN_WORDS:
+        return False
+    text = " ".join(word[4] for word in words)
+    if text_quality(text) < TEXT_LAYER_MIN_QUALITY or not has_field_values(text):
+        return False
+    return image_coverage(page) <= TEXT_LAYER_MAX_IMAGE_COVERAGE
+
+
+def text_layer_pages(content: bytes):
+    """
+    Page annotations from the PDF's text layer if every page is usable,
+    otherwise None (the document needs OCR).
+    """
+    with fitz.open(stream=content, filetype="pdf") as document:
+        if not document.page_count:
+            return None
+        pages = []
+        for page in document:
+            if not is_usable_page(page):
+                return None
+            pages.append(page_annotation(page))
+        return pages
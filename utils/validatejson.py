@@ -9,8 +9,8 @@ import os
 import json
 import re
 import sys
-import tempfile
 import unicodedata
+import itertools
 from datetime import datetime
 from pathlib import Path
 from dotenv import load_dotenv
@@ -22,8 +22,17 @@ sys.path.append(project_root)
 # Load environment variables
 load_dotenv()
 
-# Import S3 helper functions
-from utils.s3_utils import list_objects, download, upload, move
+# Import storage helpers - handle both package import and direct script execution
+try:
+    from preprocess.utils.storage import iter_objects, download_bytes, upload_bytes, move, replace_object, batched_deletes
+except ImportError:
+    from storage import iter_objects, download_bytes, upload_bytes, move, replace_object, batched_deletes
+
+# Shared date formats - handle both package import and direct script execution
+try:
+    from preprocess.utils.date_parsing import VALIDATION_FORMATS
+except ImportError:
+    from date_parsing import VALIDATION_FORMATS
 
 # S3 prefixes (override in .env if needed)
 INPUT_PREFIX = os.getenv('VALIDATE_INPUT_PREFIX', 'data/hcfa_json/')
@@ -118,7 +127,7 @@ def parse_date(date_str):
     Try to parse a date string using formats MM/DD/YY and MM/DD/YYYY.
     Return the date in YYYY-MM-DD format if successful, otherwise None.
     """
-    for fmt in ("%m/%d/%y", "%m/%d/%Y"):
+    for fmt in VALIDATION_FORMATS:
         try:
             return datetime.strptime(date_str, fmt).strftime("%Y-%m-%d")
         except ValueError:
@@ -191,82 +200,73 @@ def validate_json(data):
     
     return True, "Valid JSON"
 
-def process_validation_s3(limit=None):
-    """Process JSON files from S3, validate them, and move to appropriate locations."""
-    print(f"Starting validation run against bucket: {S3_BUCKET} (prefix: {INPUT_PREFIX})")
-    
-    # Get list of JSON files to process - only from root hcfa_json directory
-    all_keys = list_objects(INPUT_PREFIX)
-    json_keys = [k for k in all_keys if k.lower().endswith('.json') 
+def iter_json_keys(limit=None):
+    """Stream JSON files to process - only from root hcfa_json directory (sub-folders are never listed)."""
+    all_keys = iter_objects(INPUT_PREFIX, recursive=False)
+    json_keys = (k for k in all_keys if k.lower().endswith('.json') 
                 and k.count('/') == 2  # Only process files in root hcfa_json directory
-                and not any(x in k for x in ['valid', 'invalid', 'garbage', 'processed'])]  # Skip already processed files
+                and not any(x in k for x in ['valid', 'invalid', 'garbage', 'processed']))  # Skip already processed files
     
     if limit:
-        json_keys = json_keys[:int(limit)]
+        json_keys = itertools.islice(json_keys, int(limit))
+    return json_keys
 
-    for key in json_keys:
-        print(f"→ Processing s3://{S3_BUCKET}/{key}")
-        local_json = download(key, os.path.join(tempfile.gettempdir(), os.path.basename(key)))
+def validate_document(key):
+    """
+    Validate one JSON file and move it to the valid or invalid prefix.
+    
+    Returns:
+        Key of the cleaned JSON if it is valid, otherwise None
+    """
+    print(f"→ Processing s3://{S3_BUCKET}/{key}")
+    try:
+        # Load and validate JSON
+        data = json.loads(download_bytes(key).decode('utf-8'))
+    
+        # Store original name for comparison
+        original_name = data.get("patient_info", {}).get("patient_name", "N/A")
+    
+        is_valid, message = validate_json(data)
+    
+        # Cleaned/standardized data
+        cleaned_json = json.dumps(data, indent=4).encode('utf-8')
+    
+        if is_valid:
+            # Move to valid directory
+            dest_key = f"data/hcfa_json/valid/{os.path.basename(key)}"
+            replace_object(key, dest_key, cleaned_json, content_type='application/json')
+            print(f"✔ Valid JSON moved to s3://{S3_BUCKET}/{dest_key}")
         
-        try:
-            # Load and validate JSON
-            with open(local_json, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            # Store original name for comparison
-            original_name = data.get("patient_info", {}).get("patient_name", "N/A")
-            
-            is_valid, message = validate_json(data)
-            
-            # Write back cleaned/standardized data
-            with open(local_json, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=4)
-            
-            if is_valid:
-                # Move to valid directory
-                dest_key = f"data/hcfa_json/valid/{os.path.basename(key)}"
-                upload(local_json, dest_key)
-                print(f"✔ Valid JSON moved to s3://{S3_BUCKET}/{dest_key}")
-                
-                # Delete original after successful upload
-                move(key, dest_key)
-                
-                # Log name changes if any
-                new_name = data.get("patient_info", {}).get("patient_name", "N/A")
-                if new_name != original_name:
-                    log_msg = f"Name standardized in {key}: {original_name} -> {new_name}"
-                    log_local = tempfile.mktemp(suffix='.log')
-                    with open(log_local, 'w', encoding='utf-8') as logf:
-                        logf.write(log_msg + '\n')
-                    upload(log_local, LOG_PREFIX)
-                    os.remove(log_local)
-            else:
-                # Move invalid files to invalid directory
-                dest_key = f"data/hcfa_json/invalid/{os.path.basename(key)}"
-                move(key, dest_key)
-                print(f"❌ Invalid JSON moved to s3://{S3_BUCKET}/{dest_key}")
-                
-                # Log validation error
-                log_msg = f"Validation failed for {key}: {message}"
-                log_local = tempfile.mktemp(suffix='.log')
-                with open(log_local, 'w', encoding='utf-8') as logf:
-                    logf.write(log_msg + '\n')
-                upload(log_local, LOG_PREFIX)
-                os.remove(log_local)
-                
-        except Exception as e:
-            err = f"❌ Error processing {key}: {str(e)}"
-            print(err)
-            log_local = tempfile.mktemp(suffix='.log')
-            with open(log_local, 'w', encoding='utf-8') as logf:
-                logf.write(err + '\n')
-            upload(log_local, LOG_PREFIX)
-            os.remove(log_local)
-            
-        finally:
-            # Clean up temporary files
-            if os.path.exists(local_json):
-                os.remove(local_json)
+            # Log name changes if any
+            new_name = data.get("patient_info", {}).get("patient_name", "N/A")
+            if new_name != original_name:
+                log_msg = f"Name standardized in {key}: {original_name} -> {new_name}"
+                upload_bytes((log_msg + '\n').encode('utf-8'), LOG_PREFIX)
+            return dest_key
+
+        # Move invalid files to invalid directory
+        dest_key = f"data/hcfa_json/invalid/{os.path.basename(key)}"
+        move(key, dest_key)
+        print(f"❌ Invalid JSON moved to s3://{S3_BUCKET}/{dest_key}")
+    
+        # Log validation error
+        log_msg = f"Validation failed for {key}: {message}"
+        upload_bytes((log_msg + '\n').encode('utf-8'), LOG_PREFIX)
+        
+    except Exception as e:
+        err = f"❌ Error processing {key}: {str(e)}"
+        print(err)
+        upload_bytes((err + '\n').encode('utf-8'), LOG_PREFIX)
+    return None
+
+def process_validation_s3(limit=None):
+    """Process JSON files from S3, validate them, and move to appropriate locations."""
+    print(f"Starting validation run against bucket: {S3_BUCKET} (prefix: {INPUT_PREFIX})")
+    
+    # Originals are deleted in batches once their cleaned copies are written
+    with batched_deletes():
+        for key in iter_json_keys(limit):
+            validate_document(key)
 
     print("Validation run complete.")
 